@@ -1,7 +1,11 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 import asyncpg
 import config
+import rollups
+import jst_columns
+import partitions
+import invalidation
 
 class Logger(commands.Cog):
     def __init__(self, bot):
@@ -9,6 +13,7 @@ class Logger(commands.Cog):
         self.db_dsn = config.DB_DSN
         self.pool = None
         self.known_channel_ids = set()
+        self.pending_buckets = set()
 
     async def cog_load(self):
         self.pool = await asyncpg.create_pool(self.db_dsn)
@@ -23,28 +28,73 @@ class Logger(commands.Cog):
             );
             ALTER TABLE channels ADD COLUMN IF NOT EXISTS is_active BOOLEAN DEFAULT TRUE;
             ALTER TABLE channels ADD COLUMN IF NOT EXISTS category_id BIGINT;
-
-            CREATE TABLE IF NOT EXISTS messages (
-                message_id BIGINT PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                channel_id BIGINT NOT NULL,
-                guild_id BIGINT NOT NULL,
-                created_at TIMESTAMP WITH TIME ZONE NOT NULL,
-                is_bot BOOLEAN DEFAULT FALSE,
-                char_count INTEGER DEFAULT 0
-            );
-            CREATE INDEX IF NOT EXISTS idx_messages_user ON messages (user_id);
-            CREATE INDEX IF NOT EXISTS idx_messages_channel ON messages (channel_id);
-            CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages (created_at);
-            CREATE INDEX IF NOT EXISTS idx_messages_human_created_user ON messages (created_at, user_id) WHERE is_bot = FALSE;
-            CREATE INDEX IF NOT EXISTS idx_messages_human_channel_created_user ON messages (channel_id, created_at, user_id) WHERE is_bot = FALSE;
-            CREATE INDEX IF NOT EXISTS idx_messages_human_user_created ON messages (user_id, created_at) WHERE is_bot = FALSE;
         ''')
+        await partitions.ensure_messages_table(self.pool)
+        await self.add_jst_columns()
+        await rollups.ensure_rollup_table(self.pool)
+        await invalidation.ensure_generation_table(self.pool)
+        self.flush_buckets.change_interval(seconds=config.BUCKET_FLUSH_SECONDS)
+        self.flush_buckets.start()
+        self.ensure_partitions.start()
 
     async def cog_unload(self):
+        self.flush_buckets.cancel()
+        self.ensure_partitions.cancel()
+        self.retry_jst_columns.cancel()
+        try:
+            await self.publish_buckets()
+        except Exception as e:
+            print(f"Notify Error: {e}")
         if self.pool:
             await self.pool.close()
 
+    # 書き込みのたびに通知せず、一定間隔でまとめて API のキャッシュを無効化する
+    @tasks.loop(seconds=60)
+    async def flush_buckets(self):
+        try:
+            await self.publish_buckets()
+        except Exception as e:
+            print(f"Notify Error: {e}")
+
+    # 月が替わる前に先の月のパーティションを作っておく
+    @tasks.loop(hours=24)
+    async def ensure_partitions(self):
+        try:
+            await partitions.ensure_future_partitions(self.pool)
+        except Exception as e:
+            print(f"Partition Error: {e}")
+
+    # JST 列の追加は messages のロックを5秒しか待たない。取れなくてもログの記録は止めず、後でやり直す
+    async def add_jst_columns(self):
+        try:
+            await jst_columns.ensure_jst_columns(self.pool)
+        except asyncpg.exceptions.LockNotAvailableError:
+            print("JST Columns Error: messages is locked. Retrying later.")
+            if not self.retry_jst_columns.is_running():
+                self.retry_jst_columns.start()
+            return False
+        return True
+
+    @tasks.loop(minutes=10)
+    async def retry_jst_columns(self):
+        try:
+            if await self.add_jst_columns():
+                self.retry_jst_columns.stop()
+        except Exception as e:
+            print(f"JST Columns Error: {e}")
+
+    async def publish_buckets(self):
+        if not self.pending_buckets or not self.pool:
+            return
+        buckets, self.pending_buckets = self.pending_buckets, set()
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await invalidation.publish(conn, buckets)
+        except Exception:
+            self.pending_buckets.update(buckets)
+            raise
+
     @commands.Cog.listener()
     async def on_message(self, message):
         if message.author.bot or not message.guild:
@@ -52,22 +102,33 @@ class Logger(commands.Cog):
 
         try:
             await self.ensure_channel(message.channel)
-            await self.pool.execute("""
-                INSERT INTO messages (message_id, user_id, channel_id, guild_id, created_at, is_bot, char_count)
-                VALUES ($1, $2, $3, $4, $5, $6, $7)
-                ON CONFLICT (message_id) DO NOTHING
-            """, 
-            message.id, 
-            message.author.id, 
-            message.channel.id, 
-            message.guild.id, 
-            message.created_at, 
-            message.author.bot, 
-            len(message.content)
-            )
+            try:
+                await self.insert_message(message)
+            except asyncpg.CheckViolationError as e:
+                # その月のパーティションがまだ無ければ、この場で作ってやり直す (メッセージを落とさない)
+                if not partitions.is_missing_partition(e):
+                    raise
+                await partitions.ensure_partitions_for(self.pool, [message.created_at])
+                await self.insert_message(message)
+            self.pending_buckets.add(invalidation.bucket_of(message.created_at, message.channel.id))
         except Exception as e:
             print(f"Log Error: {e}")
 
+    async def insert_message(self, message):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await rollups.lock_shared(conn)
+                await rollups.insert_message(
+                    conn,
+                    message.id,
+                    message.author.id,
+                    message.channel.id,
+                    message.guild.id,
+                    message.created_at,
+                    message.author.bot,
+                    len(message.content)
+                )
+
     async def ensure_channel(self, channel):
         if channel.id in self.known_channel_ids:
             return
@@ -98,15 +159,20 @@ class Logger(commands.Cog):
                 position = EXCLUDED.position,
                 is_active = TRUE
         ''', channel.id, name, category_name, category_id, position)
+        await invalidation.publish_channels(self.pool)
         self.known_channel_ids.add(channel.id)
 
+    async def delete_messages(self, message_ids):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await rollups.lock_shared(conn)
+                buckets = await rollups.delete_messages(conn, message_ids)
+        self.pending_buckets.update(buckets)
+
     @commands.Cog.listener()
     async def on_raw_message_delete(self, payload):
         try:
-            await self.pool.execute(
-                "DELETE FROM messages WHERE message_id = $1", 
-                payload.message_id
-            )
+            await self.delete_messages([payload.message_id])
         except Exception as e:
             print(f"Delete Error: {e}")
 
@@ -115,10 +181,7 @@ class Logger(commands.Cog):
         if not payload.message_ids:
             return
         try:
-            await self.pool.execute(
-                "DELETE FROM messages WHERE message_id = ANY($1::bigint[])",
-                list(payload.message_ids)
-            )
+            await self.delete_messages(list(payload.message_ids))
         except Exception as e:
             print(f"Bulk Delete Error: {e}")
 
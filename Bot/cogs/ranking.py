@@ -14,7 +14,36 @@ EMOJI_THIRD = "<:third:1452958880379306024>"
 EXCLUDE_CHANNEL_ID = 1406033558757314752
 KING_ROLE_ID = 1452968848998531245
 
-DELETED_USER_FILTER = "(u.user_id IS NOT NULL AND u.username NOT ILIKE 'deleted%user' AND u.display_name NOT ILIKE 'deleted%user')"
+DELETED_USER_FILTER = "(u.user_id IS NOT NULL AND NOT u.is_excluded)"
+
+# bench/query_plans.py がこの2つの実行計画も確かめる ($1: ギルド / $1, $2: 期間, $3: ギルド)
+TOTAL_RANKING_SQL = f"""
+    SELECT
+        m.user_id,
+        count(*) as count,
+        u.display_name,
+        u.username,
+        u.avatar_url as avatar
+    FROM messages m
+    LEFT JOIN users u ON m.user_id = u.user_id
+    WHERE m.is_bot = FALSE AND m.guild_id = $1 AND m.channel_id != {EXCLUDE_CHANNEL_ID}
+      AND {DELETED_USER_FILTER}
+    GROUP BY m.user_id, u.display_name, u.username, u.avatar_url
+    ORDER BY count DESC
+    LIMIT 100
+"""
+
+MONTHLY_RANKING_SQL = f"""
+    SELECT m.user_id, count(*) as count, u.display_name
+    FROM messages m
+    LEFT JOIN users u ON m.user_id = u.user_id
+    WHERE m.created_at >= $1 AND m.created_at <= $2
+      AND m.is_bot = FALSE AND m.guild_id = $3 AND m.channel_id != {EXCLUDE_CHANNEL_ID}
+      AND {DELETED_USER_FILTER}
+    GROUP BY m.user_id, u.display_name
+    ORDER BY count DESC
+    LIMIT 10
+"""
 
 # 古いボタン対策
 class DummyOldRankingView(discord.ui.View):
@@ -159,21 +188,7 @@ class Ranking(commands.Cog):
         
         pool = await self.get_db_pool()
         try:
-            rows = await pool.fetch(f"""
-                SELECT
-                    m.user_id,
-                    count(*) as count,
-                    u.display_name,
-                    u.username,
-                    u.avatar_url as avatar
-                FROM messages m
-                LEFT JOIN users u ON m.user_id = u.user_id
-                WHERE m.is_bot = FALSE AND m.guild_id = $1 AND m.channel_id != {EXCLUDE_CHANNEL_ID}
-                  AND {DELETED_USER_FILTER}
-                GROUP BY m.user_id, u.display_name, u.username, u.avatar_url
-                ORDER BY count DESC
-                LIMIT 100
-            """, config.GUILD_ID)
+            rows = await pool.fetch(TOTAL_RANKING_SQL, config.GUILD_ID)
 
             if not rows:
                 await interaction.followup.send("データがありません")
@@ -205,17 +220,7 @@ class Ranking(commands.Cog):
         end_date = (start_date + relativedelta(months=1)) - timedelta(seconds=1)
 
         try:
-            rows = await pool.fetch(f"""
-                SELECT m.user_id, count(*) as count, u.display_name
-                FROM messages m
-                LEFT JOIN users u ON m.user_id = u.user_id
-                WHERE m.created_at >= $1 AND m.created_at <= $2
-                  AND m.is_bot = FALSE AND m.guild_id = $3 AND m.channel_id != {EXCLUDE_CHANNEL_ID}
-                  AND {DELETED_USER_FILTER}
-                GROUP BY m.user_id, u.display_name
-                ORDER BY count DESC
-                LIMIT 10
-            """, start_date, end_date, config.GUILD_ID)
+            rows = await pool.fetch(MONTHLY_RANKING_SQL, start_date, end_date, config.GUILD_ID)
 
             if not rows:
                 if channel: await channel.send(f"{year}年{month}月のデータはありません。")
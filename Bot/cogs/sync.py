@@ -3,6 +3,19 @@ from discord.ext import commands, tasks
 import asyncpg
 import config
 import asyncio
+import invalidation
+
+# 削除済みユーザーはランキングなどから除く。名前から判定して is_excluded に持ち、API は除外する ID の一覧だけを読む
+UPDATE_EXCLUDED_SQL = '''
+    UPDATE users
+    SET is_excluded = (username ILIKE 'deleted%user' OR display_name ILIKE 'deleted%user')
+    WHERE is_excluded IS DISTINCT FROM (username ILIKE 'deleted%user' OR display_name ILIKE 'deleted%user')
+'''
+
+# users を書き換えたら is_excluded を更新し、API に除外ユーザーと検索用の索引を読み直させる
+async def refresh_users(pool):
+    await pool.execute(UPDATE_EXCLUDED_SQL)
+    await invalidation.publish_users(pool)
 
 class SyncData(commands.Cog):
     def __init__(self, bot):
@@ -30,9 +43,12 @@ class SyncData(commands.Cog):
                 user_id BIGINT PRIMARY KEY,
                 display_name TEXT NOT NULL,
                 username TEXT NOT NULL,
-                avatar_url TEXT
+                avatar_url TEXT,
+                is_excluded BOOLEAN NOT NULL DEFAULT FALSE
             );
+            ALTER TABLE users ADD COLUMN IF NOT EXISTS is_excluded BOOLEAN NOT NULL DEFAULT FALSE;
         ''')
+        await refresh_users(pool)
 
         await pool.close()
         self.sync_loop.start()
@@ -83,6 +99,7 @@ class SyncData(commands.Cog):
                         position = EXCLUDED.position,
                         is_active = EXCLUDED.is_active
                 ''', channel_data)
+            await invalidation.publish_channels(pool)
 
             member_data = []
             for member in guild.members:
@@ -96,6 +113,7 @@ class SyncData(commands.Cog):
                 ON CONFLICT (user_id) DO UPDATE 
                 SET display_name = EXCLUDED.display_name, username = EXCLUDED.username, avatar_url = EXCLUDED.avatar_url
             ''', member_data)
+            await refresh_users(pool)
             
             print(f"同期完了: チャンネル{len(channel_data)}件 / メンバー{len(member_data)}人")
             
@@ -140,6 +158,7 @@ class SyncData(commands.Cog):
                     VALUES ($1, $2, $3, $4)
                     ON CONFLICT (user_id) DO NOTHING
                 ''', updates)
+                await refresh_users(pool)
                 print(f"補完完了: {len(updates)}人")
 
         finally:
@@ -37,3 +37,9 @@ ADMIN_ROLE_ID = int(os.getenv("ADMIN_ROLE_ID", 0))
 
 KING_ROLE_ID = int(os.getenv("KING_ROLE_ID", 0))
 ANNOUNCE_CHANNEL_ID = int(os.getenv("ANNOUNCE_CHANNEL_ID", 0))
+
+# 書き込んだ (月, チャンネル) を API に通知する間隔 (秒)
+BUCKET_FLUSH_SECONDS = int(os.getenv("BUCKET_FLUSH_SECONDS", 60))
+
+# messages の月別パーティションを何か月先まで作っておくか
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", 2))
@@ -5,6 +5,11 @@ import datetime
 import os
 import argparse
 import config
+import rollups
+import jst_columns
+import partitions
+import invalidation
+from cogs.sync import refresh_users
 import logging
 import sys
 
@@ -126,16 +131,6 @@ def parse_datetime(value):
 async def ensure_tables(pool):
     async with pool.acquire() as conn:
         await conn.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                message_id BIGINT PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                channel_id BIGINT NOT NULL,
-                guild_id BIGINT NOT NULL,
-                created_at TIMESTAMP WITH TIME ZONE NOT NULL,
-                is_bot BOOLEAN DEFAULT FALSE,
-                char_count INTEGER DEFAULT 0
-            );
-
             CREATE TABLE IF NOT EXISTS users (
                 user_id BIGINT PRIMARY KEY,
                 display_name TEXT NOT NULL,
@@ -163,6 +158,10 @@ async def ensure_tables(pool):
             ALTER TABLE channels ADD COLUMN IF NOT EXISTS is_active BOOLEAN DEFAULT TRUE;
             ALTER TABLE channels ADD COLUMN IF NOT EXISTS category_id BIGINT;
         ''')
+        await partitions.ensure_messages_table(conn)
+        await jst_columns.ensure_jst_columns(conn)
+        await rollups.ensure_rollup_table(conn)
+        await invalidation.ensure_generation_table(conn)
 
 async def collect_threads(guild, parent_channels):
     threads_by_id = {}
@@ -364,10 +363,13 @@ async def save_channels(pool, channels, mark_missing_inactive=False):
                         position = EXCLUDED.position,
                         is_active = EXCLUDED.is_active
                 ''', channel_data)
+            await invalidation.publish_channels(conn)
     logger.info(f"Synced {len(channel_data)} channels.")
 
 async def save_to_db(pool, messages, users):
     async with pool.acquire() as conn:
+        # パーティションの作成は親テーブルを排他ロックするので、書き込みのトランザクションの外で行う
+        await partitions.ensure_partitions_for(conn, [m[4] for m in messages])
         async with conn.transaction():
             if users:
                 await conn.executemany('''
@@ -378,19 +380,13 @@ async def save_to_db(pool, messages, users):
                         username = EXCLUDED.username,
                         avatar_url = EXCLUDED.avatar_url
                 ''', list(users.values()))
-            
+                # 入れた "Deleted User" を次の同期を待たずに除外し、API にも読み直させる (NOTIFY はコミット時に届く)
+                await refresh_users(conn)
+
             if messages:
-                await conn.executemany('''
-                    INSERT INTO messages (message_id, user_id, channel_id, guild_id, created_at, is_bot, char_count)
-                    VALUES ($1, $2, $3, $4, $5, $6, $7)
-                    ON CONFLICT (message_id) DO UPDATE SET
-                        user_id = EXCLUDED.user_id,
-                        channel_id = EXCLUDED.channel_id,
-                        guild_id = EXCLUDED.guild_id,
-                        created_at = EXCLUDED.created_at,
-                        is_bot = EXCLUDED.is_bot,
-                        char_count = EXCLUDED.char_count
-                ''', messages)
+                await rollups.lock_exclusive(conn)
+                buckets = await rollups.upsert_messages(conn, messages)
+                await invalidation.publish(conn, buckets)
 
 @client.event
 async def on_ready():
@@ -0,0 +1,59 @@
+import datetime
+import json
+
+# API はこのチャンネルを LISTEN し、書き込みのあった (月, チャンネル) のキャッシュを無効化する
+BUCKET_CHANNEL = "ymkw_message_buckets"
+# channels テーブルを書き換えたら API のチャンネル索引を読み直させる
+CHANNELS_CHANNEL = "ymkw_channels"
+# users を同期したら API の除外ユーザー一覧とユーザー検索の索引を読み直させる
+USERS_CHANNEL = "ymkw_users"
+MAX_PAYLOAD_BYTES = 7000
+
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+CREATE_GENERATIONS_SQL = '''
+    CREATE TABLE IF NOT EXISTS bucket_generations (
+        month TEXT NOT NULL,
+        channel_id BIGINT NOT NULL,
+        generation BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (month, channel_id)
+    );
+'''
+
+def bucket_of(created_at, channel_id):
+    return created_at.astimezone(JST).strftime("%Y-%m"), channel_id
+
+async def ensure_generation_table(conn):
+    await conn.execute(CREATE_GENERATIONS_SQL)
+
+async def publish_channels(conn):
+    await conn.execute("SELECT pg_notify($1, '')", CHANNELS_CHANNEL)
+
+async def publish_users(conn):
+    await conn.execute("SELECT pg_notify($1, '')", USERS_CHANNEL)
+
+# 世代番号を進めて NOTIFY する。トランザクション内ならコミット時に届く
+async def publish(conn, buckets):
+    if not buckets:
+        return
+    months, channel_ids = zip(*sorted(buckets))
+    rows = await conn.fetch('''
+        INSERT INTO bucket_generations AS g (month, channel_id, generation)
+        SELECT month, channel_id, 1 FROM unnest($1::text[], $2::bigint[]) AS b(month, channel_id)
+        ON CONFLICT (month, channel_id) DO UPDATE SET generation = g.generation + 1
+        RETURNING month, channel_id, generation
+    ''', list(months), list(channel_ids))
+
+    chunk = []
+    size = 0
+    for r in rows:
+        item = [r["month"], r["channel_id"], r["generation"]]
+        item_size = len(json.dumps(item)) + 1
+        if chunk and size + item_size > MAX_PAYLOAD_BYTES:
+            await conn.execute("SELECT pg_notify($1, $2)", BUCKET_CHANNEL, json.dumps(chunk))
+            chunk = []
+            size = 0
+        chunk.append(item)
+        size += item_size
+    if chunk:
+        await conn.execute("SELECT pg_notify($1, $2)", BUCKET_CHANNEL, json.dumps(chunk))
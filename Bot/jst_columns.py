@@ -0,0 +1,141 @@
+import argparse
+import asyncio
+import logging
+import sys
+
+import asyncpg
+import config
+
+logger = logging.getLogger("jst_columns")
+
+JST_DATE_SQL = "(created_at AT TIME ZONE 'Asia/Tokyo')::date"
+JST_DOW_SQL = "EXTRACT(DOW FROM created_at AT TIME ZONE 'Asia/Tokyo')::smallint"
+JST_HOUR_SQL = "EXTRACT(HOUR FROM created_at AT TIME ZONE 'Asia/Tokyo')::smallint"
+COLUMNS = ["jst_date", "jst_dow", "jst_hour"]
+
+# 新しく作る messages テーブルでは生成列として持つ
+GENERATED_COLUMNS_SQL = f'''
+    jst_date DATE GENERATED ALWAYS AS ({JST_DATE_SQL}) STORED NOT NULL,
+    jst_dow SMALLINT GENERATED ALWAYS AS ({JST_DOW_SQL}) STORED NOT NULL,
+    jst_hour SMALLINT GENERATED ALWAYS AS ({JST_HOUR_SQL}) STORED NOT NULL
+'''
+
+# 既存のテーブルを生成列に変えると全行の書き換え中ずっと書き込みが止まるので、
+# 普通の列を足して (メタデータの変更だけで済む) 新しい行はトリガーで埋め、古い行は backfill で埋める
+ADD_COLUMNS_SQL = '''
+    SET LOCAL lock_timeout = '5s';
+    ALTER TABLE messages
+        ADD COLUMN IF NOT EXISTS jst_date DATE,
+        ADD COLUMN IF NOT EXISTS jst_dow SMALLINT,
+        ADD COLUMN IF NOT EXISTS jst_hour SMALLINT;
+    CREATE OR REPLACE FUNCTION set_messages_jst_columns() RETURNS trigger AS $$
+    BEGIN
+        NEW.jst_date := (NEW.created_at AT TIME ZONE 'Asia/Tokyo')::date;
+        NEW.jst_dow := EXTRACT(DOW FROM NEW.created_at AT TIME ZONE 'Asia/Tokyo')::smallint;
+        NEW.jst_hour := EXTRACT(HOUR FROM NEW.created_at AT TIME ZONE 'Asia/Tokyo')::smallint;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+    DROP TRIGGER IF EXISTS trg_messages_jst_columns ON messages;
+    CREATE TRIGGER trg_messages_jst_columns
+        BEFORE INSERT OR UPDATE OF created_at ON messages
+        FOR EACH ROW EXECUTE FUNCTION set_messages_jst_columns();
+'''
+
+BACKFILL_SQL = f'''
+    UPDATE messages
+    SET jst_date = {JST_DATE_SQL}, jst_dow = {JST_DOW_SQL}, jst_hour = {JST_HOUR_SQL}
+    WHERE message_id > $1 AND message_id <= $2 AND jst_date IS NULL
+'''
+
+# 全行が埋まったら NOT NULL にする。CHECK を NOT VALID で足してから VALIDATE すると書き込みを止めずに検証でき、
+# SET NOT NULL はその CHECK を使ってテーブルを読み直さずに済む
+SET_NOT_NULL_SQL = '''
+    SET LOCAL lock_timeout = '5s';
+    ALTER TABLE messages DROP CONSTRAINT IF EXISTS messages_jst_columns_not_null;
+    ALTER TABLE messages ADD CONSTRAINT messages_jst_columns_not_null
+        CHECK (jst_date IS NOT NULL AND jst_dow IS NOT NULL AND jst_hour IS NOT NULL) NOT VALID;
+'''
+
+async def ensure_jst_columns(conn):
+    count = await conn.fetchval(
+        "SELECT count(*) FROM information_schema.columns WHERE table_name = 'messages' AND column_name = ANY($1::text[])",
+        COLUMNS,
+    )
+    if count < len(COLUMNS):
+        await conn.execute(ADD_COLUMNS_SQL)
+
+# 全行に値が入っているか (生成列、または backfill 済み)。まだなら JST の日付・時は created_at から計算する
+async def jst_columns_ready(conn):
+    return bool(await conn.fetchval(
+        "SELECT attnotnull FROM pg_attribute WHERE attrelid = 'messages'::regclass AND attname = 'jst_date' AND NOT attisdropped"
+    ))
+
+async def backfill(pool, batch_size, pause):
+    started = asyncio.get_running_loop().time()
+    last_id = 0
+    updated = 0
+    # message_id 順に少しずつ埋め、1バッチごとにコミットして行ロックを短く保つ
+    while True:
+        async with pool.acquire() as conn:
+            upper = await conn.fetchval(
+                "SELECT max(message_id) FROM (SELECT message_id FROM messages WHERE message_id > $1 ORDER BY message_id LIMIT $2) b",
+                last_id, batch_size,
+            )
+            if upper is None:
+                break
+            status = await conn.execute(BACKFILL_SQL, last_id, upper)
+        updated += int(status.split()[-1])
+        last_id = upper
+        logger.info(f"Backfilled up to message_id {last_id}: {updated} rows")
+        await asyncio.sleep(pause)
+
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(SET_NOT_NULL_SQL)
+        await conn.execute("ALTER TABLE messages VALIDATE CONSTRAINT messages_jst_columns_not_null")
+        async with conn.transaction():
+            await conn.execute("SET LOCAL lock_timeout = '5s'")
+            await conn.execute(
+                "ALTER TABLE messages ALTER COLUMN jst_date SET NOT NULL, ALTER COLUMN jst_dow SET NOT NULL, ALTER COLUMN jst_hour SET NOT NULL"
+            )
+            await conn.execute("ALTER TABLE messages DROP CONSTRAINT messages_jst_columns_not_null")
+    elapsed = asyncio.get_running_loop().time() - started
+    logger.info(f"Backfilled JST columns: {updated} rows ({elapsed:.1f}s)")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Add and backfill the jst_date / jst_dow / jst_hour columns on messages.")
+    parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="Fill the columns for existing rows in small batches, then mark them NOT NULL.",
+    )
+    parser.add_argument("--batch-size", type=int, default=10_000, help="Rows updated per transaction.")
+    parser.add_argument("--pause", type=float, default=0.05, help="Seconds to sleep between batches.")
+    return parser.parse_args()
+
+async def main():
+    args = parse_args()
+    if not config.DB_DSN:
+        logger.error("DB_DSN is not configured.")
+        return
+
+    pool = await asyncpg.create_pool(config.DB_DSN, command_timeout=None)
+    try:
+        await ensure_jst_columns(pool)
+        if await jst_columns_ready(pool):
+            logger.info("JST columns are already filled.")
+        elif args.backfill:
+            await backfill(pool, args.batch_size, args.pause)
+        else:
+            logger.info("Columns added. Run with --backfill to fill existing rows.")
+    finally:
+        await pool.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+    asyncio.run(main())
@@ -0,0 +1,229 @@
+import argparse
+import asyncio
+import datetime
+import logging
+import sys
+
+import asyncpg
+import config
+import jst_columns
+
+logger = logging.getLogger("partitions")
+
+JST = datetime.timezone(datetime.timedelta(hours=9))
+MIGRATION_TABLE = "messages_partitioned"
+OLD_TABLE = "messages_unpartitioned"
+BASE_COLUMNS = "message_id, user_id, channel_id, guild_id, created_at, is_bot, char_count"
+
+# messages は created_at の JST の月ごとに分ける。主キーにはパーティションキーを含める必要があるので (message_id, created_at)。
+# 集計は message_rollups から読むので、索引は残りの問い合わせ (直近1時間の差分・ロールアップの再構築) の分だけにする
+def create_messages_sql(table):
+    return f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            message_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            channel_id BIGINT NOT NULL,
+            guild_id BIGINT NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            is_bot BOOLEAN DEFAULT FALSE,
+            char_count INTEGER DEFAULT 0,
+            {jst_columns.GENERATED_COLUMNS_SQL},
+            CONSTRAINT messages_part_pkey PRIMARY KEY (message_id, created_at)
+        ) PARTITION BY RANGE (created_at);
+        CREATE INDEX IF NOT EXISTS idx_messages_part_human_created_channel
+            ON {table} (created_at, channel_id) WHERE is_bot = FALSE;
+        CREATE INDEX IF NOT EXISTS idx_messages_part_human_jst
+            ON {table} (jst_date, jst_hour, channel_id, user_id) INCLUDE (char_count) WHERE is_bot = FALSE;
+    '''
+
+# 移行中に古いテーブルへ入った書き込みを新しいテーブルにも反映する
+MIRROR_SQL = f'''
+    CREATE OR REPLACE FUNCTION mirror_messages_to_partitioned() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('DELETE', 'UPDATE') THEN
+            DELETE FROM {MIGRATION_TABLE} WHERE message_id = OLD.message_id AND created_at = OLD.created_at;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO {MIGRATION_TABLE} ({BASE_COLUMNS})
+            VALUES (NEW.message_id, NEW.user_id, NEW.channel_id, NEW.guild_id, NEW.created_at, NEW.is_bot, NEW.char_count)
+            ON CONFLICT DO NOTHING;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+    DROP TRIGGER IF EXISTS trg_messages_mirror ON messages;
+    CREATE TRIGGER trg_messages_mirror
+        AFTER INSERT OR UPDATE OR DELETE ON messages
+        FOR EACH ROW EXECUTE FUNCTION mirror_messages_to_partitioned();
+'''
+
+# FOR SHARE で写している行への同時の更新・削除を待たせ、トリガーとの順序を保つ
+COPY_SQL = f'''
+    INSERT INTO {MIGRATION_TABLE} ({BASE_COLUMNS})
+    SELECT {BASE_COLUMNS} FROM messages
+    WHERE message_id > $1 AND message_id <= $2
+    FOR SHARE
+    ON CONFLICT DO NOTHING
+'''
+
+SWAP_SQL = f'''
+    SET LOCAL lock_timeout = '5s';
+    LOCK TABLE messages IN ACCESS EXCLUSIVE MODE;
+    DROP TRIGGER trg_messages_mirror ON messages;
+    ALTER TABLE messages RENAME TO {OLD_TABLE};
+    ALTER TABLE {MIGRATION_TABLE} RENAME TO messages;
+    DROP FUNCTION mirror_messages_to_partitioned();
+'''
+
+def month_start(value):
+    value = value.astimezone(JST)
+    return datetime.datetime(value.year, value.month, 1, tzinfo=JST)
+
+def add_months(start, months):
+    index = start.year * 12 + start.month - 1 + months
+    return datetime.datetime(index // 12, index % 12 + 1, 1, tzinfo=JST)
+
+def partition_name(start):
+    return f"messages_p{start:%Y_%m}"
+
+async def is_partitioned(conn, table="messages"):
+    return bool(await conn.fetchval("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass($1)", table))
+
+async def ensure_partitions(conn, months, table="messages"):
+    # 既にあるものは作らない (PARTITION OF は親テーブルを排他ロックするので、毎回 IF NOT EXISTS に頼らない)
+    rows = await conn.fetch(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass($1)",
+        table,
+    )
+    existing = {r["relname"] for r in rows}
+    for start in sorted(set(months)):
+        name = partition_name(start)
+        if name in existing:
+            continue
+        try:
+            await conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{add_months(start, 1).isoformat()}')"
+            )
+        except asyncpg.DuplicateTableError:
+            continue
+        logger.info(f"Created partition {name}")
+
+# 今月から MONTHS_AHEAD か月先までのパーティションを用意する (Logger が定期的に呼ぶ)
+async def ensure_future_partitions(conn, months_ahead=None):
+    if not await is_partitioned(conn):
+        return
+    months_ahead = config.PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    start = month_start(datetime.datetime.now(JST))
+    await ensure_partitions(conn, [add_months(start, i) for i in range(months_ahead + 1)])
+
+# 書き込む前・書き込みが失敗した後に、その月のパーティションを用意する (history_scanner・Logger 用)。
+# 移行中は書き込みがトリガーで写し先にも入るので、そちらにも作る
+async def ensure_partitions_for(conn, created_ats):
+    if not created_ats:
+        return
+    months = {month_start(c) for c in created_ats}
+    for table in ("messages", MIGRATION_TABLE):
+        if await is_partitioned(conn, table):
+            await ensure_partitions(conn, months, table)
+
+# 行の月のパーティションが無くて挿入できなかったか (先の月を作る定期処理が止まっていた・遅れていたとき)
+def is_missing_partition(error):
+    return isinstance(error, asyncpg.CheckViolationError) and "no partition of relation" in str(error)
+
+# messages が無ければパーティション化した形で作る
+async def ensure_messages_table(conn):
+    if await conn.fetchval("SELECT to_regclass('messages')") is None:
+        await conn.execute(create_messages_sql("messages"))
+    await ensure_future_partitions(conn)
+
+async def migrate(pool, batch_size, pause):
+    started = asyncio.get_running_loop().time()
+    async with pool.acquire() as conn:
+        if await is_partitioned(conn):
+            logger.info("messages is already partitioned.")
+            return
+        first, last = await conn.fetchrow("SELECT min(created_at), max(created_at) FROM messages")
+        now = datetime.datetime.now(JST)
+        first = month_start(first or now)
+        last = add_months(month_start(max(last or now, now)), config.PARTITION_MONTHS_AHEAD)
+        months = []
+        while first <= last:
+            months.append(first)
+            first = add_months(first, 1)
+        async with conn.transaction():
+            await conn.execute(create_messages_sql(MIGRATION_TABLE))
+            await ensure_partitions(conn, months, MIGRATION_TABLE)
+            await conn.execute(MIRROR_SQL)
+        logger.info(f"Created {MIGRATION_TABLE} with {len(months)} partitions")
+
+    last_id = 0
+    copied = 0
+    while True:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                upper = await conn.fetchval(
+                    "SELECT max(message_id) FROM (SELECT message_id FROM messages WHERE message_id > $1 ORDER BY message_id LIMIT $2) b",
+                    last_id, batch_size,
+                )
+                if upper is None:
+                    break
+                status = await conn.execute(COPY_SQL, last_id, upper)
+        copied += int(status.split()[-1])
+        last_id = upper
+        logger.info(f"Copied up to message_id {last_id}: {copied} rows")
+        await asyncio.sleep(pause)
+
+    async with pool.acquire() as conn:
+        await conn.execute(f"ANALYZE {MIGRATION_TABLE}")
+        for attempt in range(10):
+            try:
+                async with conn.transaction():
+                    await conn.execute(SWAP_SQL)
+                break
+            except asyncpg.LockNotAvailableError:
+                logger.warning(f"Could not lock messages for the swap, retrying ({attempt + 1}/10)")
+                await asyncio.sleep(1)
+        else:
+            logger.error(f"Gave up swapping. {MIGRATION_TABLE} is kept in sync by the trigger; rerun to retry.")
+            return
+    elapsed = asyncio.get_running_loop().time() - started
+    logger.info(f"Partitioned messages: {copied} rows ({elapsed:.1f}s). The old table is kept as {OLD_TABLE}.")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Manage the monthly partitions of the messages table.")
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="Copy the existing messages table into a partitioned one while it stays writable, then swap them. "
+             "Do not run history_scanner.py at the same time.",
+    )
+    parser.add_argument("--drop-old", action="store_true", help=f"Drop {OLD_TABLE} left behind by --migrate.")
+    parser.add_argument("--batch-size", type=int, default=10_000, help="Rows copied per transaction.")
+    parser.add_argument("--pause", type=float, default=0.05, help="Seconds to sleep between batches.")
+    return parser.parse_args()
+
+async def main():
+    args = parse_args()
+    if not config.DB_DSN:
+        logger.error("DB_DSN is not configured.")
+        return
+
+    pool = await asyncpg.create_pool(config.DB_DSN, command_timeout=None)
+    try:
+        if args.migrate:
+            await migrate(pool, args.batch_size, args.pause)
+        if args.drop_old:
+            await pool.execute(f"DROP TABLE IF EXISTS {OLD_TABLE}")
+            logger.info(f"Dropped {OLD_TABLE}")
+        await ensure_future_partitions(pool)
+    finally:
+        await pool.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+    asyncio.run(main())
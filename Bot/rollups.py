@@ -0,0 +1,235 @@
+import argparse
+import asyncio
+import datetime
+import logging
+import sys
+
+import asyncpg
+import config
+import invalidation
+import jst_columns
+
+logger = logging.getLogger("rollups")
+
+# messages と message_rollups を同時に書き換える処理の排他用 (Logger は共有、バックフィル/再構築は排他)
+ROLLUP_LOCK_ID = 5_349_001
+
+JST = datetime.timezone(datetime.timedelta(hours=9))
+JST_DATE_SQL = jst_columns.JST_DATE_SQL
+JST_HOUR_SQL = jst_columns.JST_HOUR_SQL
+
+CREATE_ROLLUPS_SQL = '''
+    CREATE TABLE IF NOT EXISTS message_rollups (
+        jst_date DATE NOT NULL,
+        hour SMALLINT NOT NULL,
+        channel_id BIGINT NOT NULL,
+        user_id BIGINT NOT NULL,
+        message_count INTEGER NOT NULL DEFAULT 0,
+        char_count BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (jst_date, hour, channel_id, user_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_message_rollups_channel_date ON message_rollups (channel_id, jst_date, hour);
+    CREATE INDEX IF NOT EXISTS idx_message_rollups_user_date ON message_rollups (user_id, jst_date);
+'''
+
+INSERT_ROLLUPS_SQL = "INSERT INTO message_rollups AS r (jst_date, hour, channel_id, user_id, message_count, char_count)"
+
+SELECT_ROLLUPS_SQL = f'''
+    SELECT {JST_DATE_SQL}, {JST_HOUR_SQL}, channel_id, user_id, count(*), COALESCE(sum(char_count), 0)
+    FROM {{source}}
+    WHERE is_bot = FALSE
+    GROUP BY 1, 2, 3, 4
+'''
+
+# 再構築は JST 列で集計する (idx_messages_human_jst の順に読めば並べ替えが要らない)
+# created_at の条件はパーティションを絞るため
+REBUILD_ROLLUPS_SQL = f'''
+    {INSERT_ROLLUPS_SQL}
+    SELECT jst_date, jst_hour, channel_id, user_id, count(*), COALESCE(sum(char_count), 0)
+    FROM messages
+    WHERE is_bot = FALSE AND {{where}}
+    GROUP BY 1, 2, 3, 4
+'''
+
+ADD_ROLLUPS_SQL = f'''
+    {INSERT_ROLLUPS_SQL}
+    {SELECT_ROLLUPS_SQL}
+    ON CONFLICT (jst_date, hour, channel_id, user_id) DO UPDATE
+    SET message_count = r.message_count + EXCLUDED.message_count,
+        char_count = r.char_count + EXCLUDED.char_count
+'''
+
+SUBTRACT_ROLLUPS_SQL = f'''
+    UPDATE message_rollups r
+    SET message_count = r.message_count - d.c,
+        char_count = r.char_count - d.chars
+    FROM (
+        SELECT {JST_DATE_SQL} AS jst_date, {JST_HOUR_SQL} AS hour, channel_id, user_id,
+               count(*) AS c, COALESCE(sum(char_count), 0) AS chars
+        FROM {{source}}
+        WHERE is_bot = FALSE
+        GROUP BY 1, 2, 3, 4
+    ) d
+    WHERE r.jst_date = d.jst_date AND r.hour = d.hour AND r.channel_id = d.channel_id AND r.user_id = d.user_id
+    RETURNING r.jst_date, r.channel_id
+'''
+
+async def ensure_rollup_table(conn):
+    await conn.execute(CREATE_ROLLUPS_SQL)
+
+async def lock_shared(conn):
+    await conn.execute("SELECT pg_advisory_xact_lock_shared($1)", ROLLUP_LOCK_ID)
+
+async def lock_exclusive(conn):
+    await conn.execute("SELECT pg_advisory_xact_lock($1)", ROLLUP_LOCK_ID)
+
+async def prune_empty(conn, rows):
+    dates = sorted({r["jst_date"] for r in rows})
+    if dates:
+        await conn.execute(
+            "DELETE FROM message_rollups WHERE jst_date = ANY($1::date[]) AND message_count <= 0",
+            dates,
+        )
+
+def buckets_of(rows):
+    return {(r["jst_date"].strftime("%Y-%m"), r["channel_id"]) for r in rows}
+
+# messages への挿入とロールアップ加算を1文で行う (lock_shared 済みのトランザクション内で呼ぶ)
+async def insert_message(conn, message_id, user_id, channel_id, guild_id, created_at, is_bot, char_count):
+    inserted = '''
+        inserted AS (
+            INSERT INTO messages (message_id, user_id, channel_id, guild_id, created_at, is_bot, char_count)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
+            ON CONFLICT DO NOTHING
+            RETURNING created_at, channel_id, user_id, char_count, is_bot
+        )
+    '''
+    await conn.execute(
+        f"WITH {inserted} {ADD_ROLLUPS_SQL.format(source='inserted')}",
+        message_id, user_id, channel_id, guild_id, created_at, is_bot, char_count,
+    )
+
+# 削除した分をロールアップから差し引く (lock_shared 済みのトランザクション内で呼ぶ)
+async def delete_messages(conn, message_ids):
+    deleted = '''
+        deleted AS (
+            DELETE FROM messages
+            WHERE message_id = ANY($1::bigint[])
+            RETURNING created_at, channel_id, user_id, char_count, is_bot
+        )
+    '''
+    rows = await conn.fetch(f"WITH {deleted} {SUBTRACT_ROLLUPS_SQL.format(source='deleted')}", list(message_ids))
+    await prune_empty(conn, rows)
+    return buckets_of(rows)
+
+# バックフィル用: 既存行の分を引いてから upsert し、書き込んだ行の分を足し直す (lock_exclusive 済みのトランザクション内で呼ぶ)
+# 戻り値は書き換え前後で触れた (月, チャンネル)
+async def upsert_messages(conn, messages):
+    message_ids = [m[0] for m in messages]
+    existing = "(SELECT * FROM messages WHERE message_id = ANY($1::bigint[])) existing"
+    rows = await conn.fetch(SUBTRACT_ROLLUPS_SQL.format(source=existing), message_ids)
+    # 主キーが (message_id, created_at) のパーティション化したテーブルでも同じに動くよう、消してから入れ直す
+    await conn.execute("DELETE FROM messages WHERE message_id = ANY($1::bigint[])", message_ids)
+    await conn.executemany('''
+        INSERT INTO messages (message_id, user_id, channel_id, guild_id, created_at, is_bot, char_count)
+        VALUES ($1, $2, $3, $4, $5, $6, $7)
+        ON CONFLICT DO NOTHING
+    ''', messages)
+    await conn.execute(ADD_ROLLUPS_SQL.format(source=existing), message_ids)
+    await prune_empty(conn, rows)
+    buckets = buckets_of(rows)
+    buckets.update(invalidation.bucket_of(m[4], m[2]) for m in messages if not m[5])
+    return buckets
+
+def month_ranges(first, last):
+    # first から last までを JST の月ごとの [start, end) に分ける (最初の区間は first から)
+    start = first
+    while start <= last:
+        end = (start.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        yield start, end
+        start = end
+
+# 作り直す JST 日付の範囲。ロールアップにしか残っていない (メッセージが消えた) 日付も含める
+async def rebuild_bounds(conn, since):
+    messages = await conn.fetchrow("SELECT min(created_at) AS first_at, max(created_at) AS last_at FROM messages WHERE is_bot = FALSE")
+    existing = await conn.fetchrow("SELECT min(jst_date) AS first_date, max(jst_date) AS last_date FROM message_rollups")
+    firsts = [d for d in (messages["first_at"] and messages["first_at"].astimezone(JST).date(), existing["first_date"]) if d]
+    lasts = [d for d in (messages["last_at"] and messages["last_at"].astimezone(JST).date(), existing["last_date"]) if d]
+    if not lasts:
+        return None, None
+    return since or min(firsts), max(lasts)
+
+BUCKETS_IN_RANGE_SQL = "SELECT DISTINCT date_trunc('month', jst_date)::date AS jst_date, channel_id FROM message_rollups WHERE jst_date >= $1 AND jst_date < $2"
+
+# JST 日付が [start, end) のロールアップを messages から作り直す (lock_exclusive 済みのトランザクション内で呼ぶ)
+async def rebuild_range(conn, start, end, jst_ready):
+    start_at, end_at = (datetime.datetime.combine(d, datetime.time(), tzinfo=JST) for d in (start, end))
+    # 消える前の (月, チャンネル) も無効化する (全メッセージが消えたチャンネルは作り直した後の行に出てこない)
+    old_rows = await conn.fetch(BUCKETS_IN_RANGE_SQL, start, end)
+    await conn.execute("DELETE FROM message_rollups WHERE jst_date >= $1 AND jst_date < $2", start, end)
+    if jst_ready:
+        where = "jst_date >= $1 AND jst_date < $2 AND created_at >= $3 AND created_at < $4"
+        await conn.execute(REBUILD_ROLLUPS_SQL.format(where=where), start, end, start_at, end_at)
+    else:
+        source = "(SELECT * FROM messages WHERE created_at >= $1 AND created_at < $2) src"
+        await conn.execute(f"{INSERT_ROLLUPS_SQL} {SELECT_ROLLUPS_SQL.format(source=source)}", start_at, end_at)
+    # 作り直した範囲のキャッシュはすべて無効化する
+    new_rows = await conn.fetch(BUCKETS_IN_RANGE_SQL, start, end)
+    await invalidation.publish(conn, buckets_of(old_rows) | buckets_of(new_rows))
+
+# messages からロールアップを作り直す (since 指定時はその JST 日付以降のみ)。
+# 1か月ずつ別のトランザクションで作り直し、排他ロックで Logger の書き込みを待たせるのはその1か月分の間だけにする。
+# 各月はロックを取った時点の messages から作るので、月の合間に書き込みがあっても食い違わない
+async def rebuild(pool, since=None):
+    started = asyncio.get_running_loop().time()
+    async with pool.acquire() as conn:
+        await ensure_rollup_table(conn)
+        await invalidation.ensure_generation_table(conn)
+        jst_ready = await jst_columns.jst_columns_ready(conn)
+        first, last = await rebuild_bounds(conn, since)
+        months = 0
+        for start, end in month_ranges(first, last) if first else ():
+            async with conn.transaction():
+                await lock_exclusive(conn)
+                await rebuild_range(conn, start, end, jst_ready)
+            months += 1
+        count = await conn.fetchval("SELECT count(*) FROM message_rollups")
+    elapsed = asyncio.get_running_loop().time() - started
+    logger.info(f"Rebuilt message_rollups: {count} rows, {months} months ({elapsed:.1f}s)")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Maintain the message_rollups table.")
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Regenerate message_rollups from the messages table.",
+    )
+    parser.add_argument(
+        "--since",
+        help="Only rebuild rollups from this JST date. Example: 2026-05-01",
+    )
+    return parser.parse_args()
+
+async def main():
+    args = parse_args()
+    if not args.rebuild:
+        logger.error("Nothing to do. Use --rebuild.")
+        return
+    if not config.DB_DSN:
+        logger.error("DB_DSN is not configured.")
+        return
+
+    since = datetime.date.fromisoformat(args.since) if args.since else None
+    pool = await asyncpg.create_pool(config.DB_DSN, command_timeout=None)
+    try:
+        await rebuild(pool, since)
+    finally:
+        await pool.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+    asyncio.run(main())
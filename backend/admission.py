@@ -0,0 +1,65 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict
+
+class Overloaded(Exception):
+    # 待ち行列が溢れた・待ちきれなかったときに投げる (API では 503 にする)
+    def __init__(self, name: str):
+        super().__init__(f"{name} queries are overloaded")
+        self.name = name
+
+class QueryClass:
+    # 重い集計と軽い参照で同時実行数を分ける。空きが無いときは queue_size 件まで、queue_timeout 秒だけ待たせ、
+    # それを超えたら DB に投げずにすぐ断る (重い集計が接続を使い切って軽い参照まで詰まらないように)
+    def __init__(self, name: str, concurrency: int, queue_size: int, queue_timeout: float):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def check(self) -> None:
+        # 待たずに判定だけする (応答を返し始める前に断りたいストリーミング用)
+        if self.semaphore.locked() and self.waiting >= self.queue_size:
+            self.rejected += 1
+            raise Overloaded(self.name)
+
+    @asynccontextmanager
+    async def slot(self):
+        self.check()
+        self.waiting += 1
+        try:
+            # wait_for は 3.11 だと、取れたのと同時に期限が来ると枠を返さないまま TimeoutError にすることがある。
+            # timeout はこのタスクの中で acquire を取り消すので、取れた後に取り消されても acquire が枠を戻す
+            async with asyncio.timeout(self.queue_timeout):
+                await self.semaphore.acquire()
+        except TimeoutError:
+            self.rejected += 1
+            raise Overloaded(self.name) from None
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self.semaphore.release()
+
+    async def run(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        async with self.slot():
+            return await fn()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "concurrency": self.concurrency,
+            "queue_size": self.queue_size,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
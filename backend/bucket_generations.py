@@ -0,0 +1,38 @@
+from collections import defaultdict
+from typing import Dict, Iterable, Optional, Tuple
+
+class BucketGenerations:
+    # Bot が NOTIFY する (月, チャンネル) ごとの世代番号。
+    # 世代は増える一方なので、月別・チャンネル別・全体の世代はその合計で表す
+    def __init__(self):
+        self.buckets: Dict[Tuple[str, int], int] = {}
+        self.months: Dict[str, int] = defaultdict(int)
+        self.channels: Dict[int, Dict[str, int]] = defaultdict(dict)
+        self.channel_totals: Dict[int, int] = defaultdict(int)
+        self.total = 0
+
+    def apply(self, month: str, channel_id: int, generation: int) -> bool:
+        current = self.buckets.get((month, channel_id), 0)
+        if generation <= current:
+            return False
+        self.buckets[(month, channel_id)] = generation
+        self.channels[channel_id][month] = generation
+        self.months[month] += generation - current
+        self.channel_totals[channel_id] += generation - current
+        self.total += generation - current
+        return True
+
+    def month(self, month: str, channel_ids: Optional[Iterable[int]] = None) -> int:
+        if channel_ids is None:
+            return self.months.get(month, 0)
+        return sum(self.buckets.get((month, c), 0) for c in channel_ids)
+
+    def until(self, month: Optional[str], channel_ids: Optional[Iterable[int]] = None) -> int:
+        # month 以前 (None なら全期間) の世代
+        if channel_ids is None:
+            if month is None:
+                return self.total
+            return sum(g for m, g in self.months.items() if m <= month)
+        if month is None:
+            return sum(self.channel_totals.get(c, 0) for c in channel_ids)
+        return sum(g for c in channel_ids for m, g in self.channels.get(c, {}).items() if m <= month)
@@ -0,0 +1,40 @@
+from collections import defaultdict
+from typing import Dict, Iterable, List, Sequence
+
+UNCATEGORIZED_NAME = "未分類"
+THREAD_SEPARATOR = " / "
+
+class ChannelIndex:
+    # channels テーブルのスナップショット。スレッドは "親 / スレッド" という名前で保存されているので、
+    # 名前の " / " の位置ごとに親の名前 → 子チャンネルを引けるようにしておく。
+    # プラチャ総合 (カテゴリ単位の集合) も読み込み時に求めておく
+    def __init__(self, rows: Iterable, private_category_ids: Sequence[int]):
+        self.names: Dict[int, str] = {}
+        self.children: Dict[str, List[int]] = defaultdict(list)
+        private_categories = set(private_category_ids)
+        self.private_chat_ids: List[int] = []
+
+        for r in rows:
+            channel_id = r["channel_id"]
+            name = r["name"]
+            self.names[channel_id] = name
+            index = name.find(THREAD_SEPARATOR)
+            while index >= 0:
+                self.children[name[:index]].append(channel_id)
+                index = name.find(THREAD_SEPARATOR, index + 1)
+
+            if not r["is_active"]:
+                continue
+            category_id = r["category_id"]
+            if category_id is None:
+                if r["category_name"] == UNCATEGORIZED_NAME:
+                    self.private_chat_ids.append(channel_id)
+            elif category_id not in private_categories:
+                self.private_chat_ids.append(channel_id)
+
+    def scope(self, channel_id: int) -> List[int]:
+        # 指定チャンネルとその配下のスレッド
+        name = self.names.get(channel_id)
+        if name is None:
+            return [channel_id]
+        return [channel_id] + [c for c in self.children.get(name, ()) if c != channel_id]
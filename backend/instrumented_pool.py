@@ -0,0 +1,52 @@
+import contextvars
+import time
+from typing import Any, Optional
+
+from metrics import Histogram
+from slow_query_log import SlowQueryLog
+
+# クエリを投げたのがどの集計か (キャッシュキーの種類)。集計のタスクの中で設定し、gather で作られる子タスクにも引き継がれる
+query_source: contextvars.ContextVar[str] = contextvars.ContextVar("query_source", default="other")
+
+class InstrumentedPool:
+    # asyncpg.Pool の fetch 系を、接続の取得待ちとクエリの実行時間を測りながら同じように呼ぶ。
+    # slow_log の閾値を超えたクエリ (取り消し・エラーになったものも) はそこに記録する。
+    # ここに無いメソッド (acquire・close など) はそのまま元のプールに渡す
+    def __init__(self, pool, acquire_wait: Histogram, query_duration: Histogram, slow_log: Optional[SlowQueryLog] = None):
+        self.pool = pool
+        self.acquire_wait = acquire_wait
+        self.query_duration = query_duration
+        self.slow_log = slow_log
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.pool, name)
+
+    async def _run(self, method: str, query: str, args: tuple, kwargs: dict) -> Any:
+        started = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            acquired = time.perf_counter()
+            self.acquire_wait.observe(acquired - started)
+            error = None
+            try:
+                return await getattr(conn, method)(query, *args, **kwargs)
+            except BaseException as e:
+                error = type(e).__name__
+                raise
+            finally:
+                elapsed = time.perf_counter() - acquired
+                source = query_source.get()
+                self.query_duration.observe(elapsed, source, method)
+                if self.slow_log and elapsed >= self.slow_log.threshold:
+                    self.slow_log.record(self.pool, method, query, args, elapsed, source, error)
+
+    async def fetch(self, query: str, *args, **kwargs):
+        return await self._run("fetch", query, args, kwargs)
+
+    async def fetchrow(self, query: str, *args, **kwargs):
+        return await self._run("fetchrow", query, args, kwargs)
+
+    async def fetchval(self, query: str, *args, **kwargs):
+        return await self._run("fetchval", query, args, kwargs)
+
+    async def execute(self, query: str, *args, **kwargs):
+        return await self._run("execute", query, args, kwargs)
@@ -1,6 +1,6 @@
 from fastapi import FastAPI, HTTPException, Response, Query, Request
-from fastapi.responses import JSONResponse, PlainTextResponse
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.datastructures import MutableHeaders
 import asyncpg
 import aiohttp
 import os
@@ -9,12 +9,29 @@ import asyncio
 import time
 import diskcache
 import tempfile
+import json
+import base64
+import math
+from memory_cache import MemoryCache, SingleFlight, MISS, estimate_size
+from bucket_generations import BucketGenerations
+from channel_index import ChannelIndex
+from rank_table import RankTable
+from user_index import UserIndex
+from admission import QueryClass, Overloaded
+from metrics import Registry, LATENCY_BUCKETS
+from instrumented_pool import InstrumentedPool, query_source
+from slow_query_log import SlowQueryLog
+from snapshot_store import SnapshotStore
+from response_body import EncodedBody, encode_body, encoded_response
+from rate_limit import MemoryRateLimiter, SharedRateLimiter
 from dotenv import load_dotenv
 from pydantic import BaseModel
-from typing import List, Optional, Any, Tuple
+from typing import Dict, List, Optional, Any, Tuple
+from urllib.parse import urlparse
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, date, timedelta, timezone
 import socket
+import re
 import logging
 
 logging.basicConfig(
@@ -121,71 +138,321 @@ PRIVATE_CHAT_CATEGORY_IDS = [
 BOTTOM_CHANNEL_CATEGORY_IDS = {1355760969187463378}
 
 pool = None
-cache_dir = os.path.join(tempfile.gettempdir(), "ymkw_api_diskcache_v14")
-cache = diskcache.Cache(cache_dir)
+cache_dir = os.path.join(tempfile.gettempdir(), "ymkw_api_diskcache_v17")
+cache = diskcache.Cache(cache_dir, size_limit=int(os.getenv("DISK_CACHE_MAX_BYTES", str(1024 * 1024 * 1024))))
+
+# diskcache の手前に置くプロセス内キャッシュ (L1)
+L1_CACHE_MAX_BYTES = int(os.getenv("L1_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+L1_CACHE_MAX_ITEM_BYTES = int(os.getenv("L1_CACHE_MAX_ITEM_BYTES", str(4 * 1024 * 1024)))
+l1_cache = MemoryCache(L1_CACHE_MAX_BYTES, L1_CACHE_MAX_ITEM_BYTES)
+# 待っているリクエストが全部切断してから取り消すまでの猶予 (フロントの再試行がそのまま合流できるように)
+FILL_CANCEL_GRACE = float(os.getenv("FILL_CANCEL_GRACE", "3"))
+cache_fills = SingleFlight(FILL_CANCEL_GRACE)
+
+# 集計1回の締め切り (秒)。キャッシュキーの先頭 (エンドポイントの種類) ごとに決め、過ぎたら取り消して 504 を返す。
+# プールの command_timeout (60秒) より短くして、使われない結果のために接続を握り続けないようにする
+QUERY_DEADLINES = {"channels": 10, "rank": 20, "hist": 30, "heat": 20, "pie": 20, "ana": 20, "dash": 45}
+QUERY_DEADLINE_DEFAULT = 30
+cancellation_stats = {"client_disconnects": 0, "deadlines_exceeded": 0}
+
+# ユーザー順位・ランキングのページ用の順位表 (期間・チャンネル範囲ごとに1つ)。diskcache にも保存して再起動後も使い回す
+RANK_TABLE_CACHE_MAX_BYTES = int(os.getenv("RANK_TABLE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+rank_tables = MemoryCache(RANK_TABLE_CACHE_MAX_BYTES, RANK_TABLE_CACHE_MAX_BYTES)
+
+# ttl を過ぎてから更に CACHE_STALE_TTL 秒は古い値を返しつつ裏で再集計する
+CACHE_STALE_TTL = int(os.getenv("CACHE_STALE_TTL", "3600"))
+
+# Bot が書き込んだ (月, チャンネル) を NOTIFY してくるので、世代が変わったエントリは stale 扱いにする
+BUCKET_CHANNEL = "ymkw_message_buckets"
+generations = BucketGenerations()
+
+# チャンネルの親子関係・プラチャ総合の範囲はメモリ上の索引で引き、channels が変わったら NOTIFY で読み直す
+CHANNELS_CHANNEL = "ymkw_channels"
+channel_index: Optional[ChannelIndex] = None
+
+# 集計から除く (削除済みの) ユーザー。users.is_excluded は Bot が保守し、変わったら NOTIFY で読み直す
+USERS_CHANNEL = "ymkw_users"
+excluded_user_ids: List[int] = []
+user_index: Optional[UserIndex] = None
+USER_SEARCH_LIMIT = 10
+USER_SEARCH_MAX_LIMIT = 50
+
+# 締まった月は世代が変わらない限り再集計しない
+CLOSED_MONTH_CACHE_TTL = int(os.getenv("CLOSED_MONTH_CACHE_TTL", str(30 * 86400)))
+CLOSED_MONTH_MAX_AGE = 86400
+
+# 締まった月・過去の end_date の応答は期限なしでディスクに残す (キャッシュの版を上げても消えない)。
+# 取り得る値が限られるキー (is_snapshot_month / is_snapshot_end_date) だけで、それ以外は diskcache に入れる
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshots"))
+snapshots = SnapshotStore(SNAPSHOT_DIR)
+# どの ref からも指されなくなったボディは、書かれてからこの秒数を過ぎたら消す
+SNAPSHOT_PRUNE_GRACE = int(os.getenv("SNAPSHOT_PRUNE_GRACE", "3600"))
+# 集計元にある最初の月 (これより前の月はスナップショットにしない)
+first_data_month: Optional[date] = None
+MONTH_CLOSE_INTERVAL = int(os.getenv("MONTH_CLOSE_INTERVAL", "3600"))
+
+# 集計 (キャッシュミス時の fill・順位表・エクスポート) と軽い参照で同時実行数を分ける。
+# 重い方の上限は接続プール (最大50) に軽い参照の分が残るように決める (ダッシュボードの fill は1本で6接続ほど使う)
+heavy_queries = QueryClass(
+    "heavy",
+    int(os.getenv("HEAVY_QUERY_CONCURRENCY", "6")),
+    int(os.getenv("HEAVY_QUERY_QUEUE_SIZE", "50")),
+    float(os.getenv("HEAVY_QUERY_QUEUE_TIMEOUT", "10")),
+)
+light_queries = QueryClass(
+    "light",
+    int(os.getenv("LIGHT_QUERY_CONCURRENCY", "10")),
+    int(os.getenv("LIGHT_QUERY_QUEUE_SIZE", "200")),
+    float(os.getenv("LIGHT_QUERY_QUEUE_TIMEOUT", "5")),
+)
+OVERLOADED_RETRY_AFTER = 5
+
+# /metrics (Prometheus のテキスト形式)。記録はプロセス内の dict の加算だけ
+metrics = Registry()
+http_request_duration = metrics.histogram("ymkw_http_request_duration_seconds", "Request latency by route.", ("route", "method", "status"))
+http_requests_rejected = metrics.counter("ymkw_http_requests_rejected_total", "Requests rejected by the security middleware.", ("reason",))
+rate_limit_blocks = metrics.counter("ymkw_rate_limit_blocks_total", "Clients blocked by the rate limiter.", ("reason",))
+cache_requests = metrics.counter("ymkw_cache_requests_total", "Cache lookups by key prefix (hit, stale or miss).", ("prefix", "result"))
+cache_fill_duration = metrics.histogram("ymkw_cache_fill_duration_seconds", "Time to fill a cache entry, by key prefix.", ("prefix",))
+db_acquire_wait = metrics.histogram("ymkw_db_pool_acquire_wait_seconds", "Time spent waiting for a pool connection.")
+db_query_duration = metrics.histogram("ymkw_db_query_duration_seconds", "Query duration by source (cache key prefix) and method.", ("source", "method"))
+warmer_duration = metrics.histogram("ymkw_warmer_duration_seconds", "Cache warmer run time.", ("warmer",), LATENCY_BUCKETS + (120.0, 300.0))
+warmer_failures = metrics.counter("ymkw_warmer_failures_total", "Cache warmer failures.", ("warmer",))
+metrics.gauge("ymkw_db_pool_connections", "asyncpg pool connections by state.", ("state",), lambda: [
+    (("size",), pool.get_size()), (("idle",), pool.get_idle_size()), (("in_use",), pool.get_size() - pool.get_idle_size()), (("max",), pool.get_max_size()),
+] if pool else [])
+metrics.gauge("ymkw_query_class", "Admission control: running and queued fills per query class.", ("class", "state"), lambda: [
+    ((q.name, state), q.stats()[state]) for q in (heavy_queries, light_queries) for state in ("active", "waiting", "concurrency", "queue_size")
+])
+metrics.gauge("ymkw_query_class_total", "Admission control: admitted and rejected fills per query class.", ("class", "result"), lambda: [
+    ((q.name, result), q.stats()[result]) for q in (heavy_queries, light_queries) for result in ("admitted", "rejected")
+], type="counter")
+metrics.gauge("ymkw_cancellations_total", "Requests and fills cancelled by disconnects and deadlines.", ("reason",), lambda: [
+    (("client_disconnect",), cancellation_stats["client_disconnects"]),
+    (("deadline_exceeded",), cancellation_stats["deadlines_exceeded"]),
+    (("fill_abandoned",), cache_fills.cancelled),
+], type="counter")
+metrics.gauge("ymkw_cancelled_fill_seconds_total", "Time already spent by fills that were cancelled.", (), lambda: [((), cache_fills.cancelled_seconds)], type="counter")
+
+# 閾値を超えたクエリを SQL・引数・実行計画つきで残す (/debug/slow-queries)
+slow_queries = SlowQueryLog(
+    float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "500")) / 1000,
+    int(os.getenv("SLOW_QUERY_LOG_SIZE", "100")),
+    float(os.getenv("SLOW_QUERY_EXPLAIN_COOLDOWN", "600")),
+    float(os.getenv("SLOW_QUERY_EXPLAIN_TIMEOUT", "60")),
+)
 
-def get_cache(key: str):
-    return cache.get(key)
+def cache_prefix(key: str) -> str:
+    # "rank_m_2025_6_None" → "rank_m"、"rank_table:m_2025_6_None" → "rank_table"
+    if ":" in key:
+        return key.split(":", 1)[0]
+    return "_".join(key.split("_", 2)[:2])
+
+def cache_control(ttl: int, stale_ttl: int = CACHE_STALE_TTL) -> str:
+    return f"public, max-age={ttl}, stale-while-revalidate={stale_ttl}"
+
+def get_cache_entry(key: str) -> Optional[Tuple[Any, float, Optional[int]]]:
+    entry = l1_cache.get(key)
+    if entry is not MISS:
+        return entry
+    entry, expire_at = cache.get(key, expire_time=True)
+    if entry is not None:
+        l1_cache.set(key, entry, expire_at)
+    return entry
+
+async def set_cache(key: str, data: Any, ttl: int = 600, stale_ttl: int = CACHE_STALE_TTL, generation: Optional[int] = None, snapshot: bool = False) -> EncodedBody:
+    # 直列化・圧縮済みのボディを保存し、ヒット時はそのまま返す (大きい応答の圧縮でループを止めないよう別スレッドで行う)
+    encoded = await asyncio.to_thread(encode_body, data)
+    now = time.time()
+    if snapshot:
+        # スナップショットは世代が変わるまで fresh のまま
+        entry = (encoded, math.inf, generation)
+        await asyncio.to_thread(snapshots.put, key, encoded, generation)
+        l1_cache.set(key, entry, now + CLOSED_MONTH_CACHE_TTL, estimate_size(entry))
+        return encoded
+    entry = (encoded, now + ttl, generation)
+    cache.set(key, entry, expire=ttl + stale_ttl)
+    l1_cache.set(key, entry, now + ttl + stale_ttl, estimate_size(entry))
+    return encoded
+
+async def load_snapshot(key: str) -> Optional[Tuple[EncodedBody, float, Optional[int]]]:
+    stored = await asyncio.to_thread(snapshots.get, key)
+    if stored is None:
+        return None
+    encoded, generation = stored
+    entry = (encoded, math.inf, generation)
+    l1_cache.set(key, entry, time.time() + CLOSED_MONTH_CACHE_TTL, estimate_size(entry))
+    return entry
 
-def set_cache(key: str, data: Any, ttl: int = 600):
-    cache.set(key, data, expire=ttl)
+async def refresh_cache(key: str, fill):
+    try:
+        return await fill()
+    except Overloaded:
+        # 混んでいるときは古い値を返し続け、次のアクセスでまた再集計を試みる
+        logger.info(f"Skipped background cache refresh (overloaded): {key}")
+    except Exception:
+        logger.warning(f"Background cache refresh failed: {key}", exc_info=True)
+
+def query_deadline(key: str) -> float:
+    return QUERY_DEADLINES.get(key.split("_", 1)[0], QUERY_DEADLINE_DEFAULT)
+
+async def run_with_deadline(key: str, fill):
+    # 締め切りを過ぎたら集計のタスクを取り消す (asyncpg が実行中のクエリもキャンセルする)
+    try:
+        return await asyncio.wait_for(fill(), query_deadline(key))
+    except asyncio.TimeoutError:
+        cancellation_stats["deadlines_exceeded"] += 1
+        raise HTTPException(status_code=504, detail="Query deadline exceeded") from None
+
+async def timed_fill(key: str, fill):
+    # 集計のタスクの中で呼ぶ。ここから投げたクエリはキーの種類ごとに計測される
+    prefix = cache_prefix(key)
+    query_source.set(prefix)
+    started = time.perf_counter()
+    try:
+        return await run_with_deadline(key, fill)
+    finally:
+        cache_fill_duration.observe(time.perf_counter() - started, prefix)
+
+async def get_or_fill_cache(key: str, fill, generation: Optional[int] = None, snapshot: bool = False, query_class: QueryClass = heavy_queries):
+    # ミス時の集計は同じキーにつき1本だけ走らせ、同時に来たリクエストはその結果を待つ。
+    # 期限切れ・世代違い (stale) の値はそのまま返し、再集計を1本だけ裏で走らせる。
+    # 集計は query_class の枠を取ってから走らせ、混んでいれば裏の再集計は諦めて stale を返し続ける (値が無ければ 503)
+    admitted_fill = lambda: query_class.run(lambda: timed_fill(key, fill))
+    if snapshot:
+        # スナップショット対象は diskcache を使わず、L1 → スナップショットの順に引く
+        entry = l1_cache.get(key)
+        entry = await load_snapshot(key) if entry is MISS else entry
+    else:
+        entry = get_cache_entry(key)
+    if entry is not None:
+        data, fresh_until, entry_generation = entry
+        if fresh_until <= time.time() or entry_generation != generation:
+            cache_requests.inc(cache_prefix(key), "stale")
+            cache_fills.start(key, lambda: refresh_cache(key, admitted_fill))
+        else:
+            cache_requests.inc(cache_prefix(key), "hit")
+        return data
+    cache_requests.inc(cache_prefix(key), "miss")
+    return await cache_fills.run(key, admitted_fill)
+
+# CORS で Origin をそのまま返すオリジン (ALLOWED_ORIGINS に加えて)
+CORS_ORIGIN_REGEX = re.compile(r"https://.*\.ymkw\.top|https://.*\.pages\.dev")
+CORS_ALLOW_METHODS = "DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT, QUERY"
+CORS_SIMPLE_HEADERS = {"Access-Control-Allow-Credentials": "true", "Access-Control-Expose-Headers": "X-Debug-Block, X-Next-Cursor, X-Total-Count"}
+CORS_PREFLIGHT_VARY = "Origin, Access-Control-Request-Method, Access-Control-Request-Headers, Access-Control-Request-Private-Network"
+FALLBACK_ORIGIN = "https://www.ymkw.top"
+
+# Origin / Referer ごとの判定結果。値の種類は少ないので溢れたら作り直すだけにする
+ORIGIN_DECISION_CACHE_SIZE = 4096
+origin_decisions: Dict[str, Tuple[bool, bool]] = {}
+referer_decisions: Dict[str, Tuple[Optional[str], bool]] = {}
 
 def is_domain_allowed(domain: Optional[str]) -> bool:
     if not domain:
         return False
     return domain in ALLOWED_DOMAINS or domain.endswith(".ymkw.top") or domain.endswith(".pages.dev")
 
-def get_cors_origin(request: Request) -> Optional[str]:
-    origin = request.headers.get("origin")
-    if not origin:
-        referer = request.headers.get("referer")
-        if referer:
+def get_origin_decision(origin: str) -> Tuple[bool, bool]:
+    # (サイトからのアクセスとして認めるか, CORS で Origin を返すか)
+    decision = origin_decisions.get(origin)
+    if decision is None:
+        clean_origin = origin.rstrip('/')
+        is_site = clean_origin in ALLOWED_ORIGINS
+        if not is_site:
             try:
-                from urllib.parse import urlparse
-                parsed = urlparse(referer)
-                clean_ref = f"{parsed.scheme}://{parsed.hostname}"
-                if parsed.port:
-                    clean_ref += f":{parsed.port}"
-                if clean_ref in ALLOWED_ORIGINS or is_domain_allowed(parsed.hostname):
-                    return clean_ref
-            except:
+                is_site = is_domain_allowed(urlparse(clean_origin).hostname)
+            except ValueError:
                 pass
-        return None
-    
-    clean_origin = origin.rstrip('/')
-    if clean_origin in ALLOWED_ORIGINS:
-        return origin
-    
-    try:
-        from urllib.parse import urlparse
-        parsed = urlparse(clean_origin)
-        if is_domain_allowed(parsed.hostname):
-            return origin
-    except:
-        pass
-    return None
-
-def cors_json_response(request: Request, status_code: int, content: dict, block_reason: Optional[str] = None):
-    response = JSONResponse(status_code=status_code, content=content)
-    origin = get_cors_origin(request)
-    
-    if not origin and (is_domain_allowed(request.headers.get("host")) or not request.headers.get("origin")):
-        origin = "https://www.ymkw.top"
-
+        decision = (is_site, origin in ALLOWED_ORIGINS or CORS_ORIGIN_REGEX.fullmatch(origin) is not None)
+        if len(origin_decisions) >= ORIGIN_DECISION_CACHE_SIZE:
+            origin_decisions.clear()
+        origin_decisions[origin] = decision
+    return decision
+
+def get_referer_decision(referer: str) -> Tuple[Optional[str], bool]:
+    # (Referer から求めたオリジン (許可されている場合のみ), ドメインが許可されているか)
+    # パス以降は判定に関係ないので、スキーム・ホスト部分だけをキーにする
+    scheme_end = referer.find("://")
+    key = referer
+    if scheme_end >= 0:
+        for i in range(scheme_end + 3, len(referer)):
+            if referer[i] in "/?#":
+                key = referer[:i]
+                break
+    decision = referer_decisions.get(key)
+    if decision is None:
+        cors_origin = None
+        is_allowed = False
+        try:
+            parsed = urlparse(key)
+            is_allowed = is_domain_allowed(parsed.hostname)
+            clean_ref = f"{parsed.scheme}://{parsed.hostname}"
+            if parsed.port:
+                clean_ref += f":{parsed.port}"
+            if clean_ref in ALLOWED_ORIGINS or is_allowed:
+                cors_origin = clean_ref
+        except ValueError:
+            pass
+        decision = (cors_origin, is_allowed)
+        if len(referer_decisions) >= ORIGIN_DECISION_CACHE_SIZE:
+            referer_decisions.clear()
+        referer_decisions[key] = decision
+    return decision
+
+def cors_json_response(headers: Dict[str, str], status_code: int, content: dict, block_reason: Optional[str] = None) -> JSONResponse:
+    origin = headers.get("origin")
+    referer = headers.get("referer")
     if origin:
-        response.headers["Access-Control-Allow-Origin"] = origin
-        response.headers["Access-Control-Allow-Credentials"] = "true"
-        response.headers["Access-Control-Allow-Methods"] = "*"
-        response.headers["Access-Control-Allow-Headers"] = "*"
-    
-    response.headers["Vary"] = "Origin"
+        cors_origin = origin if get_origin_decision(origin)[0] else None
+    else:
+        cors_origin = get_referer_decision(referer)[0] if referer else None
+    if not cors_origin and (is_domain_allowed(headers.get("host")) or not origin):
+        cors_origin = FALLBACK_ORIGIN
+
+    response_headers = {}
+    if cors_origin:
+        response_headers["Access-Control-Allow-Origin"] = cors_origin
+        response_headers["Access-Control-Allow-Credentials"] = "true"
+        response_headers["Access-Control-Allow-Methods"] = "*"
+        response_headers["Access-Control-Allow-Headers"] = "*"
+    if origin is not None:
+        response_headers.update(CORS_SIMPLE_HEADERS)
+        if get_origin_decision(origin)[1]:
+            response_headers["Access-Control-Allow-Origin"] = origin
+    response_headers["Vary"] = "Origin"
     if block_reason:
-        response.headers["X-Debug-Block"] = block_reason
-    return response
+        response_headers["X-Debug-Block"] = block_reason
+    return JSONResponse(status_code=status_code, content=content, headers=response_headers)
+
+def cors_preflight_response(headers: Dict[str, str], origin: str) -> PlainTextResponse:
+    response_headers = {
+        "Vary": CORS_PREFLIGHT_VARY,
+        "Access-Control-Allow-Methods": CORS_ALLOW_METHODS,
+        "Access-Control-Max-Age": "600",
+        "Access-Control-Allow-Credentials": "true",
+    }
+    failures = []
+    if get_origin_decision(origin)[1]:
+        response_headers["Access-Control-Allow-Origin"] = origin
+    else:
+        failures.append("origin")
+    if headers["access-control-request-method"] not in CORS_ALLOW_METHODS.split(", "):
+        failures.append("method")
+    requested_headers = headers.get("access-control-request-headers")
+    if requested_headers is not None:
+        response_headers["Access-Control-Allow-Headers"] = requested_headers
+    if "access-control-request-private-network" in headers:
+        failures.append("private-network")
+    if failures:
+        return PlainTextResponse("Disallowed CORS " + ", ".join(failures), status_code=400, headers=response_headers)
+    return PlainTextResponse("OK", status_code=200, headers=response_headers)
 
 PUBLIC_PATHS = {"/", "/health", "/docs", "/openapi.json", "/favicon.ico"}
 WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
-DB_HEAVY_PREFIXES = ("/ranking", "/stats", "/users")
+DB_HEAVY_PREFIXES = ("/ranking", "/stats", "/users", "/dashboard", "/export")
+# メモリ上の索引で答えるので DB 用の制限は掛けない
+DB_LIGHT_PATHS = {"/users/search"}
 
 RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", "10"))
 MAX_REQUESTS = int(os.getenv("RATE_LIMIT_MAX_REQUESTS", "180"))
@@ -194,96 +461,335 @@ DB_RATE_LIMIT_WINDOW = int(os.getenv("DB_RATE_LIMIT_WINDOW", "60"))
 DB_MAX_REQUESTS = int(os.getenv("DB_RATE_LIMIT_MAX_REQUESTS", "135"))
 DB_BOT_MAX_REQUESTS = int(os.getenv("DB_RATE_LIMIT_BOT_MAX_REQUESTS", "540"))
 BLOCK_DURATION = int(os.getenv("RATE_LIMIT_BLOCK_DURATION", "600"))
+# レート制限とブロックはレスポンスキャッシュとは別に持つ (clear-cache で消えないように)。
+# 複数ワーカーで共有するときは RATE_LIMIT_BACKEND=shared
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_SWEEP_INTERVAL = 1
+# shared のとき、数えた分を共有の diskcache に書き出す間隔と、共有側の期限切れを消す間隔
+RATE_LIMIT_SYNC_INTERVAL = float(os.getenv("RATE_LIMIT_SYNC_INTERVAL", "0.5"))
+RATE_LIMIT_EXPIRE_INTERVAL = 300
+if RATE_LIMIT_BACKEND == "shared":
+    rate_limiter = SharedRateLimiter(os.getenv("RATE_LIMIT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ymkw_api_ratelimit")))
+else:
+    rate_limiter = MemoryRateLimiter()
 LIVE_TOTAL_CACHE_TTL = 1800
 TOTAL_CACHE_WARM_INTERVAL = 600
 
-def get_client_ip(request: Request) -> str:
-    forwarded_for = request.headers.get("X-Forwarded-For", "").split(",", 1)[0].strip()
+def get_client_ip(headers: Dict[str, str], scope: dict) -> str:
+    forwarded_for = headers.get("x-forwarded-for", "").split(",", 1)[0].strip()
+    client = scope.get("client")
     return (
-        request.headers.get("CF-Connecting-IP")
+        headers.get("cf-connecting-ip")
         or forwarded_for
-        or (request.client.host if request.client else "unknown")
+        or (client[0] if client else "unknown")
     )
 
 def is_db_heavy_path(path: str) -> bool:
-    return path.startswith(DB_HEAVY_PREFIXES)
+    return path.startswith(DB_HEAVY_PREFIXES) and path not in DB_LIGHT_PATHS
 
-def rate_limit_check(client_ip: str, scope: str, limit: int, window: int) -> bool:
-    count_key = f"rate_limit:{scope}:{client_ip}"
-    current_data = cache.get(count_key)
-    now = time.time()
+async def rate_limit_sweep_loop():
+    while True:
+        await asyncio.sleep(RATE_LIMIT_SWEEP_INTERVAL)
+        try:
+            rate_limiter.sweep()
+        except Exception:
+            logger.warning("Rate limit sweep failed", exc_info=True)
 
-    if current_data:
-        first_req_time, count = current_data
-        if now - first_req_time < window:
-            new_count = count + 1
-            if new_count > limit:
-                return False
-            ttl = max(1, window - (now - first_req_time))
-            cache.set(count_key, (first_req_time, new_count), expire=ttl)
-            return True
-
-    cache.set(count_key, (now, 1), expire=window)
-    return True
-
-@app.middleware("http")
-async def security_and_rate_limit_middleware(request: Request, call_next):
-    if request.method == "OPTIONS":
-        return await call_next(request)
-
-    client_api_key = request.headers.get("X-API-KEY")
-    is_bot = client_api_key == API_SECRET
-
-    origin = request.headers.get("origin")
-    referer = request.headers.get("referer")
-    
-    is_allowed_origin = bool(get_cors_origin(request))
-    is_allowed_referer = False
-    if referer:
+async def rate_limit_sync_loop():
+    # RATE_LIMIT_BACKEND=shared のときだけ動かす。SQLite を触るのは sync と expire の中の別スレッドだけ
+    last_expire = time.monotonic()
+    while True:
+        await asyncio.sleep(RATE_LIMIT_SYNC_INTERVAL)
         try:
-            from urllib.parse import urlparse
-            ref_domain = urlparse(referer).hostname
-            if is_domain_allowed(ref_domain):
-                is_allowed_referer = True
-        except:
-            pass
-    
-    path = request.url.path
+            await rate_limiter.sync()
+            if time.monotonic() - last_expire >= RATE_LIMIT_EXPIRE_INTERVAL:
+                last_expire = time.monotonic()
+                await asyncio.to_thread(rate_limiter.expire)
+        except Exception:
+            logger.warning("Rate limit sync failed", exc_info=True)
+
+def check_request(scope: dict, headers: Dict[str, str]) -> Optional[Tuple[int, dict, str]]:
+    # 拒否する場合は (ステータス, 本文, 理由) を返す
+    is_bot = headers.get("x-api-key") == API_SECRET
+
+    origin = headers.get("origin")
+    referer = headers.get("referer")
+    referer_decision = get_referer_decision(referer) if referer else (None, False)
+    if origin:
+        is_allowed_origin = get_origin_decision(origin)[0]
+    else:
+        is_allowed_origin = referer_decision[0] is not None
+    is_allowed_referer = referer_decision[1]
+
+    path = scope["path"]
     is_public_path = path in PUBLIC_PATHS
     is_website = is_allowed_origin or is_allowed_referer
 
-    if request.method in WRITE_METHODS and not is_bot and not is_public_path:
-        return cors_json_response(request, status_code=401, content={"detail": "API key required."}, block_reason="write-api-key-required")
+    if scope["method"] in WRITE_METHODS and not is_bot and not is_public_path:
+        return 401, {"detail": "API key required."}, "write-api-key-required"
 
     if not (is_bot or is_website or is_public_path):
-        if path not in PUBLIC_PATHS:
-            logger.warning(f"Access Denied: Origin={origin}, Referer={referer}, Path={request.url.path}")
-            return cors_json_response(request, status_code=403, content={"detail": "Access Denied"}, block_reason="security-policy")
+        logger.warning(f"Access Denied: Origin={origin}, Referer={referer}, Path={path}")
+        return 403, {"detail": "Access Denied"}, "security-policy"
 
-    client_ip = get_client_ip(request)
-    
-    block_key = f"blocked:{client_ip}"
-    if cache.get(block_key):
-        return cors_json_response(request, status_code=429, content={"detail": "Too Many Requests. Blocked for 10 minutes."}, block_reason="rate-limit-active")
+    client_ip = get_client_ip(headers, scope)
+
+    if rate_limiter.is_blocked(client_ip):
+        return 429, {"detail": "Too Many Requests. Blocked for 10 minutes."}, "rate-limit-active"
 
     request_limit = BOT_MAX_REQUESTS if is_bot else MAX_REQUESTS
-    if not rate_limit_check(client_ip, "request", request_limit, RATE_LIMIT_WINDOW):
-        cache.set(block_key, True, expire=BLOCK_DURATION)
-        return cors_json_response(request, status_code=429, content={"detail": "Too Many Requests. Blocked for 10 minutes."}, block_reason="rate-limit-exceeded")
+    if not rate_limiter.hit(f"request:{client_ip}", request_limit, RATE_LIMIT_WINDOW):
+        rate_limiter.block(client_ip, BLOCK_DURATION)
+        rate_limit_blocks.inc("rate-limit-exceeded")
+        return 429, {"detail": "Too Many Requests. Blocked for 10 minutes."}, "rate-limit-exceeded"
 
     if not is_public_path and is_db_heavy_path(path):
         db_limit = DB_BOT_MAX_REQUESTS if is_bot else DB_MAX_REQUESTS
-        if not rate_limit_check(client_ip, "db", db_limit, DB_RATE_LIMIT_WINDOW):
-            cache.set(block_key, True, expire=BLOCK_DURATION)
-            return cors_json_response(request, status_code=429, content={"detail": "Too Many Requests. Blocked for 10 minutes."}, block_reason="db-rate-limit-exceeded")
+        if not rate_limiter.hit(f"db:{client_ip}", db_limit, DB_RATE_LIMIT_WINDOW):
+            rate_limiter.block(client_ip, BLOCK_DURATION)
+            rate_limit_blocks.inc("db-rate-limit-exceeded")
+            return 429, {"detail": "Too Many Requests. Blocked for 10 minutes."}, "db-rate-limit-exceeded"
+    return None
+
+class SecurityMiddleware:
+    # アクセス制御・レート制限・CORS をまとめた素の ASGI ミドルウェア。ヘッダーの解析はリクエストごとに1回だけ
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers: Dict[str, str] = {}
+        for key, value in scope["headers"]:
+            key = key.decode("latin-1")
+            if key not in headers:
+                headers[key] = value.decode("latin-1")
+
+        method = scope["method"]
+        origin = headers.get("origin")
+        if origin is not None and method == "OPTIONS" and "access-control-request-method" in headers:
+            await cors_preflight_response(headers, origin)(scope, receive, send)
+            return
+
+        if method != "OPTIONS":
+            rejected = check_request(scope, headers)
+            if rejected:
+                status_code, content, block_reason = rejected
+                http_requests_rejected.inc(block_reason)
+                await cors_json_response(headers, status_code, content, block_reason)(scope, receive, send)
+                return
+
+        cors_origin = origin if origin is not None and get_origin_decision(origin)[1] else None
+        response_started = False
+
+        async def send_with_cors(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+                message.setdefault("headers", [])
+                response_headers = MutableHeaders(scope=message)
+                if origin is not None:
+                    response_headers.update(CORS_SIMPLE_HEADERS)
+                if cors_origin:
+                    response_headers["Access-Control-Allow-Origin"] = cors_origin
+                response_headers["Vary"] = ", ".join([*response_headers.getlist("Vary"), "Origin"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_cors)
+        except Exception as e:
+            logger.error(f"Unhandled exception during request: {method} {scope['path']}", exc_info=True)
+            if response_started:
+                raise
+            await cors_json_response(headers, 500, {"detail": "Internal Server Error", "error_type": type(e).__name__}, "internal-error")(scope, receive, send)
+
+class MetricsMiddleware:
+    # ルート (パスのテンプレート)・メソッド・ステータスごとの応答時間。ルートはルーティング後の scope から取る
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
 
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            http_request_duration.observe(time.perf_counter() - started, route.path if route else "unmatched", scope["method"], status)
+
+class DisconnectMiddleware:
+    # クライアントが応答を受け取る前に切断したら、そのリクエストの処理を取り消す。
+    # 待っていた集計は SingleFlight 側で、ほかに待つリクエストがいなければ取り消される。
+    # receive は裏のタスクで読み続け、アプリにはキュー経由で渡す (DB を使うパスだけ)
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not is_db_heavy_path(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        messages: asyncio.Queue = asyncio.Queue()
+        response_started = False
+        disconnected = False
+
+        async def send_tracking(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        app_task = asyncio.ensure_future(self.app(scope, messages.get, send_tracking))
+
+        async def watch_disconnect():
+            nonlocal disconnected
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message["type"] == "http.disconnect":
+                    # 応答を返し始めた後 (ストリーミング) は Starlette 側で止まる
+                    if not response_started and not app_task.done():
+                        disconnected = True
+                        cancellation_stats["client_disconnects"] += 1
+                        app_task.cancel()
+                    return
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            await app_task
+        except asyncio.CancelledError:
+            if not disconnected:
+                raise
+        finally:
+            watcher.cancel()
+
+CREATE_GENERATIONS_SQL = '''
+    CREATE TABLE IF NOT EXISTS bucket_generations (
+        month TEXT NOT NULL,
+        channel_id BIGINT NOT NULL,
+        generation BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (month, channel_id)
+    )
+'''
+
+def on_bucket_notify(conn, pid, channel, payload):
     try:
-        response = await call_next(request)
-        response.headers["Vary"] = "Origin"
-        return response
-    except Exception as e:
-        logger.error(f"Unhandled exception during request: {request.method} {request.url.path}", exc_info=True)
-        return cors_json_response(request, status_code=500, content={"detail": "Internal Server Error", "error_type": type(e).__name__}, block_reason="internal-error")
+        for month, channel_id, generation in json.loads(payload):
+            generations.apply(month, int(channel_id), int(generation))
+    except (ValueError, TypeError):
+        logger.warning(f"Ignoring malformed bucket notification: {payload[:200]}")
+
+async def reload_generations(conn) -> int:
+    # 世代は増える一方なので、通知と読み込みのどちらが先に来ても大きい方が残る
+    rows = await conn.fetch("SELECT month, channel_id, generation FROM bucket_generations")
+    for r in rows:
+        generations.apply(r["month"], r["channel_id"], r["generation"])
+    return len(rows)
+
+class Reloader:
+    # NOTIFY を受けたら load を裏で走らせる。読み直し中に来た通知の分は、終わってからもう一度読み直す
+    def __init__(self, name: str, load):
+        self.name = name
+        self.load = load
+        self.dirty = False
+        self.task: Optional[asyncio.Future] = None
+
+    def schedule(self) -> None:
+        self.dirty = True
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self) -> None:
+        while self.dirty:
+            self.dirty = False
+            try:
+                await self.load()
+            except Exception:
+                logger.warning(f"Failed to reload {self.name}", exc_info=True)
+                return
+
+async def reload_channel_index():
+    global channel_index
+    rows = await pool.fetch("SELECT channel_id, name, category_id, category_name, is_active FROM channels")
+    channel_index = ChannelIndex(rows, PRIVATE_CHAT_CATEGORY_IDS)
+
+async def reload_excluded_users():
+    global excluded_user_ids
+    rows = await pool.fetch("SELECT user_id FROM users WHERE is_excluded ORDER BY user_id")
+    excluded_user_ids = [r["user_id"] for r in rows]
+
+# 検索の並び順に使う発言数も一緒に読む。Bot が users を同期するたびに NOTIFY が来て読み直す
+USER_INDEX_SQL = """
+    SELECT u.user_id, u.display_name, u.username, u.avatar_url, COALESCE(a.c, 0) AS c
+    FROM users u
+    LEFT JOIN (SELECT user_id, sum(message_count) AS c FROM message_rollups GROUP BY user_id) a ON a.user_id = u.user_id
+    WHERE NOT u.is_excluded
+"""
+
+async def reload_first_data_month() -> Optional[date]:
+    global first_data_month
+    first = await pool.fetchval("SELECT min(jst_date) FROM message_rollups")
+    first_data_month = first.replace(day=1) if first else None
+    return first
+
+async def reload_user_index():
+    global user_index
+    rows = await pool.fetch(USER_INDEX_SQL)
+    user_index = await asyncio.to_thread(UserIndex, rows)
+
+channel_index_reloader = Reloader("channel index", reload_channel_index)
+excluded_users_reloader = Reloader("excluded users", reload_excluded_users)
+user_index_reloader = Reloader("user index", reload_user_index)
+
+def on_channels_notify(conn, pid, channel, payload):
+    channel_index_reloader.schedule()
+
+def on_users_notify(conn, pid, channel, payload):
+    excluded_users_reloader.schedule()
+    user_index_reloader.schedule()
+
+async def notify_listener_loop():
+    # プールとは別の専用接続で LISTEN し続ける。切れたら繋ぎ直して世代と索引を読み直す
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(DB_DSN, ssl=False)
+            closed = asyncio.Event()
+            conn.add_termination_listener(lambda c: closed.set())
+            await conn.add_listener(BUCKET_CHANNEL, on_bucket_notify)
+            await conn.add_listener(CHANNELS_CHANNEL, on_channels_notify)
+            await conn.add_listener(USERS_CHANNEL, on_users_notify)
+            # LISTEN を始めてから読み直すので、切れていた間とその間に来た通知も取りこぼさない
+            loaded = await reload_generations(conn)
+            channel_index_reloader.schedule()
+            excluded_users_reloader.schedule()
+            user_index_reloader.schedule()
+            logger.info(f"Listening for notifications ({loaded} buckets loaded).")
+            while not closed.is_set():
+                try:
+                    await asyncio.wait_for(closed.wait(), timeout=60)
+                except asyncio.TimeoutError:
+                    await conn.execute("SELECT 1")
+            logger.warning("Notification listener connection closed. Reconnecting...")
+        except Exception as e:
+            logger.warning(f"Notification listener error: {e}")
+        finally:
+            if conn and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(5)
 
 @app.on_event("startup")
 async def startup():
@@ -306,6 +812,9 @@ async def startup():
                 await asyncio.sleep(60)
 
     asyncio.create_task(heartbeat_loop())
+    asyncio.create_task(rate_limit_sweep_loop())
+    if RATE_LIMIT_BACKEND == "shared":
+        asyncio.create_task(rate_limit_sync_loop())
 
     global pool
     try:
@@ -314,11 +823,21 @@ async def startup():
         safe_dsn = f"{parsed.scheme}://{parsed.username}:****@{parsed.hostname}:{parsed.port}{parsed.path}"
         logger.info(f"Connecting to database at {safe_dsn}")
         
-        pool = await asyncpg.create_pool(DB_DSN, min_size=10, max_size=50, ssl=False, command_timeout=60)
+        pool = InstrumentedPool(await asyncpg.create_pool(DB_DSN, min_size=10, max_size=50, ssl=False, command_timeout=60), db_acquire_wait, db_query_duration, slow_queries)
         logger.info("Database connection pool created (size: 10-50).")
         await pool.execute("ALTER TABLE channels ADD COLUMN IF NOT EXISTS category_id BIGINT")
         await pool.execute("CREATE INDEX IF NOT EXISTS idx_channels_category_id ON channels (category_id)")
+        await pool.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS is_excluded BOOLEAN NOT NULL DEFAULT FALSE")
+        await pool.execute(CREATE_GENERATIONS_SQL)
+        # 世代を読む前に応答すると全キーが世代 0 で作られ、読んだ途端にまた stale になって締まった月を2回集計し直すことになる
+        await reload_generations(pool)
+        await reload_channel_index()
+        await reload_excluded_users()
+        await reload_user_index()
+        await reload_first_data_month()
+        asyncio.create_task(notify_listener_loop())
         asyncio.create_task(warm_total_cache_loop())
+        asyncio.create_task(month_close_loop())
     except Exception as e:
         logger.error(f"Failed to create database pool: {e}")
         raise e
@@ -339,6 +858,7 @@ class RankingItem(BaseModel):
     avatar: Optional[str]
     count: int
     char_count: int
+    rank: Optional[int] = None
 
 def format_ranking_response(rows):
     return [{"user_id": str(r["user_id"]), "display_name": r["display_name"] or "Unknown", "username": r["username"] or "unknown", "avatar": r["avatar_url"], "count": r["c"], "char_count": r["chars"] or 0} for r in rows]
@@ -356,58 +876,114 @@ def format_user_rank_response(row):
         "rank": row["rank"],
     }
 
-def get_month_bounds(year: int, month: int) -> Tuple[datetime, datetime]:
+JST = timezone(timedelta(hours=9))
+
+def get_month_bounds(year: int, month: int) -> Tuple[date, date]:
     if month < 1 or month > 12:
         raise HTTPException(status_code=400, detail="month must be between 1 and 12")
-    start = datetime(year, month, 1)
+    start = date(year, month, 1)
     if month == 12:
-        return start, datetime(year + 1, 1, 1)
-    return start, datetime(year, month + 1, 1)
+        return start, date(year + 1, 1, 1)
+    return start, date(year, month + 1, 1)
+
+def to_jst(value: datetime) -> datetime:
+    # naive な値は asyncpg と同じくローカル時刻として扱う
+    return value.astimezone(JST)
+
+def month_key(year: int, month: int) -> str:
+    return f"{year:04d}-{month:02d}"
+
+def month_generation(year: int, month: int, channel_ids: Optional[List[int]] = None) -> int:
+    return generations.month(month_key(year, month), channel_ids)
+
+def total_generation(end_date: Optional[datetime], channel_ids: Optional[List[int]] = None) -> int:
+    return generations.until(to_jst(end_date).strftime("%Y-%m") if end_date else None, channel_ids)
 
-def escape_like(value: str) -> str:
-    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+def is_closed_month(year: int, month: int) -> bool:
+    _, end = get_month_bounds(year, month)
+    return end <= datetime.now(JST).date()
+
+def is_closed_end_date(end_date: Optional[datetime]) -> bool:
+    # 今月より前で切った累計は、締まった月だけから決まる
+    if end_date is None:
+        return False
+    now = datetime.now(JST)
+    return to_jst(end_date) < now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def is_snapshot_scope(channel_id: Optional[int]) -> bool:
+    # サイトのチャンネル一覧に出る範囲 (全体・プラチャ総合・公開チャンネル) だけ
+    return channel_id is None or channel_id == PRIVATE_CHAT_CHANNEL_ID or channel_id in WHITELIST_CHANNEL_IDS
+
+def is_snapshot_month(year: int, month: int, channel_id: Optional[int] = None, user_id: Any = None) -> bool:
+    # クライアントが任意の値で期限なしのファイルを増やせないよう、user_id 付き・一覧に無いチャンネル・
+    # データより前の月は、締まっていても diskcache (ttl・容量の上限あり) に入れる
+    if not is_closed_month(year, month) or user_id or not is_snapshot_scope(channel_id):
+        return False
+    return first_data_month is not None and date(year, month, 1) >= first_data_month
+
+def is_snapshot_end_date(end_date: Optional[datetime], channel_id: Optional[int] = None, user_id: Any = None) -> bool:
+    # end_date は JST の月初ちょうどを +09:00 で指定したものだけ (同じ時点の別表記・細かい時刻はキーが増えるだけなので入れない)
+    if not is_closed_end_date(end_date) or user_id or not is_snapshot_scope(channel_id) or first_data_month is None:
+        return False
+    at_month_start = (end_date.day, end_date.hour, end_date.minute, end_date.second, end_date.microsecond) == (1, 0, 0, 0, 0)
+    return end_date.utcoffset() == timedelta(hours=9) and at_month_start and end_date.date() > first_data_month
+
+def month_cache_ttls(year: int, month: int) -> Tuple[int, int]:
+    # (サーバー側 ttl, max-age)
+    if is_closed_month(year, month):
+        return CLOSED_MONTH_CACHE_TTL, CLOSED_MONTH_MAX_AGE
+    return 600, 600
 
 async def get_channel_scope_ids(channel_id: Optional[int]) -> Optional[List[int]]:
     if not channel_id:
         return None
-
+    if channel_index is None:
+        await reload_channel_index()
     if channel_id == PRIVATE_CHAT_CHANNEL_ID:
-        rows = await pool.fetch(
-            """
-            SELECT channel_id
-            FROM channels
-            WHERE is_active = TRUE
-              AND (
-                  (category_id IS NULL AND category_name = '未分類')
-                  OR (category_id IS NOT NULL AND NOT (category_id = ANY($1::bigint[])))
-              )
-            """,
-            PRIVATE_CHAT_CATEGORY_IDS,
-        )
-        return [r["channel_id"] for r in rows]
-
-    channel = await pool.fetchrow("SELECT name FROM channels WHERE channel_id = $1", channel_id)
-    if not channel:
-        return [channel_id]
-
-    child_prefix = f"{escape_like(channel['name'])} / %"
-    rows = await pool.fetch(
-        """
-        SELECT channel_id
-        FROM channels
-        WHERE channel_id = $1 OR name LIKE $2 ESCAPE '\\'
-        """,
-        channel_id,
-        child_prefix,
-    )
-    return [r["channel_id"] for r in rows] or [channel_id]
+        return channel_index.private_chat_ids
+    return channel_index.scope(channel_id)
 
 def add_channel_scope_filter(params: List[Any], filters: List[str], column: str, channel_ids: Optional[List[int]]) -> None:
     if channel_ids is not None:
         params.append(channel_ids)
         filters.append(f"{column} = ANY(${len(params)}::bigint[])")
 
-DELETED_USER_FILTER = "(u.user_id IS NOT NULL AND u.username NOT ILIKE 'deleted%user' AND u.display_name NOT ILIKE 'deleted%user')"
+def add_excluded_users_param(params: List[Any]) -> str:
+    # 除外ユーザーは users を結合せずに配列で落とす (集計の前に行を減らせる)
+    params.append(excluded_user_ids)
+    return f"${len(params)}::bigint[]"
+
+ROLLUP_COLUMNS = "jst_date, hour, channel_id, user_id, message_count, char_count"
+
+def build_rollup_source(params: List[Any], channel_ids: Optional[List[int]] = None, start_date: Optional[date] = None, end_date: Optional[date] = None, until: Optional[datetime] = None) -> str:
+    # message_rollups (JST日付×時×チャンネル×ユーザー) を集計元にする。
+    # until 指定時は until を含む1時間だけ messages から同じ形に集計して足す。
+    f = []
+    if start_date: params.append(start_date); f.append(f"jst_date >= ${len(params)}")
+    if end_date: params.append(end_date); f.append(f"jst_date < ${len(params)}")
+    scope = []
+    add_channel_scope_filter(params, scope, "channel_id", channel_ids)
+    if until is None:
+        return f"(SELECT {ROLLUP_COLUMNS} FROM message_rollups WHERE {' AND '.join(f + scope) or 'TRUE'})"
+
+    bucket = to_jst(until).replace(minute=0, second=0, microsecond=0)
+    params.extend([bucket.date(), bucket.hour])
+    date_param, hour_param = f"${len(params) - 1}", f"${len(params)}"
+    f.append(f"(jst_date, hour) < ({date_param}, {hour_param})")
+    params.extend([bucket, until])
+    tail = ["is_bot = FALSE", f"created_at >= ${len(params) - 1}", f"created_at <= ${len(params)}"] + scope
+    # 残りの部分は until を含む1時間だけなので、JST の日付・時はその時間帯の値そのもの
+    return f"""(
+        SELECT {ROLLUP_COLUMNS} FROM message_rollups WHERE {' AND '.join(f + scope)}
+        UNION ALL
+        SELECT {date_param}::date, {hour_param}::smallint, channel_id, user_id, count(*)::int, COALESCE(sum(char_count), 0)::bigint
+        FROM messages WHERE {' AND '.join(tail)}
+        GROUP BY channel_id, user_id
+    )"""
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(status_code=503, content={"detail": "Server is busy. Please retry later."}, headers={"Retry-After": str(OVERLOADED_RETRY_AFTER)})
 
 @app.get("/")
 async def root():
@@ -418,402 +994,514 @@ async def health():
     return PlainTextResponse("ok")
 
 @app.get("/channels", response_model=List[ChannelItem])
-async def get_channels(response: Response):
+async def get_channels(request: Request):
     ckey = "channels_list"
-    cached = get_cache(ckey)
-    response.headers["Cache-Control"] = "public, max-age=3600"
-    if cached: return cached
-    
-    rows = await pool.fetch("SELECT * FROM channels WHERE is_active = TRUE ORDER BY position ASC")
-    
-    visible_rows = [r for r in rows if r["channel_id"] in WHITELIST_CHANNEL_IDS]
-    visible_rows.sort(key=lambda r: (r["category_id"] in BOTTOM_CHANNEL_CATEGORY_IDS, r["position"] or 999999))
-
-    res = [{
-        "id": str(PRIVATE_CHAT_CHANNEL_ID),
-        "name": "プラチャ総合",
-        "category": "プラチャ",
-    }]
-    res.extend([
-        {"id": str(r["channel_id"]), "name": r["name"], "category": r["category_name"] if r["category_name"] else "未分類"}
-        for r in visible_rows
-    ])
-    
-    set_cache(ckey, res, ttl=3600)
-    return res
+    cache_header = cache_control(3600)
+
+    async def fill():
+        rows = await pool.fetch("SELECT * FROM channels WHERE is_active = TRUE ORDER BY position ASC")
+
+        visible_rows = [r for r in rows if r["channel_id"] in WHITELIST_CHANNEL_IDS]
+        visible_rows.sort(key=lambda r: (r["category_id"] in BOTTOM_CHANNEL_CATEGORY_IDS, r["position"] or 999999))
+
+        res = [{
+            "id": str(PRIVATE_CHAT_CHANNEL_ID),
+            "name": "プラチャ総合",
+            "category": "プラチャ",
+        }]
+        res.extend([
+            {"id": str(r["channel_id"]), "name": r["name"], "category": r["category_name"] if r["category_name"] else "未分類"}
+            for r in visible_rows
+        ])
+
+        return await set_cache(ckey, res, ttl=3600)
+    return encoded_response(request, await get_or_fill_cache(ckey, fill, query_class=light_queries), cache_header)
 
 @app.get("/users/search")
-async def search_users(q: str):
-    search_query = q.strip()
-    if not search_query: return []
-    query = f"SELECT user_id, display_name, username, avatar_url FROM users u WHERE (display_name ILIKE $1 OR username ILIKE $1) AND {DELETED_USER_FILTER} LIMIT 10"
-    rows = await pool.fetch(query, f"%{search_query}%")
-    return [{"user_id": str(r['user_id']), "display_name": r['display_name'], "username": r['username'], "avatar": r['avatar_url']} for r in rows]
+async def search_users(q: str, limit: int = Query(USER_SEARCH_LIMIT, ge=1, le=USER_SEARCH_MAX_LIMIT)):
+    # メモリ上の索引だけで答える (入力補完で1文字ごとに呼ばれても DB に行かない)
+    if user_index is None: return []
+    return user_index.search(q, limit)
+
+# ユーザーごとに集計してから users を結合する (users に無いユーザーはここで落ちる)
+USER_TOTALS_SQL = """
+    SELECT a.user_id, a.c, a.chars, u.display_name, u.username, u.avatar_url
+    FROM (
+        SELECT r.user_id, sum(r.message_count) AS c, sum(r.char_count)::bigint AS chars
+        FROM {src} r
+        WHERE r.user_id <> ALL({excluded})
+        GROUP BY r.user_id
+    ) a
+    JOIN users u ON u.user_id = a.user_id
+"""
+
+async def build_ranking(params: List[Any], src: str):
+    params = params[:]
+    query = USER_TOTALS_SQL.format(src=src, excluded=add_excluded_users_param(params)) + " ORDER BY a.c DESC LIMIT 100"
+    rows = await pool.fetch(query, *params)
+    return format_ranking_response(rows)
+
+RANKING_PAGE_MAX = 500
+
+def encode_ranking_cursor(count: int, user_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{count}:{user_id}".encode()).decode().rstrip("=")
+
+def decode_ranking_cursor(cursor: str) -> Tuple[int, int]:
+    try:
+        count, user_id = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split(":")
+        return int(count), int(user_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def ranking_page_response(request: Request, table: RankTable, after_rank: Optional[int], cursor: Optional[str], limit: Optional[int], cache_header: str) -> Response:
+    # 順位表の (発言数の多い順, user_id の昇順) の並びで切り出す。cursor は最後の (発言数, user_id) なので
+    # 表が作り直されても続きから読め、after_rank はその位置 (1始まり) の次から返す
+    if cursor:
+        start = table.position_after(*decode_ranking_cursor(cursor))
+    else:
+        start = after_rank or 0
+    end = min(start + (limit or 100), len(table))
+    rows = [table.entry(i) for i in range(start, end)]
+    items = format_ranking_response(rows)
+    for item, r in zip(items, rows):
+        item["rank"] = r["rank"]
+    response = encoded_response(request, encode_body(items), cache_header)
+    response.headers["X-Total-Count"] = str(len(table))
+    if end < len(table):
+        response.headers["X-Next-Cursor"] = encode_ranking_cursor(rows[-1]["c"], rows[-1]["user_id"])
+    return response
 
 @app.get("/ranking/monthly/{year}/{month}", response_model=List[RankingItem])
-async def get_monthly_ranking(year: int, month: int, response: Response, channel_id: Optional[int] = Query(None)):
+async def get_monthly_ranking(year: int, month: int, request: Request, channel_id: Optional[int] = Query(None), after_rank: Optional[int] = Query(None, ge=0), cursor: Optional[str] = Query(None), limit: Optional[int] = Query(None, ge=1, le=RANKING_PAGE_MAX)):
     ckey = f"rank_m_{year}_{month}_{channel_id}"
-    cached = get_cache(ckey)
-    response.headers["Cache-Control"] = "public, max-age=600"
-    if cached: return cached
-    start_date, end_date = get_month_bounds(year, month)
-    channel_ids = await get_channel_scope_ids(channel_id)
-    p = [start_date, end_date]
-    f = ["m.created_at >= $1", "m.created_at < $2", "m.is_bot = FALSE", DELETED_USER_FILTER]
-    add_channel_scope_filter(p, f, "m.channel_id", channel_ids)
-    query = f"SELECT m.user_id, count(*) as c, sum(m.char_count) as chars, u.display_name, u.username, u.avatar_url FROM messages m LEFT JOIN users u ON m.user_id = u.user_id WHERE {' AND '.join(f)} GROUP BY m.user_id, u.display_name, u.username, u.avatar_url ORDER BY c DESC LIMIT 100"
-    rows = await pool.fetch(query, *p)
-    res = format_ranking_response(rows)
-    set_cache(ckey, res, ttl=600)
-    return res
+    ttl, max_age = month_cache_ttls(year, month)
+    snapshot = is_snapshot_month(year, month, channel_id)
+    scope = await get_channel_scope_ids(channel_id)
+    gen = month_generation(year, month, scope)
+    cache_header = cache_control(max_age)
+
+    if after_rank is not None or cursor or limit:
+        table = await get_monthly_rank_table(year, month, channel_id, scope, ttl, gen)
+        return ranking_page_response(request, table, after_rank, cursor, limit, cache_header)
+
+    async def fill():
+        start_date, end_date = get_month_bounds(year, month)
+        p = []
+        src = build_rollup_source(p, scope, start_date=start_date, end_date=end_date)
+        res = await build_ranking(p, src)
+        return await set_cache(ckey, res, ttl=ttl, generation=gen, snapshot=snapshot)
+    return encoded_response(request, await get_or_fill_cache(ckey, fill, gen, snapshot), cache_header)
 
 @app.get("/ranking/total", response_model=List[RankingItem])
-async def get_total_ranking(response: Response, channel_id: Optional[int] = Query(None), end_date: Optional[datetime] = Query(None)):
+async def get_total_ranking(request: Request, channel_id: Optional[int] = Query(None), end_date: Optional[datetime] = Query(None), after_rank: Optional[int] = Query(None, ge=0), cursor: Optional[str] = Query(None), limit: Optional[int] = Query(None, ge=1, le=RANKING_PAGE_MAX)):
     ckey = f"rank_t_{channel_id}_{end_date}"
-    cached = get_cache(ckey)
     ttl = 86400 if end_date else LIVE_TOTAL_CACHE_TTL
-    response.headers["Cache-Control"] = f"public, max-age={ttl}"
-    if cached: return cached
-    p = []; f = ["m.is_bot = FALSE", DELETED_USER_FILTER]
-    add_channel_scope_filter(p, f, "m.channel_id", await get_channel_scope_ids(channel_id))
-    if end_date: p.append(end_date); f.append(f"m.created_at <= ${len(p)}")
-    query = f"SELECT m.user_id, count(*) as c, sum(m.char_count) as chars, u.display_name, u.username, u.avatar_url FROM messages m LEFT JOIN users u ON m.user_id = u.user_id WHERE {' AND '.join(f)} GROUP BY m.user_id, u.display_name, u.username, u.avatar_url ORDER BY c DESC LIMIT 100"
-    rows = await pool.fetch(query, *p)
-    res = format_ranking_response(rows)
-    set_cache(ckey, res, ttl=ttl)
-    return res
+    snapshot = is_snapshot_end_date(end_date, channel_id)
+    scope = await get_channel_scope_ids(channel_id)
+    gen = total_generation(end_date, scope)
+    cache_header = cache_control(ttl)
+
+    if after_rank is not None or cursor or limit:
+        table = await get_total_rank_table(channel_id, end_date, scope, ttl, gen)
+        return ranking_page_response(request, table, after_rank, cursor, limit, cache_header)
+
+    async def fill():
+        p = []
+        src = build_rollup_source(p, scope, until=end_date)
+        res = await build_ranking(p, src)
+        return await set_cache(ckey, res, ttl=ttl, generation=gen, snapshot=snapshot)
+    return encoded_response(request, await get_or_fill_cache(ckey, fill, gen, snapshot), cache_header)
+
+async def build_rank_table(key: str, params: List[Any], src: str, ttl: int, generation: Optional[int]) -> RankTable:
+    params = params[:]
+    rows = await pool.fetch(USER_TOTALS_SQL.format(src=src, excluded=add_excluded_users_param(params)), *params)
+    table = await asyncio.to_thread(RankTable, rows, generation, time.time() + ttl)
+    expire = ttl + CACHE_STALE_TTL
+    rank_tables.set(key, table, time.time() + expire, table.size())
+    await asyncio.to_thread(cache.set, f"rank_table:{key}", table, expire=expire)
+    return table
+
+async def get_rank_table(key: str, generation: Optional[int], build) -> RankTable:
+    # get_or_fill_cache と同じく、同時ミスは1回の集計にまとめ、古い表は返しつつ裏で作り直す
+    fill_key = f"rank_table:{key}"
+    admitted_build = lambda: heavy_queries.run(lambda: timed_fill(fill_key, build))
+    table = rank_tables.get(key)
+    if table is MISS:
+        table = await asyncio.to_thread(cache.get, fill_key)
+        if table is None:
+            cache_requests.inc("rank_table", "miss")
+            return await cache_fills.run(fill_key, admitted_build)
+        rank_tables.set(key, table, table.fresh_until + CACHE_STALE_TTL, table.size())
+    if table.fresh_until <= time.time() or table.generation != generation:
+        cache_requests.inc("rank_table", "stale")
+        cache_fills.start(fill_key, lambda: refresh_cache(fill_key, admitted_build))
+    else:
+        cache_requests.inc("rank_table", "hit")
+    return table
+
+async def get_monthly_rank_table(year: int, month: int, channel_id: Optional[int], scope: Optional[List[int]], ttl: int, generation: Optional[int]) -> RankTable:
+    key = f"m_{year}_{month}_{channel_id}"
+
+    async def build():
+        start_date, end_date = get_month_bounds(year, month)
+        p = []
+        src = build_rollup_source(p, scope, start_date=start_date, end_date=end_date)
+        return await build_rank_table(key, p, src, ttl, generation)
+    return await get_rank_table(key, generation, build)
+
+async def get_total_rank_table(channel_id: Optional[int], end_date: Optional[datetime], scope: Optional[List[int]], ttl: int, generation: Optional[int]) -> RankTable:
+    key = f"t_{channel_id}_{end_date}"
+
+    async def build():
+        p = []
+        src = build_rollup_source(p, scope, until=end_date)
+        return await build_rank_table(key, p, src, ttl, generation)
+    return await get_rank_table(key, generation, build)
 
 @app.get("/users/{user_id}/rank/monthly/{year}/{month}")
-async def get_monthly_user_rank(user_id: int, year: int, month: int, response: Response, channel_id: Optional[int] = Query(None)):
-    ckey = f"user_rank_m_{user_id}_{year}_{month}_{channel_id}"
-    cached = get_cache(ckey)
-    response.headers["Cache-Control"] = "public, max-age=600"
-    if cached is not None:
-        return cached
-
-    start_date, end_date = get_month_bounds(year, month)
-    p = [start_date, end_date]
-    f = ["m.created_at >= $1", "m.created_at < $2", "m.is_bot = FALSE", DELETED_USER_FILTER]
-    add_channel_scope_filter(p, f, "m.channel_id", await get_channel_scope_ids(channel_id))
-    p.append(user_id)
-    target_param = f"${len(p)}"
-
-    query = f"""
-        WITH counts AS (
-            SELECT m.user_id, count(*) AS c, sum(m.char_count) AS chars
-            FROM messages m
-            LEFT JOIN users u ON m.user_id = u.user_id
-            WHERE {' AND '.join(f)}
-            GROUP BY m.user_id
-        ),
-        target AS (
-            SELECT user_id, c, chars
-            FROM counts
-            WHERE user_id = {target_param}
-        )
-        SELECT
-            t.user_id,
-            t.c,
-            t.chars,
-            u.display_name,
-            u.username,
-            u.avatar_url,
-            (SELECT count(*) + 1 FROM counts c2 WHERE c2.c > t.c)::int AS rank
-        FROM target t
-        LEFT JOIN users u ON t.user_id = u.user_id
-    """
-    row = await pool.fetchrow(query, *p)
-    res = format_user_rank_response(row)
-    set_cache(ckey, res, ttl=600)
-    return res
+async def get_monthly_user_rank(user_id: int, year: int, month: int, request: Request, channel_id: Optional[int] = Query(None)):
+    ttl, max_age = month_cache_ttls(year, month)
+    scope = await get_channel_scope_ids(channel_id)
+    gen = month_generation(year, month, scope)
+    table = await get_monthly_rank_table(year, month, channel_id, scope, ttl, gen)
+    return encoded_response(request, encode_body(format_user_rank_response(table.lookup(user_id))), cache_control(max_age))
 
 @app.get("/users/{user_id}/rank/total")
-async def get_total_user_rank(user_id: int, response: Response, channel_id: Optional[int] = Query(None), end_date: Optional[datetime] = Query(None)):
-    ckey = f"user_rank_t_{user_id}_{channel_id}_{end_date}"
-    cached = get_cache(ckey)
+async def get_total_user_rank(user_id: int, request: Request, channel_id: Optional[int] = Query(None), end_date: Optional[datetime] = Query(None)):
     ttl = 86400 if end_date else LIVE_TOTAL_CACHE_TTL
-    response.headers["Cache-Control"] = f"public, max-age={ttl}"
-    if cached is not None:
-        return cached
-
-    p = []
-    f = ["m.is_bot = FALSE", DELETED_USER_FILTER]
-    add_channel_scope_filter(p, f, "m.channel_id", await get_channel_scope_ids(channel_id))
-    if end_date:
-        p.append(end_date)
-        f.append(f"m.created_at <= ${len(p)}")
-    p.append(user_id)
-    target_param = f"${len(p)}"
-
-    query = f"""
-        WITH counts AS (
-            SELECT m.user_id, count(*) AS c, sum(m.char_count) AS chars
-            FROM messages m
-            LEFT JOIN users u ON m.user_id = u.user_id
-            WHERE {' AND '.join(f)}
-            GROUP BY m.user_id
-        ),
-        target AS (
-            SELECT user_id, c, chars
-            FROM counts
-            WHERE user_id = {target_param}
-        )
-        SELECT
-            t.user_id,
-            t.c,
-            t.chars,
-            u.display_name,
-            u.username,
-            u.avatar_url,
-            (SELECT count(*) + 1 FROM counts c2 WHERE c2.c > t.c)::int AS rank
-        FROM target t
-        LEFT JOIN users u ON t.user_id = u.user_id
-    """
-    row = await pool.fetchrow(query, *p)
-    res = format_user_rank_response(row)
-    set_cache(ckey, res, ttl=ttl)
-    return res
-
-@app.get("/stats/history/{year}/{month}")
-async def get_daily_history(year: int, month: int, response: Response, channel_id: Optional[int] = Query(None), user_id: Optional[List[str]] = Query(None)):
-    ckey = f"hist_m_{year}_{month}_{channel_id}_{user_id}"
-    cached = get_cache(ckey)
-    response.headers["Cache-Control"] = "public, max-age=600"
-    if cached: return cached
-    start_date, end_date = get_month_bounds(year, month)
-    params = [start_date, end_date]
-    f = ["created_at >= $1", "created_at < $2", "is_bot = FALSE"]
-    add_channel_scope_filter(params, f, "channel_id", await get_channel_scope_ids(channel_id))
-    where = " AND ".join(f)
-    t_rows = await pool.fetch(f"SELECT DATE(created_at) as d, count(*) as c FROM messages WHERE {where} GROUP BY DATE(created_at) ORDER BY d", *params)
-    top_where = where.replace('channel_id', 'm.channel_id').replace('created_at', 'm.created_at').replace('is_bot', 'm.is_bot')
-    top_u_sql = f"SELECT m.user_id, count(*) as c FROM messages m LEFT JOIN users u ON m.user_id = u.user_id WHERE {top_where} AND {DELETED_USER_FILTER} GROUP BY m.user_id ORDER BY c DESC LIMIT 100"
-    top_u = await pool.fetch(top_u_sql, *params)
+    scope = await get_channel_scope_ids(channel_id)
+    gen = total_generation(end_date, scope)
+    table = await get_total_rank_table(channel_id, end_date, scope, ttl, gen)
+    return encoded_response(request, encode_body(format_user_rank_response(table.lookup(user_id))), cache_control(ttl))
+
+TOP_USERS_SQL = """
+    SELECT a.user_id, a.c
+    FROM (
+        SELECT r.user_id, sum(r.message_count) AS c
+        FROM {src} r
+        WHERE r.user_id <> ALL({excluded})
+        GROUP BY r.user_id
+    ) a
+    WHERE EXISTS (SELECT 1 FROM users u WHERE u.user_id = a.user_id)
+    ORDER BY a.c DESC
+    LIMIT 100
+"""
+
+async def build_history(params: List[Any], src: str, user_id: Optional[List[str]], columnar: bool = False):
+    top_p = params[:]
+    t_rows, top_u = await asyncio.gather(
+        pool.fetch(f"SELECT r.jst_date as d, sum(r.message_count) as c FROM {src} r GROUP BY r.jst_date ORDER BY d", *params),
+        pool.fetch(TOP_USERS_SQL.format(src=src, excluded=add_excluded_users_param(top_p)), *top_p),
+    )
     target_ids = [str(r['user_id']) for r in top_u]
     if user_id:
         for uid in user_id:
             if uid.isdigit() and uid not in target_ids: target_ids.append(uid)
-    data_map = {r['d'].strftime("%Y-%m-%d"): {"date": r['d'].strftime("%Y-%m-%d"), "total": r['c']} for r in t_rows}
+    rows = []
     u_details = {}
     if target_ids:
         ids_plist = [int(i) for i in target_ids]
-        f_params = params + [ids_plist]
-        p_idx = f"${len(f_params)}"
-        rows = await pool.fetch(f"SELECT DATE(created_at) as d, user_id, count(*) as c FROM messages WHERE {where} AND user_id = ANY({p_idx}::bigint[]) GROUP BY DATE(created_at), user_id ORDER BY d", *f_params)
-        for r in rows:
-            d = r['d'].strftime("%Y-%m-%d")
-            if d not in data_map: data_map[d] = {"date": d, "total": 0}
-            data_map[d][str(r['user_id'])] = r['c']
-        u_rows = await pool.fetch("SELECT user_id, display_name, username, avatar_url FROM users WHERE user_id = ANY($1::bigint[])", ids_plist)
+        up = params + [ids_plist]
+        rows, u_rows = await asyncio.gather(
+            pool.fetch(f"SELECT r.jst_date as d, r.user_id, sum(r.message_count) as c FROM {src} r WHERE r.user_id = ANY(${len(up)}::bigint[]) GROUP BY r.jst_date, r.user_id ORDER BY d", *up),
+            pool.fetch("SELECT user_id, display_name, username, avatar_url FROM users WHERE user_id = ANY($1::bigint[])", ids_plist),
+        )
         for r in u_rows: u_details[str(r['user_id'])] = {"name": r['display_name'], "username": r['username'], "avatar": r['avatar_url']}
-    res = {"chart_data": sorted(list(data_map.values()), key=lambda x: x['date']), "users": u_details, "top_user_id": str(top_u[0]['user_id']) if top_u else None}
-    set_cache(ckey, res, ttl=600)
-    return res
+    top_user_id = str(top_u[0]['user_id']) if top_u else None
+    if columnar:
+        return {**build_columnar_history(t_rows, rows, target_ids), "users": u_details, "top_user_id": top_user_id}
+
+    data_map = {r['d'].strftime("%Y-%m-%d"): {"date": r['d'].strftime("%Y-%m-%d"), "total": r['c']} for r in t_rows}
+    for r in rows:
+        d = r['d'].strftime("%Y-%m-%d")
+        if d not in data_map: data_map[d] = {"date": d, "total": 0}
+        data_map[d][str(r['user_id'])] = r['c']
+    return {"chart_data": sorted(list(data_map.values()), key=lambda x: x['date']), "users": u_details, "top_user_id": top_user_id}
+
+def build_columnar_history(t_rows: List[asyncpg.Record], rows: List[asyncpg.Record], target_ids: List[str]) -> dict:
+    # ?format=columnar: 日付・合計の配列と、ユーザーごとに日付と同じ長さの発言数の配列。
+    # 合計とユーザーの行は別々の文で読むので (end_date の残りは messages から読む)、間の書き込みで日付が食い違うことがある。
+    # 日付は両方を合わせたものにし、合計に無い日は行の形式と同じく 0 にする
+    totals = {r['d']: r['c'] for r in t_rows}
+    dates = sorted(totals.keys() | {r['d'] for r in rows})
+    index = {d: i for i, d in enumerate(dates)}
+    series = {int(uid): [0] * len(dates) for uid in target_ids}
+    for r in rows:
+        series[r['user_id']][index[r['d']]] = r['c']
+    return {
+        "dates": [d.isoformat() for d in dates],
+        "totals": [totals.get(d, 0) for d in dates],
+        "series": {str(uid): counts for uid, counts in series.items()},
+    }
+
+@app.get("/stats/history/{year}/{month}")
+async def get_daily_history(year: int, month: int, request: Request, channel_id: Optional[int] = Query(None), user_id: Optional[List[str]] = Query(None), format: Optional[str] = Query(None, pattern="^columnar$")):
+    columnar = format == "columnar"
+    ckey = f"hist_m_{year}_{month}_{channel_id}_{user_id}" + ("_columnar" if columnar else "")
+    ttl, max_age = month_cache_ttls(year, month)
+    snapshot = is_snapshot_month(year, month, channel_id, user_id)
+    scope = await get_channel_scope_ids(channel_id)
+    gen = month_generation(year, month, scope)
+    cache_header = cache_control(max_age)
+
+    async def fill():
+        start_date, end_date = get_month_bounds(year, month)
+        p = []
+        src = build_rollup_source(p, scope, start_date=start_date, end_date=end_date)
+        res = await build_history(p, src, user_id, columnar)
+        return await set_cache(ckey, res, ttl=ttl, generation=gen, snapshot=snapshot)
+    return encoded_response(request, await get_or_fill_cache(ckey, fill, gen, snapshot), cache_header)
 
 @app.get("/stats/history/total")
-async def get_total_history(response: Response, channel_id: Optional[int] = Query(None), user_id: Optional[List[str]] = Query(None), end_date: Optional[datetime] = Query(None)):
-    ckey = f"hist_t_{channel_id}_{user_id}_{end_date}"
-    cached = get_cache(ckey)
+async def get_total_history(request: Request, channel_id: Optional[int] = Query(None), user_id: Optional[List[str]] = Query(None), end_date: Optional[datetime] = Query(None), format: Optional[str] = Query(None, pattern="^columnar$")):
+    columnar = format == "columnar"
+    ckey = f"hist_t_{channel_id}_{user_id}_{end_date}" + ("_columnar" if columnar else "")
     ttl = 86400 if end_date else LIVE_TOTAL_CACHE_TTL
-    response.headers["Cache-Control"] = f"public, max-age={ttl}"
-    if cached: return cached
-    p = []; f = ["is_bot = FALSE"]
-    add_channel_scope_filter(p, f, "channel_id", await get_channel_scope_ids(channel_id))
-    if end_date: p.append(end_date); f.append(f"created_at <= ${len(p)}")
-    t_rows = await pool.fetch(f"SELECT DATE(created_at) as d, count(*) as c FROM messages WHERE {' AND '.join(f)} GROUP BY DATE(created_at) ORDER BY d", *p)
-    line_f = (" AND ".join(f)).replace('channel_id', 'm.channel_id').replace('created_at', 'm.created_at')
-    top_u = await pool.fetch(f"SELECT m.user_id, count(*) as c FROM messages m LEFT JOIN users u ON m.user_id = u.user_id WHERE {line_f} AND {DELETED_USER_FILTER} GROUP BY m.user_id ORDER BY c DESC LIMIT 100", *p)
-    target_ids = [str(r['user_id']) for r in top_u]
-    if user_id:
-        for uid in user_id:
-            if uid.isdigit() and uid not in target_ids: target_ids.append(uid)
-    data_map = {r['d'].strftime("%Y-%m-%d"): {"date": r['d'].strftime("%Y-%m-%d"), "total": r['c']} for r in t_rows}
-    u_details = {}
-    if target_ids:
-        ids_plist = [int(i) for i in target_ids]
-        up = p + [ids_plist]
-        rows = await pool.fetch(f"SELECT DATE(created_at) as d, user_id, count(*) as c FROM messages WHERE {' AND '.join(f)} AND user_id = ANY(${len(up)}::bigint[]) GROUP BY DATE(created_at), user_id ORDER BY d", *up)
-        for r in rows:
-            d = r['d'].strftime("%Y-%m-%d")
-            if d not in data_map: data_map[d] = {"date": d, "total": 0}
-            data_map[d][str(r['user_id'])] = r['c']
-        u_rows = await pool.fetch("SELECT user_id, display_name, username, avatar_url FROM users WHERE user_id = ANY($1::bigint[])", ids_plist)
-        for r in u_rows: u_details[str(r['user_id'])] = {"name": r['display_name'], "username": r['username'], "avatar": r['avatar_url']}
-    res = {"chart_data": sorted(list(data_map.values()), key=lambda x: x['date']), "users": u_details, "top_user_id": str(top_u[0]['user_id']) if top_u else None}
-    set_cache(ckey, res, ttl=ttl)
-    return res
+    snapshot = is_snapshot_end_date(end_date, channel_id, user_id)
+    scope = await get_channel_scope_ids(channel_id)
+    gen = total_generation(end_date, scope)
+    cache_header = cache_control(ttl)
+
+    async def fill():
+        p = []
+        src = build_rollup_source(p, scope, until=end_date)
+        res = await build_history(p, src, user_id, columnar)
+        return await set_cache(ckey, res, ttl=ttl, generation=gen, snapshot=snapshot)
+    return encoded_response(request, await get_or_fill_cache(ckey, fill, gen, snapshot), cache_header)
+
+async def build_heatmap(params: List[Any], src: str):
+    rows = await pool.fetch(f"SELECT EXTRACT(DOW FROM r.jst_date) as dow, r.hour, sum(r.message_count) as count FROM {src} r GROUP BY dow, r.hour ORDER BY dow, r.hour", *params)
+    return [{"dow": int(r['dow']), "hour": int(r['hour']), "count": r['count']} for r in rows]
 
 @app.get("/stats/heatmap/{year}/{month}")
-async def get_monthly_heatmap(year: int, month: int, response: Response, channel_id: Optional[int] = Query(None)):
+async def get_monthly_heatmap(year: int, month: int, request: Request, channel_id: Optional[int] = Query(None)):
     ckey = f"heat_m_{year}_{month}_{channel_id}"
-    cached = get_cache(ckey)
-    response.headers["Cache-Control"] = "public, max-age=600"
-    if cached: return cached
-    start_date, end_date = get_month_bounds(year, month)
-    p = [start_date, end_date]; f = ["created_at >= $1", "created_at < $2", "is_bot = FALSE"]
-    add_channel_scope_filter(p, f, "channel_id", await get_channel_scope_ids(channel_id))
-    rows = await pool.fetch(f"SELECT EXTRACT(DOW FROM created_at AT TIME ZONE 'Asia/Tokyo') as dow, EXTRACT(HOUR FROM created_at AT TIME ZONE 'Asia/Tokyo') as hour, count(*) as count FROM messages WHERE {' AND '.join(f)} GROUP BY dow, hour ORDER BY dow, hour", *p)
-    res = [{"dow": int(r['dow']), "hour": int(r['hour']), "count": r['count']} for r in rows]
-    set_cache(ckey, res, ttl=600)
-    return res
+    ttl, max_age = month_cache_ttls(year, month)
+    snapshot = is_snapshot_month(year, month, channel_id)
+    scope = await get_channel_scope_ids(channel_id)
+    gen = month_generation(year, month, scope)
+    cache_header = cache_control(max_age)
+
+    async def fill():
+        start_date, end_date = get_month_bounds(year, month)
+        p = []
+        src = build_rollup_source(p, scope, start_date=start_date, end_date=end_date)
+        res = await build_heatmap(p, src)
+        return await set_cache(ckey, res, ttl=ttl, generation=gen, snapshot=snapshot)
+    return encoded_response(request, await get_or_fill_cache(ckey, fill, gen, snapshot), cache_header)
 
 @app.get("/stats/heatmap/total")
-async def get_total_heatmap(response: Response, channel_id: Optional[int] = Query(None), end_date: Optional[datetime] = Query(None)):
+async def get_total_heatmap(request: Request, channel_id: Optional[int] = Query(None), end_date: Optional[datetime] = Query(None)):
     ckey = f"heat_t_{channel_id}_{end_date}"
-    cached = get_cache(ckey)
     ttl = 86400 if end_date else LIVE_TOTAL_CACHE_TTL
-    response.headers["Cache-Control"] = f"public, max-age={ttl}"
-    if cached: return cached
-    p = []; f = ["is_bot = FALSE"]
-    add_channel_scope_filter(p, f, "channel_id", await get_channel_scope_ids(channel_id))
-    if end_date: p.append(end_date); f.append(f"created_at <= ${len(p)}")
-    rows = await pool.fetch(f"SELECT EXTRACT(DOW FROM created_at AT TIME ZONE 'Asia/Tokyo') as dow, EXTRACT(HOUR FROM created_at AT TIME ZONE 'Asia/Tokyo') as hour, count(*) as count FROM messages WHERE {' AND '.join(f)} GROUP BY dow, hour ORDER BY dow, hour", *p)
-    res = [{"dow": int(r['dow']), "hour": int(r['hour']), "count": r['count']} for r in rows]
-    set_cache(ckey, res, ttl=ttl)
-    return res
+    snapshot = is_snapshot_end_date(end_date, channel_id)
+    scope = await get_channel_scope_ids(channel_id)
+    gen = total_generation(end_date, scope)
+    cache_header = cache_control(ttl)
+
+    async def fill():
+        p = []
+        src = build_rollup_source(p, scope, until=end_date)
+        res = await build_heatmap(p, src)
+        return await set_cache(ckey, res, ttl=ttl, generation=gen, snapshot=snapshot)
+    return encoded_response(request, await get_or_fill_cache(ckey, fill, gen, snapshot), cache_header)
+
+CHANNEL_DISTRIBUTION_SQL = """
+    SELECT
+        CASE
+            WHEN c.category_id = ANY({categories_param}::bigint[]) THEN c.name
+            ELSE 'プラチャ'
+        END AS name,
+        sum(r.message_count) AS count
+    FROM {src} r
+    JOIN channels c ON r.channel_id = c.channel_id
+    GROUP BY 1
+    ORDER BY count DESC
+    LIMIT 10
+"""
+
+async def build_channel_distribution(params: List[Any], src: str):
+    params = params + [PRIVATE_CHAT_CATEGORY_IDS]
+    rows = await pool.fetch(CHANNEL_DISTRIBUTION_SQL.format(src=src, categories_param=f"${len(params)}"), *params)
+    return [{"name": r['name'], "value": r['count']} for r in rows]
 
 @app.get("/stats/channels_distribution/{year}/{month}")
-async def get_monthly_channel_distribution(year: int, month: int, response: Response):
+async def get_monthly_channel_distribution(year: int, month: int, request: Request):
     ckey = f"pie_m_{year}_{month}"
-    cached = get_cache(ckey)
-    response.headers["Cache-Control"] = "public, max-age=600"
-    if cached: return cached
-    start_date, end_date = get_month_bounds(year, month)
-    rows = await pool.fetch(
-        """
-        SELECT
-            CASE
-                WHEN c.category_id = ANY($3::bigint[]) THEN c.name
-                ELSE 'プラチャ'
-            END AS name,
-            count(*) AS count
-        FROM messages m
-        JOIN channels c ON m.channel_id = c.channel_id
-        WHERE m.created_at >= $1 AND m.created_at < $2 AND m.is_bot = FALSE
-        GROUP BY 1
-        ORDER BY count DESC
-        LIMIT 10
-        """,
-        start_date,
-        end_date,
-        PRIVATE_CHAT_CATEGORY_IDS,
-    )
-    res = [{"name": r['name'], "value": r['count']} for r in rows]
-    set_cache(ckey, res, ttl=600)
-    return res
+    ttl, max_age = month_cache_ttls(year, month)
+    snapshot = is_snapshot_month(year, month)
+    gen = month_generation(year, month)
+    cache_header = cache_control(max_age)
+
+    async def fill():
+        start_date, end_date = get_month_bounds(year, month)
+        p = []
+        src = build_rollup_source(p, start_date=start_date, end_date=end_date)
+        res = await build_channel_distribution(p, src)
+        return await set_cache(ckey, res, ttl=ttl, generation=gen, snapshot=snapshot)
+    return encoded_response(request, await get_or_fill_cache(ckey, fill, gen, snapshot), cache_header)
 
 @app.get("/stats/channels_distribution/total")
-async def get_total_channel_distribution(response: Response, end_date: Optional[datetime] = Query(None)):
+async def get_total_channel_distribution(request: Request, end_date: Optional[datetime] = Query(None)):
     ckey = f"pie_t_{end_date}"
-    cached = get_cache(ckey)
     ttl = 86400 if end_date else LIVE_TOTAL_CACHE_TTL
-    response.headers["Cache-Control"] = f"public, max-age={ttl}"
-    if cached: return cached
-    p = [PRIVATE_CHAT_CATEGORY_IDS]; f = ["m.is_bot = FALSE"]
-    if end_date: p.append(end_date); f.append(f"m.created_at <= ${len(p)}")
-    rows = await pool.fetch(
-        f"""
+    snapshot = is_snapshot_end_date(end_date)
+    gen = total_generation(end_date)
+    cache_header = cache_control(ttl)
+
+    async def fill():
+        p = []
+        src = build_rollup_source(p, until=end_date)
+        res = await build_channel_distribution(p, src)
+        return await set_cache(ckey, res, ttl=ttl, generation=gen, snapshot=snapshot)
+    return encoded_response(request, await get_or_fill_cache(ckey, fill, gen, snapshot), cache_header)
+
+ANALYSIS_SQL = """
+    WITH g AS (
         SELECT
-            CASE
-                WHEN c.category_id = ANY($1::bigint[]) THEN c.name
-                ELSE 'プラチャ'
-            END AS name,
-            count(*) AS count
-        FROM messages m
-        JOIN channels c ON m.channel_id = c.channel_id
-        WHERE {' AND '.join(f)}
-        GROUP BY 1
-        ORDER BY count DESC
-        LIMIT 10
-        """,
-        *p,
+            GROUPING(r.jst_date) AS g_date,
+            GROUPING(r.hour) AS g_hour,
+            GROUPING(r.user_id) AS g_user,
+            r.jst_date,
+            r.hour,
+            r.user_id,
+            sum(r.message_count) AS c
+        FROM {src} r
+        WHERE {where}
+        GROUP BY GROUPING SETS ((r.jst_date), (r.hour), (r.user_id), ())
     )
-    res = [{"name": r['name'], "value": r['count']} for r in rows]
-    set_cache(ckey, res, ttl=ttl)
-    return res
+    SELECT
+        COALESCE(t.c, 0) AS total,
+        uu.n AS unique_users,
+        d.jst_date AS d, d.c AS d_c,
+        w.dow, w.c AS w_c,
+        h.hour AS h, h.c AS h_c
+    FROM (SELECT c FROM g WHERE g_date = 1 AND g_hour = 1 AND g_user = 1) t
+    CROSS JOIN (SELECT count(*) AS n FROM g JOIN users u ON u.user_id = g.user_id WHERE g.g_user = 0 AND g.user_id <> ALL({excluded})) uu
+    LEFT JOIN LATERAL (SELECT jst_date, c FROM g WHERE g_date = 0 ORDER BY c DESC LIMIT 1) d ON TRUE
+    LEFT JOIN LATERAL (SELECT EXTRACT(DOW FROM jst_date) AS dow, sum(c)::bigint AS c FROM g WHERE g_date = 0 GROUP BY 1 ORDER BY c DESC LIMIT 1) w ON TRUE
+    LEFT JOIN LATERAL (SELECT hour, c FROM g WHERE g_hour = 0 ORDER BY c DESC LIMIT 1) h ON TRUE
+"""
+
+async def build_analysis(params: List[Any], src: str, user_id: Optional[str]):
+    # 合計・ユニークユーザー・最多日/曜日/時間を GROUPING SETS の1回の集計で求める
+    where = "TRUE"
+    if user_id and user_id.isdigit(): params = params + [int(user_id)]; where = f"r.user_id = ${len(params)}"
+    params = params[:]
+    excluded = add_excluded_users_param(params)
+    row = await pool.fetchrow(ANALYSIS_SQL.format(src=src, where=where, excluded=excluded), *params)
+    if not row or not row['total']: return {"total": 0}
+    return {"total": row['total'], "unique_users": row['unique_users'] or 0, "max_date": {"date": row['d'].strftime("%Y-%m-%d"), "count": row['d_c']} if row['d'] else None, "max_dow": {"dow": int(row['dow']), "count": row['w_c']} if row['dow'] is not None else None, "max_hour": {"hour": int(row['h']), "count": row['h_c']} if row['h'] is not None else None}
 
 @app.get("/stats/analysis/{year}/{month}")
-async def get_monthly_analysis(year: int, month: int, response: Response, channel_id: Optional[int] = Query(None), user_id: Optional[str] = Query(None)):
+async def get_monthly_analysis(year: int, month: int, request: Request, channel_id: Optional[int] = Query(None), user_id: Optional[str] = Query(None)):
     ckey = f"ana_m_{year}_{month}_{channel_id}_{user_id}"
-    cached = get_cache(ckey)
-    response.headers["Cache-Control"] = "public, max-age=600"
-    if cached: return cached
-    start_date, end_date = get_month_bounds(year, month)
-    p = [start_date, end_date]; f = ["created_at >= $1", "created_at < $2", "is_bot = FALSE"]
-    add_channel_scope_filter(p, f, "channel_id", await get_channel_scope_ids(channel_id))
-    if user_id and user_id.isdigit(): p.append(int(user_id)); f.append(f"user_id = ${len(p)}")
-    where = " AND ".join(f)
-    count = await pool.fetchrow(f"SELECT count(*) as total FROM messages WHERE {where}", *p)
-    if not count or count['total'] == 0: return {"total": 0}
-    unique_where = where.replace('channel_id', 'm.channel_id').replace('created_at', 'm.created_at').replace('is_bot', 'm.is_bot').replace('user_id', 'm.user_id')
-    unique_users = await pool.fetchval(
-        f"""
-        SELECT count(DISTINCT m.user_id)
-        FROM messages m
-        LEFT JOIN users u ON m.user_id = u.user_id
-        WHERE {unique_where}
-          AND {DELETED_USER_FILTER}
-        """,
-        *p,
-    )
-    max_d = await pool.fetchrow(f"SELECT DATE(created_at AT TIME ZONE 'Asia/Tokyo') as d, count(*) as c FROM messages WHERE {where} GROUP BY d ORDER BY c DESC LIMIT 1", *p)
-    max_w = await pool.fetchrow(f"SELECT EXTRACT(DOW FROM created_at AT TIME ZONE 'Asia/Tokyo') as dow, count(*) as c FROM messages WHERE {where} GROUP BY dow ORDER BY c DESC LIMIT 1", *p)
-    max_h = await pool.fetchrow(f"SELECT EXTRACT(HOUR FROM created_at AT TIME ZONE 'Asia/Tokyo') as h, count(*) as c FROM messages WHERE {where} GROUP BY h ORDER BY c DESC LIMIT 1", *p)
-    res = {"total": count['total'], "unique_users": unique_users or 0, "max_date": {"date": max_d['d'].strftime("%Y-%m-%d"), "count": max_d['c']} if max_d else None, "max_dow": {"dow": int(max_w['dow']), "count": max_w['c']} if max_w else None, "max_hour": {"hour": int(max_h['h']), "count": max_h['c']} if max_h else None}
-    set_cache(ckey, res, ttl=600)
-    return res
+    ttl, max_age = month_cache_ttls(year, month)
+    snapshot = is_snapshot_month(year, month, channel_id, user_id)
+    scope = await get_channel_scope_ids(channel_id)
+    gen = month_generation(year, month, scope)
+    cache_header = cache_control(max_age)
+
+    async def fill():
+        start_date, end_date = get_month_bounds(year, month)
+        p = []
+        src = build_rollup_source(p, scope, start_date=start_date, end_date=end_date)
+        res = await build_analysis(p, src, user_id)
+        if res["total"] == 0: return encode_body(res)
+        return await set_cache(ckey, res, ttl=ttl, generation=gen, snapshot=snapshot)
+    return encoded_response(request, await get_or_fill_cache(ckey, fill, gen, snapshot), cache_header)
 
 @app.get("/stats/analysis/total")
-async def get_total_analysis(response: Response, channel_id: Optional[int] = Query(None), user_id: Optional[str] = Query(None), end_date: Optional[datetime] = Query(None)):
+async def get_total_analysis(request: Request, channel_id: Optional[int] = Query(None), user_id: Optional[str] = Query(None), end_date: Optional[datetime] = Query(None)):
     ckey = f"ana_t_{channel_id}_{user_id}_{end_date}"
-    cached = get_cache(ckey)
     ttl = 86400 if end_date else LIVE_TOTAL_CACHE_TTL
-    response.headers["Cache-Control"] = f"public, max-age={ttl}"
-    if cached: return cached
-    p = []; f = ["is_bot = FALSE"]
-    add_channel_scope_filter(p, f, "channel_id", await get_channel_scope_ids(channel_id))
-    if user_id and user_id.isdigit(): p.append(int(user_id)); f.append(f"user_id = ${len(p)}")
-    if end_date: p.append(end_date); f.append(f"created_at <= ${len(p)}")
-    where = " AND ".join(f)
-    count = await pool.fetchrow(f"SELECT count(*) as total FROM messages WHERE {where}", *p)
-    if not count or count['total'] == 0: return {"total": 0}
-    unique_where = where.replace('channel_id', 'm.channel_id').replace('created_at', 'm.created_at').replace('is_bot', 'm.is_bot').replace('user_id', 'm.user_id')
-    unique_users = await pool.fetchval(
-        f"""
-        SELECT count(DISTINCT m.user_id)
-        FROM messages m
-        LEFT JOIN users u ON m.user_id = u.user_id
-        WHERE {unique_where}
-          AND {DELETED_USER_FILTER}
-        """,
-        *p,
+    snapshot = is_snapshot_end_date(end_date, channel_id, user_id)
+    scope = await get_channel_scope_ids(channel_id)
+    gen = total_generation(end_date, scope)
+    cache_header = cache_control(ttl)
+
+    async def fill():
+        p = []
+        src = build_rollup_source(p, scope, until=end_date)
+        res = await build_analysis(p, src, user_id)
+        if res["total"] == 0: return encode_body(res)
+        return await set_cache(ckey, res, ttl=ttl, generation=gen, snapshot=snapshot)
+    return encoded_response(request, await get_or_fill_cache(ckey, fill, gen, snapshot), cache_header)
+
+async def build_dashboard(params: List[Any], src: str, dist_params: List[Any], dist_src: Optional[str]):
+    # ダッシュボード1画面分を並行に集計する (各クエリは別々のプール接続で走る)。
+    # 閲覧者ごとに変わらないよう user_id は取らず、推移は上位ユーザーの分だけ。特定ユーザーの推移は /stats/history で引く
+    ranking, history, heatmap, analysis, distribution = await asyncio.gather(
+        build_ranking(params, src),
+        build_history(params, src, None),
+        build_heatmap(params, src),
+        build_analysis(params, src, None),
+        build_channel_distribution(dist_params, dist_src) if dist_src else asyncio.sleep(0, result=None),
     )
-    max_d = await pool.fetchrow(f"SELECT DATE(created_at AT TIME ZONE 'Asia/Tokyo') as d, count(*) as c FROM messages WHERE {where} GROUP BY d ORDER BY c DESC LIMIT 1", *p)
-    max_w = await pool.fetchrow(f"SELECT EXTRACT(DOW FROM created_at AT TIME ZONE 'Asia/Tokyo') as dow, count(*) as c FROM messages WHERE {where} GROUP BY dow ORDER BY c DESC LIMIT 1", *p)
-    max_h = await pool.fetchrow(f"SELECT EXTRACT(HOUR FROM created_at AT TIME ZONE 'Asia/Tokyo') as h, count(*) as c FROM messages WHERE {where} GROUP BY h ORDER BY c DESC LIMIT 1", *p)
-    res = {"total": count['total'], "unique_users": unique_users or 0, "max_date": {"date": max_d['d'].strftime("%Y-%m-%d"), "count": max_d['c']} if max_d else None, "max_dow": {"dow": int(max_w['dow']), "count": max_w['c']} if max_w else None, "max_hour": {"hour": int(max_h['h']), "count": max_h['c']} if max_h else None}
-    set_cache(ckey, res, ttl=ttl)
-    return res
+    return {"ranking": ranking, "history": history, "heatmap": heatmap, "analysis": analysis, "channels_distribution": distribution}
+
+@app.get("/dashboard/{year}/{month}")
+async def get_monthly_dashboard(year: int, month: int, request: Request, channel_id: Optional[int] = Query(None)):
+    ckey = f"dash_m_{year}_{month}_{channel_id}"
+    ttl, max_age = month_cache_ttls(year, month)
+    snapshot = is_snapshot_month(year, month, channel_id)
+    scope = await get_channel_scope_ids(channel_id)
+    gen = month_generation(year, month, scope)
+    cache_header = cache_control(max_age)
+
+    async def fill():
+        start_date, end_date = get_month_bounds(year, month)
+        p = []
+        src = build_rollup_source(p, scope, start_date=start_date, end_date=end_date)
+        dist_p = []
+        dist_src = None if channel_id else build_rollup_source(dist_p, start_date=start_date, end_date=end_date)
+        res = await build_dashboard(p, src, dist_p, dist_src)
+        return await set_cache(ckey, res, ttl=ttl, generation=gen, snapshot=snapshot)
+    return encoded_response(request, await get_or_fill_cache(ckey, fill, gen, snapshot), cache_header)
+
+@app.get("/dashboard/total")
+async def get_total_dashboard(request: Request, channel_id: Optional[int] = Query(None), end_date: Optional[datetime] = Query(None)):
+    ckey = f"dash_t_{channel_id}_{end_date}"
+    ttl = 86400 if end_date else LIVE_TOTAL_CACHE_TTL
+    snapshot = is_snapshot_end_date(end_date, channel_id)
+    scope = await get_channel_scope_ids(channel_id)
+    gen = total_generation(end_date, scope)
+    cache_header = cache_control(ttl)
+
+    async def fill():
+        p = []
+        src = build_rollup_source(p, scope, until=end_date)
+        dist_p = []
+        dist_src = None if channel_id else build_rollup_source(dist_p, until=end_date)
+        res = await build_dashboard(p, src, dist_p, dist_src)
+        return await set_cache(ckey, res, ttl=ttl, generation=gen, snapshot=snapshot)
+    return encoded_response(request, await get_or_fill_cache(ckey, fill, gen, snapshot), cache_header)
+
+# ウォーマーは条件付きヘッダーを持たない素のリクエストとしてエンドポイントを呼ぶ
+WARMER_REQUEST = Request({"type": "http", "method": "GET", "path": "/", "headers": []})
 
 async def warm_total_cache_once():
     if not pool:
         return
 
     warmers = [
-        ("ranking_total", lambda: get_total_ranking(Response(), channel_id=None, end_date=None)),
-        ("history_total", lambda: get_total_history(Response(), channel_id=None, user_id=None, end_date=None)),
-        ("heatmap_total", lambda: get_total_heatmap(Response(), channel_id=None, end_date=None)),
-        ("channels_total", lambda: get_total_channel_distribution(Response(), end_date=None)),
-        ("analysis_total", lambda: get_total_analysis(Response(), channel_id=None, user_id=None, end_date=None)),
+        ("ranking_total", lambda: get_total_ranking(WARMER_REQUEST, channel_id=None, end_date=None)),
+        ("history_total", lambda: get_total_history(WARMER_REQUEST, channel_id=None, user_id=None, end_date=None, format=None)),
+        ("heatmap_total", lambda: get_total_heatmap(WARMER_REQUEST, channel_id=None, end_date=None)),
+        ("channels_total", lambda: get_total_channel_distribution(WARMER_REQUEST, end_date=None)),
+        ("analysis_total", lambda: get_total_analysis(WARMER_REQUEST, channel_id=None, user_id=None, end_date=None)),
+        ("dashboard_total", lambda: get_total_dashboard(WARMER_REQUEST, channel_id=None, end_date=None)),
     ]
 
     for name, warmer in warmers:
         started = time.perf_counter()
         try:
             await warmer()
-            elapsed_ms = int((time.perf_counter() - started) * 1000)
-            logger.info(f"Warmed cache: {name} ({elapsed_ms}ms)")
+            elapsed = time.perf_counter() - started
+            warmer_duration.observe(elapsed, name)
+            logger.info(f"Warmed cache: {name} ({int(elapsed * 1000)}ms)")
         except Exception:
+            warmer_failures.inc(name)
             logger.warning(f"Failed to warm cache: {name}", exc_info=True)
 
 async def warm_total_cache_loop():
@@ -822,6 +1510,186 @@ async def warm_total_cache_loop():
         await warm_total_cache_once()
         await asyncio.sleep(TOTAL_CACHE_WARM_INTERVAL)
 
+async def close_month(year: int, month: int) -> bool:
+    # 締まった月の全体の集計をスナップショットに入れる。世代が変わっていれば裏で再集計されるので、それも待つ
+    closers = [
+        ("ranking", lambda: get_monthly_ranking(year, month, WARMER_REQUEST, channel_id=None, after_rank=None, cursor=None, limit=None)),
+        ("history", lambda: get_daily_history(year, month, WARMER_REQUEST, channel_id=None, user_id=None, format=None)),
+        ("heatmap", lambda: get_monthly_heatmap(year, month, WARMER_REQUEST, channel_id=None)),
+        ("channels", lambda: get_monthly_channel_distribution(year, month, WARMER_REQUEST)),
+        ("analysis", lambda: get_monthly_analysis(year, month, WARMER_REQUEST, channel_id=None, user_id=None)),
+        ("dashboard", lambda: get_monthly_dashboard(year, month, WARMER_REQUEST, channel_id=None)),
+    ]
+    ok = True
+    for name, closer in closers:
+        try:
+            await closer()
+        except Exception:
+            ok = False
+            logger.warning(f"Failed to close month: {name} {month_key(year, month)}", exc_info=True)
+    await cache_fills.wait_all()
+    return ok
+
+async def month_close_loop():
+    # 起動時は全ての締まった月を、その後は世代が変わった月 (締めた後に書き込み・削除があった月) だけを締め直す
+    # 締めるたびに、書き直されて指されなくなったスナップショットのボディを片付ける
+    await asyncio.sleep(30)
+    closed_generations: Dict[str, int] = {}
+    while True:
+        try:
+            first = await reload_first_data_month()
+            if first:
+                today = datetime.now(JST).date()
+                year, month = first.year, first.month
+                while (year, month) < (today.year, today.month):
+                    key = month_key(year, month)
+                    gen = month_generation(year, month)
+                    if closed_generations.get(key) != gen:
+                        started = time.perf_counter()
+                        if await close_month(year, month):
+                            closed_generations[key] = gen
+                        logger.info(f"Closed month: {key} ({int((time.perf_counter() - started) * 1000)}ms)")
+                    year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+            removed = await asyncio.to_thread(snapshots.prune, SNAPSHOT_PRUNE_GRACE)
+            if removed:
+                logger.info(f"Pruned {removed} unreferenced snapshot files.")
+        except Exception:
+            logger.warning("Month close job failed", exc_info=True)
+        await asyncio.sleep(MONTH_CLOSE_INTERVAL)
+
+# 一括エクスポート (Bot の API キー専用)。期間を EXPORT_PAGE_DAYS 日ずつに区切り、その中を (日付, ID) の順に
+# EXPORT_BATCH_SIZE 行ずつ別の文で読んで流す。手元に持つのは1文分の行 (と、それを整形した文字列) だけ。
+# 枠と接続を持つのは1文を読む間だけなので、読むのが遅い・止まったクライアントがいても重い集計の枠やプールは塞がらない
+EXPORT_BATCH_SIZE = 5000
+EXPORT_PAGE_DAYS = int(os.getenv("EXPORT_PAGE_DAYS", "31"))
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+USER_DAILY_EXPORT_SQL = """
+    SELECT r.jst_date AS date, r.user_id, sum(r.message_count)::bigint AS count, sum(r.char_count)::bigint AS char_count
+    FROM {src} r
+    WHERE {where}
+    GROUP BY r.jst_date, r.user_id
+    ORDER BY r.jst_date, r.user_id
+    LIMIT {limit}
+"""
+
+CHANNEL_DAILY_EXPORT_SQL = """
+    SELECT r.jst_date AS date, r.channel_id, sum(r.message_count)::bigint AS count, sum(r.char_count)::bigint AS char_count
+    FROM {src} r
+    WHERE {where}
+    GROUP BY r.jst_date, r.channel_id
+    ORDER BY r.jst_date, r.channel_id
+    LIMIT {limit}
+"""
+
+def require_api_key(request: Request) -> None:
+    if request.headers.get("x-api-key") != API_SECRET:
+        raise HTTPException(status_code=401, detail="API key required.")
+
+def export_range(start_date: Optional[date], end_date: Optional[date]) -> Tuple[Optional[date], Optional[date]]:
+    # end_date はその日を含む。集計元には翌日 (含まない) で渡す
+    if start_date and end_date and start_date > end_date:
+        raise HTTPException(status_code=400, detail="start_date must not be after end_date")
+    return start_date, end_date + timedelta(days=1) if end_date else None
+
+def add_export_after(params: List[Any], where: List[str], key: str, after: Optional[Tuple[date, int]]) -> None:
+    # 前の文で読んだ最後の (日付, ID) より後だけを読む。集計のキーと同じ列で絞るので、グループが途中で切れることは無い
+    if after:
+        params.extend(after)
+        where.append(f"(r.jst_date, r.{key}) > (${len(params) - 1}::date, ${len(params)}::bigint)")
+
+def format_export_rows(rows: List[asyncpg.Record], columns: List[str], fmt: str) -> str:
+    # ID は JSON の数値だと精度が落ちるので、他の API と同じく文字列で返す
+    if fmt == "csv":
+        return "".join(",".join(str(r[c]) for c in columns) + "\n" for r in rows)
+    return "".join(json.dumps({c: r[c].isoformat() if c == "date" else str(r[c]) if c.endswith("_id") else r[c] for c in columns}) + "\n" for r in rows)
+
+def export_response(build, start: Optional[date], end: Optional[date], columns: List[str], fmt: str, filename: str) -> StreamingResponse:
+    # build(開始日, 終了日 (含まない), 前の文の最後の (日付, ID)) → (SQL, 引数)。文ごとに別に読むので、文をまたいだ一貫性は無い (キーで分かれるので重ならない)。
+    # 応答を返し始めてからは 503 にできないので、混んでいればここで断る
+    heavy_queries.check()
+
+    async def stream():
+        if fmt == "csv":
+            yield ",".join(columns) + "\n"
+        page_start, page_end = start, end
+        if page_start is None or page_end is None:
+            # 指定の無い側は集計元にある日付の端までにする
+            async with heavy_queries.slot():
+                bounds = await pool.fetchrow("SELECT min(jst_date) AS first_date, max(jst_date) AS last_date FROM message_rollups")
+            if bounds["first_date"] is None:
+                return
+            page_start = page_start or bounds["first_date"]
+            page_end = page_end or bounds["last_date"] + timedelta(days=1)
+        key = columns[1]
+        after = None
+        while page_start < page_end:
+            window_end = min(page_start + timedelta(days=EXPORT_PAGE_DAYS), page_end)
+            query, params = build(page_start, window_end, after)
+            async with heavy_queries.slot():
+                rows = await pool.fetch(query, *params)
+            if rows:
+                yield format_export_rows(rows, columns, fmt)
+            if len(rows) < EXPORT_BATCH_SIZE:
+                page_start, after = window_end, None
+            else:
+                # 続きは最後の行の日付から読み直す (その日の残りと、区切りの終わりまで)
+                after = (rows[-1]["date"], rows[-1][key])
+                page_start = after[0]
+
+    return StreamingResponse(
+        stream(),
+        media_type=EXPORT_FORMATS[fmt],
+        headers={"Cache-Control": "no-store", "Content-Disposition": f'attachment; filename="{filename}.{fmt}"'},
+    )
+
+@app.get("/export/users/daily")
+async def export_user_daily(
+    request: Request,
+    start_date: Optional[date] = Query(None),
+    end_date: Optional[date] = Query(None),
+    channel_id: Optional[int] = Query(None),
+    user_id: Optional[List[int]] = Query(None),
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+):
+    require_api_key(request)
+    start, end = export_range(start_date, end_date)
+    scope = await get_channel_scope_ids(channel_id)
+
+    def build(page_start: date, page_end: date, after: Optional[Tuple[date, int]]) -> Tuple[str, List[Any]]:
+        params: List[Any] = []
+        src = build_rollup_source(params, scope, page_start, page_end)
+        where = [f"r.user_id <> ALL({add_excluded_users_param(params)})"]
+        if user_id:
+            params.append(user_id)
+            where.append(f"r.user_id = ANY(${len(params)}::bigint[])")
+        add_export_after(params, where, "user_id", after)
+        return USER_DAILY_EXPORT_SQL.format(src=src, where=" AND ".join(where), limit=EXPORT_BATCH_SIZE), params
+    return export_response(build, start, end, ["date", "user_id", "count", "char_count"], format, "user_daily")
+
+@app.get("/export/channels/daily")
+async def export_channel_daily(
+    request: Request,
+    start_date: Optional[date] = Query(None),
+    end_date: Optional[date] = Query(None),
+    channel_id: Optional[int] = Query(None),
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+):
+    require_api_key(request)
+    start, end = export_range(start_date, end_date)
+    scope = await get_channel_scope_ids(channel_id)
+
+    def build(page_start: date, page_end: date, after: Optional[Tuple[date, int]]) -> Tuple[str, List[Any]]:
+        params: List[Any] = []
+        src = build_rollup_source(params, scope, page_start, page_end)
+        where = ["TRUE"]
+        add_export_after(params, where, "channel_id", after)
+        return CHANNEL_DAILY_EXPORT_SQL.format(src=src, where=" AND ".join(where), limit=EXPORT_BATCH_SIZE), params
+    return export_response(build, start, end, ["date", "channel_id", "count", "char_count"], format, "channel_daily")
+
 @app.get("/debug/db")
 async def debug_db():
     if not pool:
@@ -861,20 +1729,41 @@ async def debug_db():
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    require_api_key(request)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/debug/slow-queries")
+async def debug_slow_queries(request: Request):
+    # 引数にユーザー ID などが入るので Bot の API キー専用
+    require_api_key(request)
+    return {"threshold_ms": slow_queries.threshold * 1000, "entries": slow_queries.snapshot()}
+
+@app.get("/debug/admission")
+async def debug_admission():
+    # クエリの種類ごとの実行中・待ち行列の数 (上限の調整用)
+    return {q.name: q.stats() for q in (heavy_queries, light_queries)}
+
+@app.get("/debug/cancellations")
+async def debug_cancellations():
+    # 切断・締め切りで取り消した数と、取り消した集計がそれまでに使っていた時間
+    return {
+        **cancellation_stats,
+        "fills_cancelled": cache_fills.cancelled,
+        "fills_cancelled_seconds": round(cache_fills.cancelled_seconds, 3),
+    }
+
 @app.get("/debug/clear-cache")
 async def clear_app_cache():
     cache.clear()
+    l1_cache.clear()
+    rank_tables.clear()
     return {"status": "cache cleared"}
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=ALLOWED_ORIGINS,
-    allow_origin_regex=r"https://.*\.ymkw\.top|https://.*\.pages\.dev",
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-    expose_headers=["X-Debug-Block"],
-)
+app.add_middleware(DisconnectMiddleware)
+app.add_middleware(SecurityMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,107 @@
+import asyncio
+import pickle
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+MISS = object()
+
+class MemoryCache:
+    # プロセス内のLRU。1エントリの上限 (max_item_bytes) を超える値は保持しない
+    def __init__(self, max_bytes: int, max_item_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.total_bytes = 0
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key: str) -> Any:
+        entry = self.entries.get(key)
+        if entry is None:
+            return MISS
+        expire_at, _, value = entry
+        if expire_at is not None and expire_at <= time.time():
+            self.delete(key)
+            return MISS
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, expire_at: Optional[float], size: Optional[int] = None) -> None:
+        if size is None:
+            size = estimate_size(value)
+        self.delete(key)
+        if size > self.max_item_bytes:
+            return
+        self.entries[key] = (expire_at, size, value)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes and self.entries:
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+
+    def delete(self, key: str) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.total_bytes = 0
+
+def estimate_size(value: Any) -> int:
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+class SingleFlight:
+    # 同じキーの同時ミスを1回の取得にまとめる。取得は別タスクで走るため、
+    # 最初に来たリクエストが切断されても待っている他のリクエストには結果が届く。
+    # ミスで始めた取得 (run) は、待っているリクエストが cancel_grace 秒いなくなったら取り消す
+    # (すぐ来る再試行はそのまま合流させる)。stale を返しつつの裏の再集計 (start) は取り消さない
+    def __init__(self, cancel_grace: float = 0.0):
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.cancel_grace = cancel_grace
+        self.waiters: Dict[asyncio.Future, int] = {}
+        self.started_at: Dict[asyncio.Future, float] = {}
+        self.cancelled = 0
+        self.cancelled_seconds = 0.0
+
+    def start(self, key: str, fn: Callable[[], Awaitable[Any]], on_demand: bool = False) -> asyncio.Future:
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self.inflight[key] = task
+            if on_demand:
+                self.waiters[task] = 0
+                self.started_at[task] = time.monotonic()
+            task.add_done_callback(lambda t: self._finish(key, t))
+        return task
+
+    async def run(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self.start(key, fn, on_demand=True)
+        if task not in self.waiters:
+            return await asyncio.shield(task)
+        self.waiters[task] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if task in self.waiters:
+                self.waiters[task] -= 1
+                if self.waiters[task] == 0 and not task.done():
+                    asyncio.get_running_loop().call_later(self.cancel_grace, self._cancel_if_unwanted, task)
+
+    async def wait_all(self) -> None:
+        # いま走っている取得がすべて終わるまで待つ (まとめて再集計するジョブが DB に一度に投げすぎないように)
+        if self.inflight:
+            await asyncio.wait(list(self.inflight.values()))
+
+    def _cancel_if_unwanted(self, task: asyncio.Future) -> None:
+        if task.done() or self.waiters.get(task) != 0:
+            return
+        task.cancel()
+        self.cancelled += 1
+        self.cancelled_seconds += time.monotonic() - self.started_at[task]
+
+    def _finish(self, key: str, task: asyncio.Future) -> None:
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        self.waiters.pop(task, None)
+        self.started_at.pop(task, None)
+        if not task.cancelled():
+            task.exception()
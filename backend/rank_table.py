@@ -0,0 +1,52 @@
+from bisect import bisect_left, bisect_right
+from typing import Iterable, Optional
+
+# 1ユーザーあたりの大まかなメモリ量 (MemoryCache のサイズ計算用)
+BYTES_PER_USER = 160
+
+class RankTable:
+    # ある (期間, チャンネル範囲) の全ユーザーの発言数を多い順に並べたもの。
+    # 順位は「自分より多いユーザー数 + 1」なので、符号を反転した昇順配列の二分探索で求まる
+    __slots__ = ("user_ids", "counts", "chars", "profiles", "positions", "neg_counts", "generation", "fresh_until")
+
+    def __init__(self, rows: Iterable, generation: Optional[int], fresh_until: float):
+        rows = sorted(rows, key=lambda r: (-r["c"], r["user_id"]))
+        self.user_ids = [r["user_id"] for r in rows]
+        self.counts = [r["c"] for r in rows]
+        self.chars = [r["chars"] for r in rows]
+        self.profiles = [(r["display_name"], r["username"], r["avatar_url"]) for r in rows]
+        self.positions = {user_id: i for i, user_id in enumerate(self.user_ids)}
+        self.neg_counts = [-c for c in self.counts]
+        self.generation = generation
+        self.fresh_until = fresh_until
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def size(self) -> int:
+        return len(self.user_ids) * BYTES_PER_USER
+
+    def rank_of(self, count: int) -> int:
+        return bisect_left(self.neg_counts, -count) + 1
+
+    def position_after(self, count: int, user_id: int) -> int:
+        # (発言数の多い順, user_id の昇順) で (count, user_id) より後ろの最初の位置 (キーセット方式のページング用)
+        lo = bisect_left(self.neg_counts, -count)
+        hi = bisect_right(self.neg_counts, -count, lo)
+        return bisect_right(self.user_ids, user_id, lo, hi)
+
+    def entry(self, i: int) -> dict:
+        display_name, username, avatar_url = self.profiles[i]
+        return {
+            "user_id": self.user_ids[i],
+            "c": self.counts[i],
+            "chars": self.chars[i],
+            "display_name": display_name,
+            "username": username,
+            "avatar_url": avatar_url,
+            "rank": self.rank_of(self.counts[i]),
+        }
+
+    def lookup(self, user_id: int) -> Optional[dict]:
+        i = self.positions.get(user_id)
+        return self.entry(i) if i is not None else None
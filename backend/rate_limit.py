@@ -0,0 +1,177 @@
+import asyncio
+import time
+import zlib
+from typing import Dict, List, Set, Tuple
+
+import diskcache
+
+class MemoryRateLimiter:
+    # プロセス内のトークンバケット。イベントループ上でだけ触るのでロックは要らない。
+    # シャードに分けてあるのは、期限切れの掃除を1シャードずつ少しずつ行うため
+    def __init__(self, shards: int = 64):
+        self.shards: List[Dict[str, list]] = [{} for _ in range(shards)]
+        self.blocks: List[Dict[str, float]] = [{} for _ in range(shards)]
+        self.next_shard = 0
+
+    def _shard(self, key: str) -> int:
+        return zlib.crc32(key.encode()) % len(self.shards)
+
+    def hit(self, key: str, limit: int, window: int) -> bool:
+        # window 秒あたり limit 回まで (最大 limit 回のバースト)
+        now = time.monotonic()
+        rate = limit / window
+        shard = self.shards[self._shard(key)]
+        bucket = shard.get(key)
+        if bucket is None:
+            tokens = limit
+        else:
+            tokens = min(limit, bucket[0] + (now - bucket[1]) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        # [残りトークン, 更新時刻, 満タンに戻る時刻]
+        shard[key] = [tokens, now, now + (limit - tokens) / rate]
+        return allowed
+
+    def block(self, key: str, duration: int) -> None:
+        self.blocks[self._shard(key)][key] = time.monotonic() + duration
+
+    def is_blocked(self, key: str) -> bool:
+        blocks = self.blocks[self._shard(key)]
+        until = blocks.get(key)
+        if until is None:
+            return False
+        if until <= time.monotonic():
+            del blocks[key]
+            return False
+        return True
+
+    def sweep(self) -> int:
+        # 満タンに戻ったバケットと期限切れのブロックを1シャード分だけ消す
+        index = self.next_shard
+        self.next_shard = (index + 1) % len(self.shards)
+        now = time.monotonic()
+        shard = self.shards[index]
+        blocks = self.blocks[index]
+        expired = [k for k, b in shard.items() if b[2] <= now]
+        for k in expired:
+            del shard[k]
+        expired_blocks = [k for k, until in blocks.items() if until <= now]
+        for k in expired_blocks:
+            del blocks[k]
+        return len(expired) + len(expired_blocks)
+
+    def clear(self) -> None:
+        for shard in self.shards:
+            shard.clear()
+        for blocks in self.blocks:
+            blocks.clear()
+
+class SharedRateLimiter:
+    # 複数の uvicorn ワーカーで1つの制限を共有する版。リクエストごとの判定は手元の MemoryRateLimiter と、
+    # 前回の sync で共有の diskcache から知った状態だけで行い (イベントループで SQLite を触らない)、
+    # 数えた分とブロックは sync でまとめて別スレッドから書き出す。共有側は直前と現在の固定窓を重み付けした
+    # スライディングウィンドウで数える。sync の間隔の分だけ、全ワーカー合わせて制限を少し超えて通すことがある
+    def __init__(self, directory: str):
+        self.cache = diskcache.Cache(directory)
+        self.local = MemoryRateLimiter()
+        # sync を待っている分 (ループ上でだけ触り、sync のときに丸ごと差し替える)
+        self.pending: Dict[str, list] = {}
+        self.pending_blocks: Dict[str, float] = {}
+        self.checked: Set[str] = set()
+        # 共有の数えで制限を超えたキー → その窓が終わる時刻 (time.monotonic)
+        self.exceeded: Dict[str, float] = {}
+
+    def hit(self, key: str, limit: int, window: int) -> bool:
+        until = self.exceeded.get(key)
+        if until is not None:
+            if until > time.monotonic():
+                return False
+            del self.exceeded[key]
+        if not self.local.hit(key, limit, window):
+            return False
+        # [まだ書き出していない回数, limit, window]
+        entry = self.pending.get(key)
+        if entry is None:
+            self.pending[key] = [1, limit, window]
+        else:
+            entry[0] += 1
+        return True
+
+    def block(self, key: str, duration: int) -> None:
+        self.local.block(key, duration)
+        self.pending_blocks[key] = time.time() + duration
+
+    def is_blocked(self, key: str) -> bool:
+        if self.local.is_blocked(key):
+            return True
+        # 他のワーカーがブロックしていないかは次の sync で確かめる
+        self.checked.add(key)
+        return False
+
+    async def sync(self) -> None:
+        pending, self.pending = self.pending, {}
+        blocks, self.pending_blocks = self.pending_blocks, {}
+        checked, self.checked = self.checked, set()
+        if not (pending or blocks or checked):
+            return
+        try:
+            exceeded, blocked = await asyncio.to_thread(self._push, pending, blocks, checked)
+        except Exception:
+            # 書き出せなかった分は次の sync に回す
+            for key, (count, limit, window) in pending.items():
+                entry = self.pending.setdefault(key, [0, limit, window])
+                entry[0] += count
+            for key, until in blocks.items():
+                self.pending_blocks.setdefault(key, until)
+            self.checked |= checked
+            raise
+        now = time.monotonic()
+        for key, remaining in exceeded.items():
+            self.exceeded[key] = now + remaining
+        for key, remaining in blocked.items():
+            self.local.block(key, remaining)
+
+    def _push(self, pending: Dict[str, list], blocks: Dict[str, float], checked: Set[str]) -> Tuple[Dict[str, float], Dict[str, float]]:
+        # 別スレッドで、1つのトランザクションでまとめて書き出す。
+        # 返すのは (制限を超えたキー → 窓の残り秒数, 他のワーカーがブロックしたキー → 残り秒数)
+        now = time.time()
+        exceeded: Dict[str, float] = {}
+        blocked: Dict[str, float] = {}
+        with self.cache.transact():
+            for key, (count, limit, window) in pending.items():
+                slot = int(now // window)
+                elapsed = (now - slot * window) / window
+                current_key = f"rate:{key}:{slot}"
+                previous = self.cache.get(f"rate:{key}:{slot - 1}", 0)
+                current = self.cache.get(current_key, 0) + count
+                self.cache.set(current_key, current, expire=window * 2)
+                if previous * (1 - elapsed) + current > limit:
+                    exceeded[key] = (slot + 1) * window - now
+            for key, until in blocks.items():
+                if until > now:
+                    self.cache.set(f"blocked:{key}", True, expire=until - now)
+            for key in checked - blocks.keys():
+                value, expire_at = self.cache.get(f"blocked:{key}", expire_time=True)
+                if value and expire_at and expire_at > now:
+                    blocked[key] = expire_at - now
+        return exceeded, blocked
+
+    def sweep(self) -> int:
+        now = time.monotonic()
+        expired = [k for k, until in self.exceeded.items() if until <= now]
+        for k in expired:
+            del self.exceeded[k]
+        return self.local.sweep() + len(expired)
+
+    def expire(self) -> int:
+        # 共有の diskcache の期限切れを消す (全体を読むので、別スレッドでたまにだけ呼ぶ)
+        return self.cache.expire()
+
+    def clear(self) -> None:
+        self.local.clear()
+        self.pending.clear()
+        self.pending_blocks.clear()
+        self.checked.clear()
+        self.exceeded.clear()
+        self.cache.clear()
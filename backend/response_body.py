@@ -0,0 +1,70 @@
+import gzip
+import hashlib
+import json
+from typing import Any, Optional
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# これより小さいボディは圧縮しない
+MIN_COMPRESS_BYTES = 512
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 6
+
+class EncodedBody:
+    # キャッシュに入れる JSON ボディ。ETag と圧縮済みの版は集計時に1回だけ作る
+    __slots__ = ("body", "etag", "gzip", "br")
+
+    def __init__(self, body: bytes, etag: str, gzip: Optional[bytes] = None, br: Optional[bytes] = None):
+        self.body = body
+        self.etag = etag
+        self.gzip = gzip
+        self.br = br
+
+def encode_body(data: Any) -> EncodedBody:
+    # FastAPI の JSONResponse と同じ形式で直列化する
+    body = json.dumps(data, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+    etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+    if len(body) < MIN_COMPRESS_BYTES:
+        return EncodedBody(body, etag)
+    gzipped = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    br = brotli.compress(body, quality=BROTLI_QUALITY) if brotli else None
+    return EncodedBody(body, etag, gzipped, br)
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag == etag or tag == "W/" + etag:
+            return True
+    return False
+
+def accepts_encoding(accept_encoding: str, encoding: str) -> bool:
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        if name.strip().lower() == encoding:
+            return params.replace(" ", "").lower() not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+def encoded_response(request: Request, encoded: EncodedBody, cache_control: Optional[str] = None) -> Response:
+    headers = {"ETag": encoded.etag, "Vary": "Accept-Encoding"}
+    if cache_control:
+        headers["Cache-Control"] = cache_control
+    if etag_matches(request.headers.get("if-none-match"), encoded.etag):
+        return Response(status_code=304, headers=headers)
+
+    accept_encoding = request.headers.get("accept-encoding", "")
+    body = encoded.body
+    if encoded.br is not None and accepts_encoding(accept_encoding, "br"):
+        body = encoded.br
+        headers["Content-Encoding"] = "br"
+    elif encoded.gzip is not None and accepts_encoding(accept_encoding, "gzip"):
+        body = encoded.gzip
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from collections import deque
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger("ymkw-api")
+
+# 配列の引数 (除外ユーザー・チャンネル範囲) は長いことがあるので先頭だけ残す
+MAX_ARRAY_ITEMS = 20
+EXPLAINABLE = re.compile(r"^\s*(SELECT|WITH)\b", re.IGNORECASE)
+
+def normalize_sql(query: str) -> str:
+    # f-string で組み立てた SQL の改行・インデントを詰めて、同じ形のクエリが同じ文字列になるようにする
+    return re.sub(r"\s+", " ", query).strip()
+
+def describe_param(value: Any) -> Any:
+    if isinstance(value, (list, tuple)):
+        items = [describe_param(v) for v in value[:MAX_ARRAY_ITEMS]]
+        if len(value) > MAX_ARRAY_ITEMS:
+            items.append(f"... ({len(value)} items)")
+        return items
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(value)
+
+class SlowQueryLog:
+    # threshold 秒以上かかったクエリを新しい順に size 件まで残すリングバッファ。
+    # 実行計画は裏で EXPLAIN (ANALYZE, BUFFERS) を取り直して付ける (同じ形のクエリは cooldown 秒に1回、同時に1本まで)。
+    # ANALYZE はクエリを実際に流すので、トランザクションを巻き戻し、statement_timeout で打ち切る
+    def __init__(self, threshold: float, size: int, cooldown: float, explain_timeout: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.explain_timeout = explain_timeout
+        self.entries: deque = deque(maxlen=size)
+        self.last_explained: Dict[str, float] = {}
+        self.explaining = False
+
+    def record(self, pool, method: str, query: str, args: tuple, elapsed: float, source: str, error: Optional[str] = None) -> None:
+        sql = normalize_sql(query)
+        fingerprint = hashlib.blake2b(sql.encode(), digest_size=8).hexdigest()
+        entry = {
+            "at": datetime.now().isoformat(timespec="seconds"),
+            "duration_ms": round(elapsed * 1000, 1),
+            "source": source,
+            "method": method,
+            "fingerprint": fingerprint,
+            "sql": sql,
+            "params": [describe_param(a) for a in args],
+            "error": error,
+            "plan": None,
+        }
+        self.entries.append(entry)
+        logger.warning(f"Slow query ({entry['duration_ms']}ms, {source}, {fingerprint}): {sql[:200]}")
+
+        now = time.monotonic()
+        if self.explaining or not EXPLAINABLE.match(sql) or now - self.last_explained.get(fingerprint, -self.cooldown) < self.cooldown:
+            return
+        self.last_explained[fingerprint] = now
+        self.explaining = True
+        asyncio.ensure_future(self.explain(pool, entry, query, args))
+
+    async def explain(self, pool, entry: dict, query: str, args: tuple) -> None:
+        try:
+            entry["plan"] = await self.run_explain(pool, "EXPLAIN (ANALYZE, BUFFERS) ", query, args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # 締め切りを過ぎるほど遅いときは、実行しない EXPLAIN で計画だけ取る
+            try:
+                plan = await self.run_explain(pool, "EXPLAIN ", query, args)
+                entry["plan"] = [f"(EXPLAIN ANALYZE failed: {type(e).__name__})"] + plan
+            except Exception:
+                logger.warning(f"Failed to explain slow query {entry['fingerprint']}", exc_info=True)
+        finally:
+            self.explaining = False
+
+    async def run_explain(self, pool, prefix: str, query: str, args: tuple) -> List[str]:
+        async with pool.acquire() as conn:
+            tr = conn.transaction(readonly=True)
+            await tr.start()
+            try:
+                await conn.execute(f"SET LOCAL statement_timeout = {int(self.explain_timeout * 1000)}")
+                rows = await conn.fetch(prefix + query, *args)
+            finally:
+                await tr.rollback()
+        return [r[0] for r in rows]
+
+    def snapshot(self) -> List[dict]:
+        return list(reversed(self.entries))
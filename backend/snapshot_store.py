@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Optional, Tuple
+
+from response_body import EncodedBody
+
+class SnapshotStore:
+    # 締まった月・過去の end_date の応答を保存するディスク上のストア。期限は無い。
+    # ボディは内容のハッシュ (ETag) を名前にして objects/ に1回だけ書き、refs/ にはキーごとに
+    # (ハッシュ, 世代) だけを置く。月が締まった後に書き込みがあれば世代が変わるので、再集計して ref を書き直す
+    def __init__(self, directory: str):
+        self.objects_dir = os.path.join(directory, "objects")
+        self.refs_dir = os.path.join(directory, "refs")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.refs_dir, exist_ok=True)
+
+    def _ref_path(self, key: str) -> str:
+        return os.path.join(self.refs_dir, hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + ".json")
+
+    def _object_path(self, digest: str, suffix: str = "") -> str:
+        return os.path.join(self.objects_dir, digest[:2], digest + suffix)
+
+    def _write(self, path: str, data: bytes) -> None:
+        # 読み手が途中までのファイルを見ないよう、同じディレクトリの一時ファイルから置き換える
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _read(self, path: str) -> Optional[bytes]:
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get(self, key: str) -> Optional[Tuple[EncodedBody, Optional[int]]]:
+        ref = self._read(self._ref_path(key))
+        if ref is None:
+            return None
+        ref = json.loads(ref)
+        if ref["key"] != key:
+            return None
+        digest = ref["etag"].strip('"')
+        body = self._read(self._object_path(digest))
+        if body is None:
+            return None
+        encoded = EncodedBody(body, ref["etag"], self._read(self._object_path(digest, ".gz")), self._read(self._object_path(digest, ".br")))
+        return encoded, ref["generation"]
+
+    def put(self, key: str, encoded: EncodedBody, generation: Optional[int]) -> None:
+        digest = encoded.etag.strip('"')
+        for suffix, data in (("", encoded.body), (".gz", encoded.gzip), (".br", encoded.br)):
+            path = self._object_path(digest, suffix)
+            if data is None:
+                continue
+            if os.path.exists(path):
+                # 既にあるボディも書いたばかりとして扱う (ref を書く前に prune で消されないように)
+                os.utime(path)
+            else:
+                self._write(path, data)
+        self._write(self._ref_path(key), json.dumps({"key": key, "etag": encoded.etag, "generation": generation}).encode())
+
+    def prune(self, grace: float) -> int:
+        # どの ref からも指されていないボディ (世代が変わって書き直された古い応答など) を消し、消した数を返す。
+        # put はボディを書いてから ref を書くので、grace 秒以内に書かれたものは残す
+        referenced = set()
+        for name in os.listdir(self.refs_dir):
+            if not name.endswith(".json"):
+                continue
+            ref = self._read(os.path.join(self.refs_dir, name))
+            try:
+                referenced.add(json.loads(ref)["etag"].strip('"'))
+            except (TypeError, ValueError, KeyError):
+                pass
+        cutoff = time.time() - grace
+        removed = 0
+        for prefix in os.listdir(self.objects_dir):
+            directory = os.path.join(self.objects_dir, prefix)
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    if name.split(".", 1)[0] not in referenced and os.path.getmtime(path) < cutoff:
+                        os.unlink(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
@@ -0,0 +1,87 @@
+import heapq
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Set
+
+# 入力の3-gramのうち名前に含まれる割合がこれ以上なら候補にする (pg_trgm の word_similarity_threshold と同じ)
+SIMILARITY_THRESHOLD = 0.6
+# 部分一致・前方一致のときの加点と、発言数 (対数で 0〜1 に正規化) の重み
+SUBSTRING_BONUS = 0.5
+PREFIX_BONUS = 0.25
+ACTIVITY_WEIGHT = 0.3
+
+WORD_RE = re.compile(r"\w+")
+
+def normalize(text: str) -> str:
+    # 全角/半角・大文字/小文字の違いを無視する
+    return unicodedata.normalize("NFKC", text).casefold().strip()
+
+def trigrams(text: str) -> Set[str]:
+    # pg_trgm と同じく単語ごとに前に空白2つ・後ろに空白1つを足して3文字ずつ切る。
+    # 前の空白のおかげで1〜2文字の入力でも単語の先頭と一致する
+    grams = set()
+    for word in WORD_RE.findall(text):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+class UserIndex:
+    # users テーブル (除外ユーザーを除く) の検索用スナップショット。3-gram → ユーザーの転置索引を持ち、
+    # 入力のたびの検索を DB に行かずに済ませる (検索窓の入力補完用)。
+    # 並び順は「入力の3-gramが表示名・ユーザー名に含まれる割合 + 部分一致/前方一致の加点 + 発言数」
+    def __init__(self, rows: Iterable):
+        rows = sorted(rows, key=lambda r: (-r["c"], r["user_id"]))
+        max_log = math.log1p(rows[0]["c"]) if rows and rows[0]["c"] else 1.0
+        self.users: List[dict] = []
+        # 部分一致を1回で調べられるよう、正規化した表示名とユーザー名を改行でつないで持つ
+        self.texts: List[str] = []
+        self.activity: List[float] = []
+        self.postings: Dict[str, List[int]] = defaultdict(list)
+
+        for i, r in enumerate(rows):
+            self.users.append({"user_id": str(r["user_id"]), "display_name": r["display_name"], "username": r["username"], "avatar": r["avatar_url"]})
+            text = f"{normalize(r['display_name'])}\n{normalize(r['username'])}"
+            self.texts.append(text)
+            self.activity.append(ACTIVITY_WEIGHT * math.log1p(r["c"]) / max_log)
+            for g in trigrams(text):
+                self.postings[g].append(i)
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def search(self, query: str, limit: int) -> List[dict]:
+        q = normalize(query)
+        if not q:
+            return []
+        grams = trigrams(q)
+        hits = Counter()
+        for g in grams:
+            hits.update(self.postings.get(g, ()))
+        need = len(grams) * SIMILARITY_THRESHOLD
+        texts, activity = self.texts, self.activity
+        prefix = "\n" + q
+        scores = {}
+        for i, n in hits.items():
+            text = texts[i]
+            substring = q in text
+            if n < need and not substring:
+                continue
+            score = n / len(grams) + activity[i]
+            if substring:
+                score += SUBSTRING_BONUS
+                if text.startswith(q) or prefix in text:
+                    score += PREFIX_BONUS
+            scores[i] = score
+        if len(scores) < limit and len(q) < 3:
+            # 1〜2文字で単語の途中に一致するものは3-gramで拾えないので、足りないときだけ全件を見る
+            # (発言数の多い順に並べてあるので、limit 件見つかれば残りは見なくてよい)
+            for i, text in enumerate(texts):
+                if i not in scores and q in text:
+                    scores[i] = SUBSTRING_BONUS + activity[i]
+                    if len(scores) >= limit:
+                        break
+        # 添字は発言数の多い順なので、同点なら活発なユーザーが先
+        best = heapq.nsmallest(limit, scores, key=lambda i: (-scores[i], i))
+        return [self.users[i] for i in best]
@@ -0,0 +1,88 @@
+import argparse
+import asyncio
+import datetime
+import logging
+import statistics
+import sys
+import time
+
+import asyncpg
+
+import synthetic
+
+logger = logging.getLogger("analysis-latency")
+
+async def legacy_analysis(api, params, src, user_id):
+    # 単一集計に置き換える前の5クエリ版 (比較用)
+    where = "TRUE"
+    if user_id and user_id.isdigit(): params = params + [int(user_id)]; where = f"r.user_id = ${len(params)}"
+    total = await api.pool.fetchval(f"SELECT COALESCE(sum(r.message_count), 0) FROM {src} r WHERE {where}", *params)
+    if not total: return {"total": 0}
+    unique_users = await api.pool.fetchval(f"SELECT count(DISTINCT r.user_id) FROM {src} r LEFT JOIN users u ON r.user_id = u.user_id WHERE {where} AND u.user_id IS NOT NULL AND NOT u.is_excluded", *params)
+    max_d = await api.pool.fetchrow(f"SELECT r.jst_date as d, sum(r.message_count) as c FROM {src} r WHERE {where} GROUP BY d ORDER BY c DESC LIMIT 1", *params)
+    max_w = await api.pool.fetchrow(f"SELECT EXTRACT(DOW FROM r.jst_date) as dow, sum(r.message_count) as c FROM {src} r WHERE {where} GROUP BY dow ORDER BY c DESC LIMIT 1", *params)
+    max_h = await api.pool.fetchrow(f"SELECT r.hour as h, sum(r.message_count) as c FROM {src} r WHERE {where} GROUP BY h ORDER BY c DESC LIMIT 1", *params)
+    return {"total": total, "unique_users": unique_users or 0, "max_date": {"date": max_d['d'].strftime("%Y-%m-%d"), "count": max_d['c']} if max_d else None, "max_dow": {"dow": int(max_w['dow']), "count": max_w['c']} if max_w else None, "max_hour": {"hour": int(max_h['h']), "count": max_h['c']} if max_h else None}
+
+def build_cases(api, start, channel_id, user_id):
+    month_start, month_end = api.get_month_bounds(start.year, start.month)
+    until = datetime.datetime.combine(start, datetime.time(12, 30), tzinfo=api.JST) + datetime.timedelta(days=120)
+    return [
+        ("total", {}, None),
+        ("total+channel", {"channel_ids": [channel_id]}, None),
+        ("total+user", {}, str(user_id)),
+        ("total+end_date", {"until": until}, None),
+        ("month", {"start_date": month_start, "end_date": month_end}, None),
+        ("month+channel+user", {"channel_ids": [channel_id], "start_date": month_start, "end_date": month_end}, str(user_id)),
+    ]
+
+async def measure(fn, runs):
+    timings = []
+    result = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = await fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return result, timings
+
+async def main():
+    parser = argparse.ArgumentParser(description="Compare the five-query and single-scan /stats/analysis paths.")
+    synthetic.add_dataset_args(parser)
+    parser.add_argument("--skip-generate", action="store_true", help="Reuse the dataset already in --schema.")
+    parser.add_argument("--runs", type=int, default=5, help="Timed runs per case and path.")
+    args = parser.parse_args()
+    if not args.dsn:
+        parser.error("--dsn or BENCH_DSN is required")
+
+    api = synthetic.load_api(args.dsn)
+
+    start = synthetic.start_date(args)
+    if not args.skip_generate:
+        await synthetic.create_dataset(args, api)
+
+    api.pool = await asyncpg.create_pool(args.dsn, min_size=1, max_size=4, command_timeout=None, server_settings=synthetic.schema_settings(args.schema))
+    try:
+        await api.reload_excluded_users()
+        channel_id = await api.pool.fetchval("SELECT channel_id FROM channels ORDER BY channel_id LIMIT 1")
+
+        print(f"{'case':<22}{'legacy p50':>12}{'single p50':>12}{'speedup':>10}")
+        for name, source_args, user_id in build_cases(api, start, channel_id, 1):
+            params = []
+            src = api.build_rollup_source(params, **source_args)
+            legacy, legacy_ms = await measure(lambda: legacy_analysis(api, params, src, user_id), args.runs)
+            single, single_ms = await measure(lambda: api.build_analysis(params, src, user_id), args.runs)
+            if legacy["total"] != single["total"] or legacy.get("unique_users") != single.get("unique_users"):
+                logger.error(f"Result mismatch in {name}: {legacy} != {single}")
+            legacy_p50 = statistics.median(legacy_ms)
+            single_p50 = statistics.median(single_ms)
+            print(f"{name:<22}{legacy_p50:>10.1f}ms{single_p50:>10.1f}ms{legacy_p50 / single_p50:>9.2f}x")
+    finally:
+        await api.pool.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+    asyncio.run(main())
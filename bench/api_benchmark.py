@@ -0,0 +1,364 @@
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import math
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+import asyncpg
+
+import synthetic
+
+# レート制限に掛からないように上限を上げておく
+os.environ.setdefault("RATE_LIMIT_MAX_REQUESTS", "1000000000")
+os.environ.setdefault("RATE_LIMIT_BOT_MAX_REQUESTS", "1000000000")
+os.environ.setdefault("DB_RATE_LIMIT_MAX_REQUESTS", "1000000000")
+os.environ.setdefault("DB_RATE_LIMIT_BOT_MAX_REQUESTS", "1000000000")
+# 遅いクエリの EXPLAIN ANALYZE を計測中に裏で走らせない
+os.environ.setdefault("SLOW_QUERY_THRESHOLD_MS", "600000")
+
+logger = logging.getLogger("api-benchmark")
+
+ORIGIN = "https://ymkw.top"
+# キャッシュを消すためのものと FastAPI のドキュメントは測らない
+SKIPPED_ROUTES = {"/debug/clear-cache", "/docs", "/docs/oauth2-redirect", "/redoc", "/openapi.json"}
+PERCENTILES = (50, 95, 99)
+
+DATASET_SQL = '''
+    SELECT
+        (SELECT COALESCE(sum(c.reltuples), 0)::bigint FROM pg_class c
+         WHERE c.relnamespace = current_schema()::regnamespace AND c.relkind = 'r'
+           AND (c.relname = 'messages' OR c.relname LIKE 'messages\\_p%')) AS messages,
+        (SELECT count(*) FROM message_rollups) AS rollups,
+        (SELECT count(*) FROM users) AS users,
+        (SELECT count(*) FROM channels) AS channels,
+        (SELECT count(*) FROM channels WHERE name LIKE '% / %') AS threads
+'''
+
+def build_scope(path, query, headers):
+    raw_headers = [(b"host", b"api.ymkw.top"), (b"user-agent", b"bench"), (b"accept", b"application/json"), (b"accept-encoding", b"gzip, br"), (b"origin", ORIGIN.encode())]
+    raw_headers += [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "https",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": urlencode(query, doseq=True).encode(),
+        "headers": raw_headers,
+        "client": ("203.0.113.7", 50000),
+        "server": ("127.0.0.1", 8070),
+    }
+
+async def call(app, scope):
+    # 本文 (ストリーミングの出力も) を最後まで受け取るまでを1回とする
+    status = None
+    size = 0
+    received = False
+
+    async def receive():
+        # 本文の無い GET を1回渡したら、あとは切断されないクライアントとして待たせる
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal status, size
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            size += len(message.get("body", b""))
+
+    started = time.perf_counter()
+    await app(dict(scope), receive, send)
+    return status, time.perf_counter() - started, size
+
+def build_cases(api, ctx):
+    # (名前, パス, クエリ, API キーが要るか)。月は締まった先月、end_date は履歴の中ほど
+    y, m, uid, ch = ctx["year"], ctx["month"], ctx["user_id"], ctx["channel_id"]
+    pc = api.PRIVATE_CHAT_CHANNEL_ID
+    end_date = ctx["end_date"]
+    month_start, month_end = ctx["month_start"], ctx["month_end"]
+    return [
+        ("root", "/", {}, False),
+        ("health", "/health", {}, False),
+        ("channels", "/channels", {}, False),
+        ("users/search", "/users/search", {"q": "sa"}, False),
+        ("users/search kana", "/users/search", {"q": "さくら", "limit": 50}, False),
+        ("ranking/monthly", f"/ranking/monthly/{y}/{m}", {}, False),
+        ("ranking/monthly channel", f"/ranking/monthly/{y}/{m}", {"channel_id": ch}, False),
+        ("ranking/monthly private", f"/ranking/monthly/{y}/{m}", {"channel_id": pc}, False),
+        ("ranking/monthly page", f"/ranking/monthly/{y}/{m}", {"after_rank": 100, "limit": 500}, False),
+        ("ranking/total", "/ranking/total", {}, False),
+        ("ranking/total channel", "/ranking/total", {"channel_id": ch}, False),
+        ("ranking/total end_date", "/ranking/total", {"end_date": end_date}, False),
+        ("user rank/monthly", f"/users/{uid}/rank/monthly/{y}/{m}", {}, False),
+        ("user rank/total", f"/users/{uid}/rank/total", {}, False),
+        ("user rank/total end_date", f"/users/{uid}/rank/total", {"end_date": end_date, "channel_id": ch}, False),
+        ("history/monthly", f"/stats/history/{y}/{m}", {}, False),
+        ("history/monthly user", f"/stats/history/{y}/{m}", {"user_id": [uid]}, False),
+        ("history/monthly columnar", f"/stats/history/{y}/{m}", {"format": "columnar"}, False),
+        ("history/total", "/stats/history/total", {}, False),
+        ("history/total private", "/stats/history/total", {"channel_id": pc}, False),
+        ("history/total end_date", "/stats/history/total", {"end_date": end_date, "user_id": [uid]}, False),
+        ("heatmap/monthly", f"/stats/heatmap/{y}/{m}", {}, False),
+        ("heatmap/monthly channel", f"/stats/heatmap/{y}/{m}", {"channel_id": ch}, False),
+        ("heatmap/total", "/stats/heatmap/total", {}, False),
+        ("heatmap/total end_date", "/stats/heatmap/total", {"end_date": end_date}, False),
+        ("channels_distribution/monthly", f"/stats/channels_distribution/{y}/{m}", {}, False),
+        ("channels_distribution/total", "/stats/channels_distribution/total", {}, False),
+        ("channels_distribution/total end_date", "/stats/channels_distribution/total", {"end_date": end_date}, False),
+        ("analysis/monthly", f"/stats/analysis/{y}/{m}", {}, False),
+        ("analysis/monthly user", f"/stats/analysis/{y}/{m}", {"channel_id": ch, "user_id": uid}, False),
+        ("analysis/total", "/stats/analysis/total", {}, False),
+        ("analysis/total end_date", "/stats/analysis/total", {"end_date": end_date, "channel_id": pc}, False),
+        ("dashboard/monthly", f"/dashboard/{y}/{m}", {}, False),
+        ("dashboard/monthly channel", f"/dashboard/{y}/{m}", {"channel_id": ch}, False),
+        ("dashboard/total", "/dashboard/total", {}, False),
+        ("dashboard/total end_date", "/dashboard/total", {"end_date": end_date}, False),
+        ("export/users/daily", "/export/users/daily", {"start_date": month_start, "end_date": month_end}, True),
+        ("export/users/daily csv", "/export/users/daily", {"start_date": month_start, "end_date": month_end, "channel_id": ch, "format": "csv"}, True),
+        ("export/channels/daily", "/export/channels/daily", {"start_date": month_start, "end_date": month_end}, True),
+        ("debug/db", "/debug/db", {}, False),
+        ("debug/admission", "/debug/admission", {}, False),
+        ("debug/cancellations", "/debug/cancellations", {}, False),
+        ("debug/slow-queries", "/debug/slow-queries", {}, True),
+        ("metrics", "/metrics", {}, True),
+    ]
+
+def route_template(api, path):
+    for route in api.app.routes:
+        match = getattr(route, "path_regex", None)
+        if match and match.match(path):
+            return route.path
+    return None
+
+def uncovered_routes(api, cases):
+    covered = {route_template(api, path) for _, path, _, _ in cases}
+    return sorted({r.path for r in api.app.routes if "GET" in getattr(r, "methods", ())} - covered - SKIPPED_ROUTES)
+
+async def open_api(api, args):
+    # 起動イベントのうち集計に要る部分だけを行う (ウォーマー・月の締め・通知の待ち受けは走らせない。
+    # 走らせるとコールドの計測の途中でキャッシュが埋まる)
+    raw_pool = await asyncpg.create_pool(args.dsn, min_size=1, max_size=args.pool_size, command_timeout=60, server_settings=synthetic.schema_settings(args.schema))
+    api.pool = api.InstrumentedPool(raw_pool, api.db_acquire_wait, api.db_query_duration, api.slow_queries)
+    await api.pool.execute(api.CREATE_GENERATIONS_SQL)
+    await api.reload_generations(api.pool)
+    await api.reload_channel_index()
+    await api.reload_excluded_users()
+    await api.reload_user_index()
+    await api.reload_first_data_month()
+
+async def reset_caches(api, snapshot_root):
+    # 応答のキャッシュ (L1・diskcache・順位表・スナップショット) を空にする。
+    # PostgreSQL の共有バッファと OS のページキャッシュはそのままなので、DB は温まった状態のまま測る
+    await api.cache_fills.wait_all()
+    api.cache.clear()
+    api.l1_cache.clear()
+    api.rank_tables.clear()
+    api.snapshots = api.SnapshotStore(tempfile.mkdtemp(dir=snapshot_root))
+
+def percentile(sorted_values, q):
+    # 最近傍順位法
+    return sorted_values[max(0, math.ceil(q / 100 * len(sorted_values)) - 1)]
+
+def summarize(timings, wall=None):
+    values = sorted(t * 1000 for t in timings)
+    result = {"count": len(values)}
+    for q in PERCENTILES:
+        result[f"p{q}"] = round(percentile(values, q), 3)
+    result["mean"] = round(statistics.fmean(values), 3)
+    result["max"] = round(values[-1], 3)
+    if wall:
+        result["rps"] = round(len(values) / wall, 1)
+    return result
+
+async def measure_cold(api, scope, runs, snapshot_root):
+    timings = []
+    statuses = set()
+    for _ in range(runs):
+        await reset_caches(api, snapshot_root)
+        status, elapsed, _ = await call(api.app, scope)
+        statuses.add(status)
+        timings.append(elapsed)
+    return summarize(timings), statuses
+
+async def measure_warm(api, scope, requests, concurrency):
+    # 1回流してキャッシュを埋めてから、concurrency 本で合わせて requests 回投げる
+    status, _, size = await call(api.app, scope)
+    await api.cache_fills.wait_all()
+    timings = []
+    statuses = {status}
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            status, elapsed, _ = await call(api.app, scope)
+            statuses.add(status)
+            timings.append(elapsed)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return summarize(timings, time.perf_counter() - started), statuses, size
+
+async def benchmark_context(api, start):
+    # 計測に使う月・チャンネル・ユーザー。チャンネルはスレッドの一番多い公開チャンネル、ユーザーは発言数が一番多い人
+    today = datetime.date.today()
+    last_month = today.replace(day=1) - datetime.timedelta(days=1)
+    month_start, month_end = api.get_month_bounds(last_month.year, last_month.month)
+    whitelisted = [c for c in api.WHITELIST_CHANNEL_IDS if c in api.channel_index.names]
+    channel_id = max(whitelisted, key=lambda c: len(api.channel_index.scope(c))) if whitelisted else api.PRIVATE_CHAT_CHANNEL_ID
+    user_id = await api.pool.fetchval(
+        "SELECT user_id FROM message_rollups WHERE user_id <> ALL($1::bigint[]) GROUP BY user_id ORDER BY sum(message_count) DESC LIMIT 1",
+        api.excluded_user_ids,
+    )
+    middle = start + (today - start) / 2
+    end_date = datetime.datetime.combine(middle, datetime.time(12, 30), tzinfo=api.JST)
+    return {
+        "year": last_month.year,
+        "month": last_month.month,
+        "month_start": month_start.isoformat(),
+        # export の end_date はその日を含む
+        "month_end": (month_end - datetime.timedelta(days=1)).isoformat(),
+        "channel_id": channel_id,
+        "user_id": user_id or 1,
+        "end_date": end_date.isoformat(),
+    }
+
+def git_commit(path):
+    try:
+        return subprocess.run(["git", "-C", str(path), "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run(args):
+    api = synthetic.load_api(args.dsn, args.backend)
+    if not args.skip_generate:
+        await synthetic.create_dataset(args, api)
+
+    await open_api(api, args)
+    snapshot_root = tempfile.mkdtemp(prefix="ymkw_bench_snapshots_")
+    try:
+        ctx = await benchmark_context(api, synthetic.start_date(args))
+        dataset = dict(await api.pool.fetchrow(DATASET_SQL))
+        logger.info(f"Dataset: {dataset}")
+        cases = build_cases(api, ctx)
+        for path in uncovered_routes(api, cases):
+            logger.warning(f"No benchmark case for route {path}")
+        if args.only:
+            cases = [c for c in cases if re.search(args.only, c[0])]
+
+        results = []
+        print(f"{'case':<40}{'cold p50':>10}{'cold p99':>10}{'warm p50':>10}{'warm p99':>10}{'warm req/s':>12}")
+        for name, path, query, needs_key in cases:
+            headers = {"x-api-key": api.API_SECRET} if needs_key else {}
+            scope = build_scope(path, query, headers)
+            cold, cold_statuses = await measure_cold(api, scope, args.cold_runs, snapshot_root)
+            warm, warm_statuses, size = await measure_warm(api, scope, args.requests, args.concurrency)
+            statuses = sorted(cold_statuses | warm_statuses)
+            if statuses != [200]:
+                logger.warning(f"{name}: unexpected status {statuses}")
+            results.append({"name": name, "path": path, "query": query, "status": statuses, "bytes": size, "cold": cold, "warm": warm})
+            print(f"{name:<40}{cold['p50']:>8.1f}ms{cold['p99']:>8.1f}ms{warm['p50']:>8.2f}ms{warm['p99']:>8.2f}ms{warm['rps']:>12.0f}")
+    finally:
+        await api.cache_fills.wait_all()
+        await api.pool.close()
+
+    report = {
+        "label": args.label,
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(args.backend or synthetic.ROOT),
+        "dataset": {**dataset, "schema": args.schema},
+        "settings": {"cold_runs": args.cold_runs, "requests": args.requests, "concurrency": args.concurrency, "pool_size": args.pool_size},
+        "context": ctx,
+        "cases": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logger.info(f"Wrote {args.output}")
+
+def compare(base_path, new_path, threshold, min_delta):
+    # 2回分の結果を並べ、p50/p95/p99 が threshold の割合かつ min_delta ミリ秒より遅くなったものに印を付ける (1ms 未満の揺れは拾わない)。
+    # 遅くなった数を返す
+    with open(base_path, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+    for report in (base, new):
+        print(f"{report.get('label') or '-'} ({report.get('commit')}, {report['created_at']}): {report['dataset']}")
+    if base["dataset"] != new["dataset"]:
+        logger.warning("The two runs used different datasets")
+
+    base_cases = {c["name"]: c for c in base["cases"]}
+    regressions = 0
+    print(f"{'case':<40}{'phase':<6}" + "".join(f"{f'p{q}':>22}" for q in PERCENTILES) + f"{'req/s':>20}")
+    for case in new["cases"]:
+        old = base_cases.get(case["name"])
+        if old is None:
+            continue
+        for phase in ("cold", "warm"):
+            cells = []
+            for q in PERCENTILES:
+                before, after = old[phase][f"p{q}"], case[phase][f"p{q}"]
+                ratio = after / before if before else 1.0
+                mark = "!" if ratio > 1 + threshold and after - before >= min_delta else " "
+                regressions += mark == "!"
+                cells.append(f"{before:>8.2f}→{after:>8.2f}{ratio:>5.2f}x{mark}")
+            rps = ""
+            if "rps" in case[phase]:
+                rps = f"{old[phase]['rps']:>9.0f}→{case[phase]['rps']:>9.0f}"
+            print(f"{case['name']:<40}{phase:<6}" + "".join(f"{c:>22}" for c in cells) + f"{rps:>20}")
+    missing = set(base_cases) - {c["name"] for c in new["cases"]}
+    if missing:
+        logger.warning(f"Cases only in {base_path}: {sorted(missing)}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Run every API route against the synthetic dataset with cold and warm caches and record p50/p95/p99 latency and throughput.")
+    synthetic.add_dataset_args(parser)
+    parser.add_argument("--skip-generate", action="store_true", help="Reuse the dataset already in --schema.")
+    parser.add_argument("--backend", help="Backend directory to load main.py from (e.g. a git worktree of an older commit).")
+    parser.add_argument("--cold-runs", type=int, default=5, help="Requests per case with all response caches cleared before each one.")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per case once the cache is warm.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent requests in the warm phase.")
+    parser.add_argument("--pool-size", type=int, default=20, help="Maximum database connections.")
+    parser.add_argument("--only", help="Only run cases whose name matches this regular expression.")
+    parser.add_argument("--label", help="Free-form label stored in the results file.")
+    parser.add_argument("--output", default="api_benchmark.json", help="Results file to write.")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="Compare two results files instead of running the benchmark.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown flagged by --compare. Default: 0.1 (10%%)")
+    parser.add_argument("--min-delta", type=float, default=1.0, help="Smallest slowdown in milliseconds flagged by --compare. Default: 1.0")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 when --compare flags any slowdown.")
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare(*args.compare, args.threshold, args.min_delta)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+        return
+    if not args.dsn:
+        parser.error("--dsn or BENCH_DSN is required")
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+    main()
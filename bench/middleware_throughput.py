@@ -0,0 +1,81 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# DB には接続しない (起動イベントは走らせない) が、main.py の読み込みに DSN が要る
+os.environ.setdefault("DB_DSN", "postgresql://bench@127.0.0.1:5432/bench")
+# レート制限に掛からないように上限を上げておく
+os.environ.setdefault("RATE_LIMIT_MAX_REQUESTS", "1000000000")
+os.environ.setdefault("RATE_LIMIT_BOT_MAX_REQUESTS", "1000000000")
+os.environ.setdefault("DB_RATE_LIMIT_MAX_REQUESTS", "1000000000")
+os.environ.setdefault("DB_RATE_LIMIT_BOT_MAX_REQUESTS", "1000000000")
+
+CASES = [
+    ("health, allowed Origin", "GET", "/health", {"origin": "https://www.ymkw.top"}),
+    ("health, allowed Referer", "GET", "/health", {"referer": "https://ymkw.top/ranking/2026/5"}),
+    ("health, preview Origin", "GET", "/health", {"origin": "https://feature-x.ymkw-top.pages.dev"}),
+    ("denied, foreign Origin", "GET", "/ranking/total", {"origin": "https://example.com"}),
+    ("preflight", "OPTIONS", "/ranking/total", {"origin": "https://ymkw.top", "access-control-request-method": "GET", "access-control-request-headers": "x-api-key"}),
+]
+
+def build_scope(method, path, headers):
+    raw_headers = [(b"host", b"api.ymkw.top"), (b"user-agent", b"bench"), (b"accept", b"application/json"), (b"accept-encoding", b"gzip, br")]
+    raw_headers += [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "https",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": raw_headers,
+        "client": ("203.0.113.7", 50000),
+        "server": ("127.0.0.1", 8070),
+    }
+
+async def call(app, scope):
+    status = None
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(dict(scope), receive, send)
+    return status
+
+async def measure(app, method, path, headers, requests):
+    scope = build_scope(method, path, headers)
+    status = await call(app, scope)
+    started = time.perf_counter()
+    for _ in range(requests):
+        await call(app, scope)
+    return status, requests / (time.perf_counter() - started)
+
+async def main():
+    parser = argparse.ArgumentParser(description="Measure requests per second through the API middleware stack without a database.")
+    parser.add_argument("--backend", default=str(ROOT / "backend"), help="Backend directory to load main.py from (e.g. a git worktree of an older commit).")
+    parser.add_argument("--requests", type=int, default=5000, help="Requests per case.")
+    args = parser.parse_args()
+
+    sys.path.insert(0, args.backend)
+    import main as api
+
+    print(f"{'case':<28}{'status':>8}{'req/s':>12}")
+    for name, method, path, headers in CASES:
+        status, rps = await measure(api.app, method, path, headers, args.requests)
+        print(f"{name:<28}{status:>8}{rps:>12.0f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,351 @@
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import re
+import sys
+import tempfile
+from contextlib import asynccontextmanager
+
+from dateutil.relativedelta import relativedelta
+
+import api_benchmark
+import synthetic
+from cogs import ranking
+
+logger = logging.getLogger("query-plans")
+
+BASELINE_FILE = synthetic.ROOT / "bench" / "query_plans_baseline.json"
+EXPLAINABLE_PREFIXES = ("SELECT", "WITH")
+# 集計のエンドポイント (/debug/db の count(*) のような全件を読むのが当然のものは見ない)
+CHECKED_PREFIXES = ("/channels", "/ranking", "/stats", "/users/{user_id}", "/dashboard", "/export")
+
+# Bot のランキング (Bot/cogs/ranking.py) は synthetic.MESSAGES_SQL の guild_id で絞る
+BOT_GUILD_ID = 1
+# パーティション化したときに月のランキングが使うはずの索引 (Bot/partitions.py)
+PARTITION_CREATED_CHANNEL_INDEX = "idx_messages_part_human_created_channel"
+
+class RecordingConnection:
+    def __init__(self, conn, recorder):
+        self.conn = conn
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def cursor(self, query, *args, **kwargs):
+        self.recorder.record(query, args)
+        return self.conn.cursor(query, *args, **kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        self.recorder.record(query, args)
+        return await self.conn.fetch(query, *args, **kwargs)
+
+class QueryRecorder:
+    # api.pool の代わりに置いて、応答を作る間に投げられた SELECT を引数ごと控える (クエリはそのまま流す)
+    def __init__(self, pool):
+        self.pool = pool
+        self.queries = []
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    def record(self, query, args):
+        if query.lstrip().upper().startswith(EXPLAINABLE_PREFIXES):
+            self.queries.append((query, args))
+
+    def take(self):
+        queries, self.queries = self.queries, []
+        return queries
+
+    async def fetch(self, query, *args, **kwargs):
+        self.record(query, args)
+        return await self.pool.fetch(query, *args, **kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        self.record(query, args)
+        return await self.pool.fetchrow(query, *args, **kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        self.record(query, args)
+        return await self.pool.fetchval(query, *args, **kwargs)
+
+    @asynccontextmanager
+    async def acquire(self):
+        async with self.pool.acquire() as conn:
+            yield RecordingConnection(conn, self)
+
+def filter_values(ctx, api):
+    # 絞り込みごとに「無し」と試す値。channel_id は配下にスレッドのある公開チャンネルとプラチャ総合
+    return {
+        "channel_id": [None, ctx["channel_id"], api.PRIVATE_CHAT_CHANNEL_ID],
+        "user_id": [None, ctx["user_id"]],
+        "end_date": [None, ctx["end_date"]],
+    }
+
+def route_cases(api, ctx):
+    # 集計のルートごとに、受け付ける絞り込み (channel_id・user_id・end_date) の有無をすべて組み合わせる。
+    # 月の絞り込みは /{year}/{month} のルート、export では start_date/end_date の組で試す
+    values = filter_values(ctx, api)
+    path_values = {"year": ctx["year"], "month": ctx["month"], "user_id": ctx["user_id"]}
+    cases = []
+    for route in api.app.routes:
+        if "GET" not in getattr(route, "methods", ()) or not route.path.startswith(CHECKED_PREFIXES) or route.path == "/users/search":
+            continue
+        path = route.path.format(**path_values)
+        params = {p.name for p in route.dependant.query_params}
+        is_export = route.path.startswith("/export")
+        names = [n for n in values if n in params and not (is_export and n == "end_date")]
+        needs_key = is_export
+        ranges = [{}, {"start_date": ctx["month_start"], "end_date": ctx["month_end"]}] if is_export else [{}]
+        for combo in itertools.product(*[values[n] for n in names]):
+            for date_range in ranges:
+                query = {n: v for n, v in zip(names, combo) if v is not None}
+                query.update(date_range)
+                cases.append((case_name(route.path, query, ctx, api), path, query, needs_key))
+    return cases
+
+def case_name(path, query, ctx, api):
+    labels = []
+    for name, value in query.items():
+        if name == "channel_id":
+            labels.append("channel=private" if value == api.PRIVATE_CHAT_CHANNEL_ID else "channel=scope")
+        elif name == "start_date":
+            labels.append("month")
+        elif name != "end_date" or "start_date" not in query:
+            labels.append(name)
+    return " ".join([path] + labels)
+
+def bot_cases(ctx):
+    # API は message_rollups を読むので、db/indexes.sql の messages の部分索引を使うのはこの2つだけ。
+    # 月の範囲は ranking.py の run_ranking_logic と同じく、月初からその月の最後の1秒まで
+    start = datetime.datetime(ctx["year"], ctx["month"], 1)
+    end = start + relativedelta(months=1) - datetime.timedelta(seconds=1)
+    return [
+        ("bot ranking total", [(ranking.TOTAL_RANKING_SQL, (BOT_GUILD_ID,))]),
+        ("bot ranking monthly", [(ranking.MONTHLY_RANKING_SQL, (start, end, BOT_GUILD_ID))]),
+    ]
+
+def flat_index_names():
+    return {re.search(r"INDEX (?:IF NOT EXISTS )?(\w+)", sql).group(1) for sql in synthetic.flat_index_sql()}
+
+def bot_plan_rules(layout, ctx, relations):
+    # Bot の形ごとに (Seq Scan を許す messages の表, 計画に1つは出てこないといけない索引, その説明)。
+    # 分けていない messages では、どちらも Seq Scan 無しで db/indexes.sql の索引を使う。
+    # パーティションには created_at と JST 列の索引しか無く (guild_id もユーザーも先頭に無い)、
+    # 日付で絞らない全期間のランキングは全パーティションを読むしかないので Seq Scan を許し、索引は月のランキングで確かめる。
+    # 月のランキングはその月のパーティションを読み切るのだけ許す (範囲がほぼ丸ごと覆うので索引より安い)。
+    # はみ出した先の翌月のパーティションは索引で読む
+    if layout == "flat":
+        required = flat_index_names()
+        return {
+            "bot ranking total": (set(), required, "db/indexes.sql"),
+            "bot ranking monthly": (set(), required, "db/indexes.sql"),
+        }
+    month = synthetic.partitions.partition_name(datetime.date(ctx["year"], ctx["month"], 1))
+    return {
+        "bot ranking total": (relations, set(), None),
+        "bot ranking monthly": ({month}, {PARTITION_CREATED_CHANNEL_INDEX}, PARTITION_CREATED_CHANNEL_INDEX),
+    }
+
+async def parent_indexes(conn):
+    # パーティションの索引の名前 → 親 (messages) の索引の名前
+    rows = await conn.fetch(
+        """
+        SELECT c.relname AS child, p.relname AS parent
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relkind = 'I' AND p.relnamespace = current_schema()::regnamespace
+        """
+    )
+    return {r["child"]: r["parent"] for r in rows}
+
+async def message_relations(conn):
+    rows = await conn.fetch(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass('messages')"
+    )
+    return {"messages"} | {r["relname"] for r in rows}
+
+async def explain(conn, query, args):
+    tr = conn.transaction(readonly=True)
+    await tr.start()
+    try:
+        plan = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *args)
+    finally:
+        await tr.rollback()
+    return json.loads(plan)[0]["Plan"]
+
+def walk(node):
+    yield node
+    for child in node.get("Plans", ()):
+        yield from walk(child)
+
+def describe(node, depth=0):
+    # 失敗したときに出す、計画の木の要約 (ノードの種類・対象・索引・見積もり)
+    target = node.get("Relation Name") or ""
+    if node.get("Index Name"):
+        target += f" using {node['Index Name']}"
+    lines = [f"{'  ' * depth}{node['Node Type']} {target} (cost={node['Total Cost']:.0f} rows={node['Plan Rows']})"]
+    for child in node.get("Plans", ()):
+        lines.extend(describe(child, depth + 1))
+    return lines
+
+def message_indexes(node, relations, parents):
+    # messages (とそのパーティション) を読むのに使った索引 (パーティションの索引は messages の索引の名前にする)。
+    # Bitmap Index Scan は対象のテーブルを持たないので親の Bitmap Heap Scan で見る
+    names = set()
+    for n in walk(node):
+        if n.get("Relation Name") not in relations:
+            continue
+        if n["Node Type"] in ("Index Scan", "Index Only Scan"):
+            names.add(n["Index Name"])
+        elif n["Node Type"] == "Bitmap Heap Scan":
+            names.update(c["Index Name"] for c in walk(n) if c.get("Index Name"))
+    return {parents.get(name, name) for name in names}
+
+async def check_case(conn, queries, relations, parents):
+    # クエリごとの (見積もりコスト, messages の Seq Scan の対象, messages に使った索引, 計画の要約)
+    results = []
+    for query, args in queries:
+        plan = await explain(conn, query, args)
+        seq_scans = sorted({n["Relation Name"] for n in walk(plan) if n["Node Type"] == "Seq Scan" and n.get("Relation Name") in relations})
+        indexes = sorted(message_indexes(plan, relations, parents))
+        results.append({"sql": compact_sql(query), "cost": plan["Total Cost"], "seq_scans": seq_scans, "indexes": indexes, "plan": describe(plan)})
+    return results
+
+def compact_sql(query):
+    return " ".join(query.split())
+
+def load_baseline(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+async def run(args):
+    api = synthetic.load_api(args.dsn)
+    if not args.skip_generate:
+        await synthetic.create_dataset(args, api)
+
+    await api_benchmark.open_api(api, args)
+    recorder = QueryRecorder(api.pool)
+    api.pool = recorder
+    snapshot_root = tempfile.mkdtemp(prefix="ymkw_plan_snapshots_")
+    try:
+        ctx = await api_benchmark.benchmark_context(api, synthetic.start_date(args))
+        dataset = dict(await api.pool.fetchrow(api_benchmark.DATASET_SQL))
+
+        # 起動時の読み込み (世代・チャンネル・除外ユーザー・ユーザー索引・最初の月) も1つの形として見る
+        recorder.take()
+        await api.reload_generations(api.pool)
+        await api.reload_channel_index()
+        await api.reload_excluded_users()
+        await api.reload_user_index()
+        await api.reload_first_data_month()
+        shapes = [("startup reloads", recorder.take())]
+
+        for name, path, query, needs_key in route_cases(api, ctx):
+            if args.only and args.only not in name:
+                continue
+            await api_benchmark.reset_caches(api, snapshot_root)
+            recorder.take()
+            headers = {"x-api-key": api.API_SECRET} if needs_key else {}
+            status, _, _ = await api_benchmark.call(api.app, api_benchmark.build_scope(path, query, headers))
+            await api.cache_fills.wait_all()
+            if status != 200:
+                logger.warning(f"{name}: status {status}")
+            shapes.append((name, recorder.take()))
+        shapes.extend(c for c in bot_cases(ctx) if not args.only or args.only in c[0])
+
+        baseline_file = load_baseline(args.baseline)
+        baseline = baseline_file.get(args.layout, {})
+        if baseline and baseline.get("dataset") != dataset:
+            logger.warning(f"Baseline was recorded on a different dataset: {baseline.get('dataset')} (now {dataset})")
+        recorded = {}
+        failures = 0
+        message_index_shapes = []
+
+        async with recorder.pool.acquire() as conn:
+            relations = await message_relations(conn)
+            parents = await parent_indexes(conn)
+            rules = bot_plan_rules(args.layout, ctx, relations)
+            print(f"{'shape':<70}{'queries':>8}{'cost':>14}{'baseline':>14}  result")
+            for name, queries in shapes:
+                results = await check_case(conn, queries, relations, parents)
+                cost = round(sum(r["cost"] for r in results), 2)
+                recorded[name] = cost
+                limit = baseline.get("shapes", {}).get(name)
+                if any(r["indexes"] for r in results):
+                    message_index_shapes.append(name)
+                allowed, required, required_label = rules.get(name, (set(), set(), None))
+                for r in results:
+                    r["seq_scans"] = [t for t in r["seq_scans"] if t not in allowed]
+                problems = [f"seq scan on {', '.join(r['seq_scans'])}" for r in results if r["seq_scans"]]
+                missing_index = bool(required) and not any(required & set(r["indexes"]) for r in results)
+                if missing_index:
+                    problems.append(f"no index from {required_label}")
+                over_cost = limit is not None and not args.record and cost > limit * (1 + args.tolerance)
+                if over_cost:
+                    problems.append(f"cost {cost:.0f} > baseline {limit:.0f} +{args.tolerance:.0%}")
+                result = "; ".join(problems) or ("new" if limit is None else "ok")
+                print(f"{name:<70}{len(results):>8}{cost:>14.0f}{(f'{limit:.0f}' if limit is not None else '-'):>14}  {result}")
+                failures += bool(problems)
+                if problems or args.verbose:
+                    for r in results:
+                        if r["seq_scans"] or over_cost or missing_index or args.verbose:
+                            print(f"    {r['sql'][:160]}")
+                            for line in r["plan"]:
+                                print(f"      {line}")
+
+        # messages を読む形がどれも索引を使っていなければ、Seq Scan の検査は何も見ていないのと同じなので失敗にする
+        # (--only で一部だけ見るときは、その中に messages を読む形が無いこともあるので見ない)
+        if not args.only:
+            if message_index_shapes:
+                logger.info(f"{len(message_index_shapes)} shapes use an index on messages")
+            else:
+                logger.error("No shape uses an index on messages")
+                failures += 1
+    finally:
+        await api.cache_fills.wait_all()
+        await api.pool.close()
+
+    if args.record:
+        baseline_file[args.layout] = {
+            "recorded_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "dataset": dataset,
+            "shapes": recorded,
+        }
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline_file, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        logger.info(f"Recorded {len(recorded)} shapes in {args.baseline}")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="EXPLAIN every query the API's aggregate routes and the bot ranking issue, with and without each filter, and fail on a seq scan of messages, a cost above the recorded baseline, a bot ranking query not using its messages index, or no shape using an index on messages.")
+    synthetic.add_dataset_args(parser)
+    parser.add_argument("--skip-generate", action="store_true", help="Reuse the dataset already in --schema.")
+    parser.add_argument("--pool-size", type=int, default=10, help="Maximum database connections.")
+    parser.add_argument("--baseline", default=str(BASELINE_FILE), help=f"Baseline costs per layout and shape. Default: {BASELINE_FILE.name}")
+    parser.add_argument("--record", action="store_true", help="Write the current costs as the baseline for --layout instead of comparing.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative cost increase over the baseline. Default: 0.25")
+    parser.add_argument("--only", help="Only check shapes whose name contains this string.")
+    parser.add_argument("--verbose", action="store_true", help="Print the plan of every query, not only the ones that failed.")
+    args = parser.parse_args()
+    if not args.dsn:
+        parser.error("--dsn or BENCH_DSN is required")
+
+    failures = asyncio.run(run(args))
+    if failures:
+        logger.error(f"{failures} query shapes failed")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+    main()
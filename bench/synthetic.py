@@ -0,0 +1,305 @@
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import random
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+import asyncpg
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "Bot"))
+
+import invalidation
+import jst_columns
+import partitions
+import rollups
+
+logger = logging.getLogger("synthetic")
+
+DEFAULT_SCHEMA = "ymkw_bench"
+CHUNK_SIZE = 1_000_000
+LAYOUTS = ("partitioned", "flat")
+INDEXES_FILE = ROOT / "db" / "indexes.sql"
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+# 本番の ID と重ならない範囲に作る
+SYNTHETIC_CHANNEL_BASE = 10_000
+THREAD_CHANNEL_BASE = 1_000_000
+PUBLIC_CATEGORY_BASE = 100
+PRIVATE_CATEGORY_BASE = 900_000
+THREAD_SHARE = 0.3
+
+SCHEMA_SQL = '''
+    CREATE TABLE IF NOT EXISTS channels (
+        channel_id BIGINT PRIMARY KEY,
+        name TEXT NOT NULL,
+        category_name TEXT,
+        category_id BIGINT,
+        position INTEGER,
+        is_active BOOLEAN DEFAULT TRUE
+    );
+    CREATE INDEX IF NOT EXISTS idx_channels_category_id ON channels (category_id);
+
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        display_name TEXT NOT NULL,
+        username TEXT NOT NULL,
+        avatar_url TEXT,
+        is_excluded BOOLEAN NOT NULL DEFAULT FALSE
+    );
+    ALTER TABLE users ADD COLUMN IF NOT EXISTS is_excluded BOOLEAN NOT NULL DEFAULT FALSE;
+'''
+
+# パーティション化前の messages (索引は db/indexes.sql のもの)
+FLAT_MESSAGES_SQL = f'''
+    CREATE TABLE IF NOT EXISTS messages (
+        message_id BIGINT PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        channel_id BIGINT NOT NULL,
+        guild_id BIGINT NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+        is_bot BOOLEAN DEFAULT FALSE,
+        char_count INTEGER DEFAULT 0,
+        {jst_columns.GENERATED_COLUMNS_SQL}
+    );
+'''
+
+# ユーザーの発言量は power(random(), skew) で偏らせる (skew が大きいほど上位に集中)。
+# チャンネルは累積の重み ($6) を width_bucket で引く。
+# message_id と日付は本番の snowflake と同じく一緒に増やし (チャンクごとにほぼ1つのパーティションに入る)、
+# 日ごとの件数は growth 乗で後の方ほど増やす。時刻は1割を一日中に散らし、残りを JST の夕方〜深夜に寄せる
+MESSAGES_SQL = '''
+    INSERT INTO messages (message_id, user_id, channel_id, guild_id, created_at, is_bot, char_count)
+    SELECT
+        i,
+        1 + floor(power(random(), $3) * $4)::bigint,
+        ($5::bigint[])[width_bucket(random(), $6::float8[])],
+        1,
+        $7::timestamptz
+            + floor($8 * power((i - 1)::float8 / $9, $10)) * interval '1 day'
+            + CASE WHEN random() < 0.1 THEN 24 * random() ELSE 10 + 14 * sqrt(random()) + 4 * random() END * interval '1 hour',
+        random() < 0.03,
+        floor(random() * random() * 400)::int
+    FROM generate_series($1::bigint, $2::bigint) AS i
+'''
+
+# 表示名は重なりのある名前 + 番号 (検索の候補が複数出るように)。
+# 97人に1人は削除済みユーザー (除外)、211人に1人はサーバーを抜けていて users に居ない
+USER_NAMES = ["さくら", "ゆうき", "はると", "みお", "そら", "りん", "あおい", "ひなた", "Yuki", "Sora", "Kai", "Mio", "Ren", "Hina", "Aoi", "Riku"]
+USER_LOGINS = ["sakura", "yuuki", "haruto", "mio", "sora", "rin", "aoi", "hinata", "yuki", "sora", "kai", "mio", "ren", "hina", "aoi", "riku"]
+USERS_SQL = '''
+    INSERT INTO users (user_id, display_name, username, avatar_url, is_excluded)
+    SELECT i,
+           CASE WHEN i % 97 = 0 THEN 'Deleted User'
+                ELSE ($2::text[])[1 + (i * 7) % array_length($2::text[], 1)] || CASE WHEN i % 3 = 0 THEN '' ELSE i::text END END,
+           CASE WHEN i % 97 = 0 THEN 'deleted_user'
+                ELSE ($3::text[])[1 + (i * 7) % array_length($3::text[], 1)] || '_' || i END,
+           CASE WHEN i % 2 = 0 THEN 'https://cdn.discordapp.com/embed/avatars/' || i % 6 || '.png' END,
+           i % 97 = 0
+    FROM generate_series(1, $1::bigint) AS i
+    WHERE i % 211 <> 0
+'''
+
+# 主キー以外の messages の索引 (読み込みの後で作り直す)
+MESSAGE_INDEXES_SQL = '''
+    SELECT indexname, indexdef FROM pg_indexes
+    WHERE schemaname = current_schema() AND tablename = 'messages'
+      AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = 'messages'::regclass)
+'''
+
+def schema_settings(schema):
+    return {"search_path": schema}
+
+def flat_index_sql():
+    # db/indexes.sql の messages の索引。空のテーブルに作るので CONCURRENTLY は外す
+    lines = [line for line in INDEXES_FILE.read_text(encoding="utf-8").splitlines() if not line.startswith("--")]
+    statements = "\n".join(lines).split(";")
+    return [s.replace(" CONCURRENTLY", "").strip() for s in statements if "ON messages" in s]
+
+async def create_schema(dsn, schema, layout="partitioned"):
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute(f'CREATE SCHEMA IF NOT EXISTS "{schema}"')
+    finally:
+        await conn.close()
+    conn = await asyncpg.connect(dsn, server_settings=schema_settings(schema))
+    try:
+        existing = await conn.fetchval("SELECT to_regclass('messages') IS NOT NULL")
+        if existing and await partitions.is_partitioned(conn) != (layout == "partitioned"):
+            logger.info(f"Recreating messages as {layout}")
+            await conn.execute("DROP TABLE messages CASCADE")
+        await conn.execute(SCHEMA_SQL)
+        if layout == "partitioned":
+            await conn.execute(partitions.create_messages_sql("messages"))
+        else:
+            await conn.execute(FLAT_MESSAGES_SQL)
+            for sql in flat_index_sql():
+                await conn.execute(sql)
+        await rollups.ensure_rollup_table(conn)
+        await invalidation.ensure_generation_table(conn)
+    finally:
+        await conn.close()
+
+def build_channels(channels, threads, private_categories, whitelist=(), public_categories=()):
+    # (channels の行, チャンネルごとの発言の重み) を返す。
+    # 先頭から順に、本番の公開チャンネル (ホワイトリストの ID・公開カテゴリ)、ホワイトリスト外の公開チャンネル、
+    # プラチャのカテゴリのチャンネル (17個に1つは未分類) を並べ、重みは順位の 0.7 乗の逆数にする。
+    # スレッドは "親 / スレッド" という名前で親と同じカテゴリに置き (親は前の方に偏る)、
+    # 1つの親のスレッド全体で親の重みの THREAD_SHARE 倍を分け合う (大半はアーカイブ済み)
+    rng = random.Random(0)
+    public_categories = list(public_categories) or [PUBLIC_CATEGORY_BASE + k for k in range(8)]
+    rows, weights = [], []
+    for i in range(channels):
+        if i < len(whitelist) or i % 4 == 0:
+            channel_id = whitelist[i] if i < len(whitelist) else SYNTHETIC_CHANNEL_BASE + i
+            k = i % len(public_categories)
+            category_id, category_name, category_position = public_categories[k], f"category-{k}", k
+            name = f"channel-{i}"
+        elif i % 17 == 0:
+            channel_id, category_id, category_name, category_position = SYNTHETIC_CHANNEL_BASE + i, None, "未分類", 999
+            name = f"room-{i}"
+        else:
+            k = i % private_categories
+            channel_id, category_id, category_name, category_position = SYNTHETIC_CHANNEL_BASE + i, PRIVATE_CATEGORY_BASE + k, f"プラチャ-{k}", 100 + k
+            name = f"room-{i}"
+        is_active = i < len(whitelist) or i % 23 != 0
+        rows.append((channel_id, name, category_name, category_id, category_position * 1000 + i, is_active))
+        weights.append(1 / (i + 1) ** 0.7)
+
+    parents = [min(int(rng.paretovariate(1.2)) - 1, channels - 1) for _ in range(threads)]
+    shares = [rng.random() for _ in range(threads)]
+    share_totals = defaultdict(float)
+    for parent, share in zip(parents, shares):
+        share_totals[parent] += share
+    for j, (parent, share) in enumerate(zip(parents, shares)):
+        channel_id, name, category_name, category_id, position, _ = rows[parent]
+        rows.append((THREAD_CHANNEL_BASE + j, f"{name} / thread-{j}", category_name, category_id, position, rng.random() < 0.3))
+        weights.append(weights[parent] * THREAD_SHARE * share / share_totals[parent])
+    return rows, weights
+
+def cumulative_bounds(weights):
+    # width_bucket 用の各区間の下端 (0 から始まり、合計を 1 にする)
+    total = sum(weights)
+    bounds, acc = [], 0.0
+    for w in weights:
+        bounds.append(acc / total)
+        acc += w
+    return bounds
+
+def month_starts(start_at, days):
+    months = []
+    month = partitions.month_start(start_at)
+    # 深夜に寄せた時刻で最終日の翌日にはみ出すことがあるので1日余分に見る
+    while month <= start_at + datetime.timedelta(days=days + 1):
+        months.append(month)
+        month = partitions.add_months(month, 1)
+    return months
+
+async def drop_message_indexes(conn):
+    # 読み込み中は索引を外しておき、読み込み後に1回で作る (1行ずつ索引を更新するより速い)。
+    # パーティション化したテーブルの定義は "ON ONLY" で出てくるので、子まで作られるように外す
+    rows = await conn.fetch(MESSAGE_INDEXES_SQL)
+    for r in rows:
+        await conn.execute(f'DROP INDEX "{r["indexname"]}"')
+    return [r["indexdef"].replace(" ON ONLY ", " ON ") for r in rows]
+
+async def generate(pool, messages, users, channels, days, start, skew=4.0, threads=0, private_categories=6, whitelist=(), public_categories=(), growth=0.8, jobs=1):
+    async with pool.acquire() as conn:
+        await conn.execute("TRUNCATE messages, users, channels, message_rollups, bucket_generations")
+
+        channel_rows, weights = build_channels(channels, threads, private_categories, whitelist, public_categories)
+        await conn.executemany(
+            "INSERT INTO channels (channel_id, name, category_name, category_id, position, is_active) VALUES ($1, $2, $3, $4, $5, $6)",
+            channel_rows,
+        )
+        await conn.execute(USERS_SQL, users, USER_NAMES, USER_LOGINS)
+
+        start_at = datetime.datetime.combine(start, datetime.time(), tzinfo=JST)
+        if await partitions.is_partitioned(conn):
+            await partitions.ensure_partitions(conn, month_starts(start_at, days))
+        index_sql = await drop_message_indexes(conn)
+
+    channel_ids = [r[0] for r in channel_rows]
+    bounds = cumulative_bounds(weights)
+    chunks = [(first, min(messages, first + CHUNK_SIZE - 1)) for first in range(1, messages + 1, CHUNK_SIZE)]
+    semaphore = asyncio.Semaphore(jobs)
+    started = asyncio.get_running_loop().time()
+
+    async def load(first, last):
+        async with semaphore:
+            await pool.execute(MESSAGES_SQL, first, last, skew, users, channel_ids, bounds, start_at, days, messages, growth)
+            elapsed = asyncio.get_running_loop().time() - started
+            logger.info(f"Inserted messages {first}-{last} ({elapsed:.0f}s)")
+
+    await asyncio.gather(*[load(first, last) for first, last in chunks])
+
+    for sql in index_sql:
+        index_started = asyncio.get_running_loop().time()
+        await pool.execute(sql)
+        logger.info(f"Created index ({asyncio.get_running_loop().time() - index_started:.0f}s): {sql[:80]}")
+    await pool.execute("ANALYZE channels, users, messages")
+
+def add_dataset_args(parser):
+    parser.add_argument("--dsn", default=os.getenv("BENCH_DSN"), help="PostgreSQL DSN used for the synthetic dataset.")
+    parser.add_argument("--schema", default=DEFAULT_SCHEMA, help=f"Schema to create the tables in. Default: {DEFAULT_SCHEMA}")
+    parser.add_argument("--layout", choices=LAYOUTS, default="partitioned", help="messages table layout: monthly partitions (Bot/partitions.py) or the unpartitioned table with db/indexes.sql.")
+    parser.add_argument("--messages", type=int, default=2_000_000, help="Number of messages to generate (tested up to a few hundred million).")
+    parser.add_argument("--users", type=int, default=5_000, help="Number of users to generate.")
+    parser.add_argument("--channels", type=int, default=40, help="Number of top-level channels to generate.")
+    parser.add_argument("--threads", type=int, default=200, help="Number of threads (\"parent / thread\" channels) to generate.")
+    parser.add_argument("--private-categories", type=int, default=6, help="Number of private-chat categories the non-public channels are spread over.")
+    parser.add_argument("--days", type=int, default=600, help="Length of the generated history in days.")
+    parser.add_argument("--start", help="First JST date of the generated history. Default: --days before yesterday, so the history ends about now.")
+    parser.add_argument("--skew", type=float, default=4.0, help="User activity skew; larger values concentrate messages on fewer users.")
+    parser.add_argument("--growth", type=float, default=0.8, help="Exponent for how message volume grows over the history; 1.0 keeps it flat.")
+    parser.add_argument("--jobs", type=int, default=4, help="Chunks of messages inserted in parallel.")
+
+def start_date(args):
+    if args.start:
+        return datetime.date.fromisoformat(args.start)
+    # 夜更けの発言が翌日にはみ出すので、最終日を昨日にする
+    return datetime.date.today() - datetime.timedelta(days=args.days + 1)
+
+def load_api(dsn, backend=None):
+    # main.py の公開チャンネル・カテゴリの定数を使う (読み込みに DSN が要るだけで、接続はしない)
+    os.environ.setdefault("DB_DSN", dsn)
+    sys.path.insert(0, str(backend or ROOT / "backend"))
+    import main as api
+    return api
+
+async def create_dataset(args, api):
+    await create_schema(args.dsn, args.schema, args.layout)
+    # main.py の PRIVATE_CHAT_CATEGORY_IDS はプラチャ総合に含めない (公開の) カテゴリ
+    pool = await asyncpg.create_pool(args.dsn, min_size=1, max_size=max(args.jobs, 1), command_timeout=None, server_settings=schema_settings(args.schema))
+    try:
+        await generate(
+            pool, args.messages, args.users, args.channels, args.days, start_date(args),
+            skew=args.skew, threads=args.threads, private_categories=args.private_categories,
+            whitelist=api.WHITELIST_CHANNEL_IDS, public_categories=api.PRIVATE_CHAT_CATEGORY_IDS,
+            growth=args.growth, jobs=args.jobs,
+        )
+        await rollups.rebuild(pool)
+        await pool.execute("ANALYZE message_rollups")
+    finally:
+        await pool.close()
+
+async def main():
+    parser = argparse.ArgumentParser(description="Fill a PostgreSQL schema with synthetic messages, users, channels and rollups.")
+    add_dataset_args(parser)
+    args = parser.parse_args()
+    if not args.dsn:
+        parser.error("--dsn or BENCH_DSN is required")
+
+    await create_dataset(args, load_api(args.dsn))
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+    asyncio.run(main())
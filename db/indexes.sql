@@ -1,3 +1,7 @@
+-- For the unpartitioned messages table. CREATE INDEX CONCURRENTLY cannot run on a
+-- partitioned table; after `python Bot/partitions.py --migrate` the messages indexes
+-- are the ones created by Bot/partitions.py.
+
 CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_human_created_user
     ON messages (created_at, user_id)
     WHERE is_bot = FALSE;
@@ -26,6 +30,11 @@ CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_human_channel_created
     ON messages (channel_id, created_at)
     WHERE is_bot = FALSE;
 
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_human_jst
+    ON messages (jst_date, jst_hour, channel_id, user_id)
+    INCLUDE (char_count)
+    WHERE is_bot = FALSE;
+
 CREATE EXTENSION IF NOT EXISTS pg_trgm;
 
 CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_display_name_trgm
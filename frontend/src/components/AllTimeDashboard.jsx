@@ -31,19 +31,19 @@ export default function AllTimeDashboard({ channelId, userId }) {
                 const baseParamsStr = baseParams.toString();
                 const histParamsStr = histParams.toString();
 
-                const [rankRes, trendRes, heatmapRes, overallRes, personalRes, pieRes, userRankRes, globalOverallRes] = await Promise.all([
-                    fetchAPI(`/ranking/total${baseParamsStr ? `?${baseParamsStr}` : ''}`),
-                    fetchAPI(`/stats/history/total${histParamsStr ? `?${histParamsStr}` : ''}`),
-                    fetchAPI(`/stats/heatmap/total${baseParamsStr ? `?${baseParamsStr}` : ''}`),
-                    fetchAPI(`/stats/analysis/total${baseParamsStr ? `?${baseParamsStr}` : ''}`),
+                // ランキング・推移・ヒートマップ・全体分析・チャンネル分布は /dashboard でまとめて取得 (閲覧者によらず同じ内容)。
+                // 自分・選択中のユーザーの推移が要るときだけ /stats/history を別に引く
+                const [dashboardRes, trendRes, personalRes, userRankRes, globalOverallRes] = await Promise.all([
+                    fetchAPI(`/dashboard/total${baseParamsStr ? `?${baseParamsStr}` : ''}`),
+                    histParams.has('user_id') ? fetchAPI(`/stats/history/total?${histParamsStr}`) : Promise.resolve(null),
                     userId && userId !== 'guest' ? fetchAPI(`/stats/analysis/total?${baseParamsStr}${baseParamsStr ? '&' : ''}user_id=${userId}`) : Promise.resolve(null),
-                    !channelId ? fetchAPI(`/stats/channels_distribution/total${baseParamsStr ? `?${baseParamsStr}` : ''}`) : Promise.resolve(null),
                     userId && userId !== 'guest' ? fetchAPI(`/users/${userId}/rank/total${baseParamsStr ? `?${baseParamsStr}` : ''}`) : Promise.resolve(null),
                     channelId ? fetchAPI('/stats/analysis/total') : Promise.resolve(null)
                 ]);
 
-                const ranking = await rankRes.json();
-                const trend = await trendRes.json();
+                const dashboard = await dashboardRes.json();
+                const ranking = dashboard?.ranking;
+                const trend = trendRes ? await trendRes.json() : dashboard?.history;
 
                 if (!ranking || ranking.length === 0 || !trend?.chart_data || trend.chart_data.length === 0) {
                     if (channelId) {
@@ -51,14 +51,14 @@ export default function AllTimeDashboard({ channelId, userId }) {
                         return;
                     }
 
-                    window.location.href = `/error?code=502&msg=Empty%20Data&url=${encodeURIComponent(rankRes.url)}`;
+                    window.location.href = `/error?code=502&msg=Empty%20Data&url=${encodeURIComponent(dashboardRes.url)}`;
                     return;
                 }
 
-                const heatmap = await heatmapRes.json();
-                const overall = await overallRes.json();
+                const heatmap = dashboard.heatmap;
+                const overall = dashboard.analysis;
                 const personal = (personalRes && personalRes.ok) ? await personalRes.json() : null;
-                const pie = (pieRes && pieRes.ok) ? await pieRes.json() : [];
+                const pie = dashboard.channels_distribution || [];
                 const globalOverall = (globalOverallRes && globalOverallRes.ok) ? await globalOverallRes.json() : overall;
 
                 const userRank = (userRankRes && userRankRes.ok) ? await userRankRes.json() : null;
@@ -36,20 +36,20 @@ export default function Dashboard({ year, month, channelId, userId }) {
                 const paramsStr = params.toString();
                 const histParamsStr = histParams.toString();
 
+                // ランキング・推移・ヒートマップ・全体分析・チャンネル分布は /dashboard でまとめて取得 (閲覧者によらず同じ内容)。
+                // 自分・選択中のユーザーの推移が要るときだけ /stats/history を別に引く
                 const responses = await Promise.all([
-                    fetchAPI(`/ranking/monthly/${year}/${month}${paramsStr ? `?${paramsStr}` : ''}`),
-                    fetchAPI(`/stats/history/${year}/${month}${histParamsStr ? `?${histParamsStr}` : ''}`),
-                    fetchAPI(`/stats/heatmap/${year}/${month}${paramsStr ? `?${paramsStr}` : ''}`),
-                    fetchAPI(`/stats/analysis/${year}/${month}${paramsStr ? `?${paramsStr}` : ''}`),
+                    fetchAPI(`/dashboard/${year}/${month}${paramsStr ? `?${paramsStr}` : ''}`),
+                    targetId ? fetchAPI(`/stats/history/${year}/${month}?${histParamsStr}`) : Promise.resolve(null),
                     fetchAPI(`/stats/analysis/${prevYear}/${prevMonth}${paramsStr ? `?${paramsStr}` : ''}`),
                     userId && userId !== 'guest' ? fetchAPI(`/stats/analysis/${year}/${month}?${paramsStr}${paramsStr ? '&' : ''}user_id=${userId}`) : Promise.resolve(null),
-                    !channelId ? fetchAPI(`/stats/channels_distribution/${year}/${month}`) : Promise.resolve(null),
                     userId && userId !== 'guest' ? fetchAPI(`/users/${userId}/rank/monthly/${year}/${month}${paramsStr ? `?${paramsStr}` : ''}`) : Promise.resolve(null)
                 ]);
 
-                const [rankRes, trendRes, heatmapRes, overallRes, prevOverallRes, personalRes, pieRes, userRankRes] = responses;
-                const ranking = await rankRes.json();
-                const trend = await trendRes.json();
+                const [dashboardRes, trendRes, prevOverallRes, personalRes, userRankRes] = responses;
+                const dashboard = await dashboardRes.json();
+                const ranking = dashboard?.ranking;
+                const trend = trendRes ? await trendRes.json() : dashboard?.history;
 
                 if (!ranking || ranking.length === 0 || !trend?.chart_data || trend.chart_data.length === 0) {
                     if (channelId) {
@@ -57,15 +57,15 @@ export default function Dashboard({ year, month, channelId, userId }) {
                         return;
                     }
 
-                    window.location.href = `/error?code=502&msg=Empty%20Data&url=${encodeURIComponent(rankRes.url)}`;
+                    window.location.href = `/error?code=502&msg=Empty%20Data&url=${encodeURIComponent(dashboardRes.url)}`;
                     return;
                 }
 
-                const heatmap = await heatmapRes.json();
-                const overall = await overallRes.json();
+                const heatmap = dashboard.heatmap;
+                const overall = dashboard.analysis;
                 const prevOverall = await prevOverallRes.json();
                 const personal = (personalRes && personalRes.ok) ? await personalRes.json() : null;
-                const pie = (pieRes && pieRes.ok) ? await pieRes.json() : [];
+                const pie = dashboard.channels_distribution || [];
 
                 const userRank = (userRankRes && userRankRes.ok) ? await userRankRes.json() : null;
                 let myData = userRank;
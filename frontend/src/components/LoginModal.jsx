@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { Search, User } from 'lucide-react';
 import { fetchAPI } from '@/lib/api';
 
@@ -7,6 +7,8 @@ export default function LoginModal() {
     const [query, setQuery] = useState('');
     const [results, setResults] = useState([]);
     const [loading, setLoading] = useState(false);
+    // 入力ごとに検索するので、後から返ってきた古い入力の結果で上書きしない
+    const latestQuery = useRef('');
 
     useEffect(() => {
         const cookies = document.cookie.split('; ').reduce((acc, current) => {
@@ -32,6 +34,7 @@ export default function LoginModal() {
     const handleSearch = async (e) => {
         const val = e.target.value;
         setQuery(val);
+        latestQuery.current = val;
 
         if (val.length > 0) {
             setLoading(true);
@@ -39,14 +42,14 @@ export default function LoginModal() {
                 const res = await fetchAPI(`/users/search?q=${encodeURIComponent(val)}`);
                 if (res.ok) {
                     const data = await res.json();
-                    setResults(data);
+                    if (latestQuery.current === val) setResults(data);
                 } else {
                     console.error("Search API Error:", res.status);
                 }
             } catch (error) {
                 console.error("Fetch Error:", error);
             } finally {
-                setLoading(false);
+                if (latestQuery.current === val) setLoading(false);
             }
         } else {
             setResults([]);
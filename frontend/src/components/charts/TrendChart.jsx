@@ -146,15 +146,20 @@ export default function TrendChart({ apiData, highlightUserId, focusedUserId, on
     }, []);
 
     useEffect(() => {
+        // 検索はサーバーのメモリ上の索引で答えるので、短い間隔で入力に追従させる
+        let stale = false;
         const delayDebounceFn = setTimeout(async () => {
             if (searchTerm.trim().length > 0) {
                 try {
                     const res = await fetchAPI(`/users/search?q=${encodeURIComponent(searchTerm)}`);
-                    if (res.ok) setSearchResults(await res.json());
+                    if (res.ok) {
+                        const data = await res.json();
+                        if (!stale) setSearchResults(data);
+                    }
                 } catch (e) { console.error(e); }
             } else { setSearchResults([]); }
-        }, 300);
-        return () => clearTimeout(delayDebounceFn);
+        }, 100);
+        return () => { stale = true; clearTimeout(delayDebounceFn); };
     }, [searchTerm]);
 
     if (!apiData || !apiData.chart_data || apiData.chart_data.length === 0) {